@@ -1,4 +1,6 @@
-from structlog import get_logger
+from plsmake.log import LazyLogger
 
 
-logger = get_logger(__name__)
+__version__ = '0.0.1.dev0'
+
+logger = LazyLogger(__name__)
@@ -1,31 +1,90 @@
 import argparse
+import sys
 
-from plsmake import logger
-from plsmake.app import (
-    create_init_env, load_file, resolve, ResolverResults, execute, execute_parallel,
-)
-from plsmake.log import config_logger
+# modules are imported when needed to keep startup fast
+from plsmake import logger, __version__
+from plsmake.log import config_logger, flush_logs, LOG_FORMATS
 
 
-# TODO: --dry-run
 # TODO: auto dependancy with gcc -MM
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--version', action='version', version='plsmake ' + __version__)
     parser.add_argument('-f', '--file', default='Plsmakefile.py', help='build scripts')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='increase verbosity')
     parser.add_argument('--logfile', help='write log to file')
+    parser.add_argument(
+        '--logfile-format', choices=LOG_FORMATS, default='json', help='format of log file')
     parser.add_argument('--resolve', action='store_true', help='only do dependency resolution')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='reuse results of resolvers whose recorded inputs are unchanged')
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='print targets that would be built without running actions')
+    parser.add_argument(
+        '-q', '--question', action='store_true',
+        help='run nothing, exit with 1 if any target is out of date')
     parser.add_argument(
         '-B', '--always-make', action='store_true', help='Unconditionally make all targets')
     parser.add_argument('-j', '--jobs', type=int, help='the number of jobs run simultaneously')
+    parser.add_argument(
+        '--failed-first', action='store_true',
+        help='in parallel mode, run targets depending on previously failed targets or '
+             'files modified since the last build first')
+    parser.add_argument(
+        '--pool', action='append', default=[], metavar='NAME=N',
+        help='run at most N actions of the pool at once, overrides set_pool() of build files')
+    parser.add_argument(
+        '--spawn', choices=['subprocess', 'posix_spawn', 'helper'], default='subprocess',
+        help='how commands are started, helper runs a small process from startup to start '
+             'them, which is faster with big build graphs')
+    parser.add_argument(
+        '--keep-fds', action='store_true',
+        help='do not close inherited file descriptors when starting commands')
+    parser.add_argument(
+        '--progress', action='store_true',
+        help='show a status line of progress instead of echoing commands')
+    parser.add_argument(
+        '--batch-size', type=int, default=16,
+        help='max number of targets passed to a batch action in parallel mode')
+    parser.add_argument(
+        '--shard', metavar='I/N',
+        help='build the I-th of N slices of the targets, balanced by previous durations')
+    parser.add_argument(
+        '--list-shards', type=int, metavar='N', help='print the predicted balance of N shards')
+    parser.add_argument(
+        '-w', '--watch', action='store_true', help='rebuild targets when source files changed')
+    parser.add_argument(
+        '--cache', action='store_true', help='restore action outputs from local cache')
+    parser.add_argument('--cache-dir', help='directory of local action cache')
+    parser.add_argument('--cache-size', default='5G', help='size limit of local action cache')
+    parser.add_argument(
+        '--cache-hardlink', action='store_true',
+        help='restore outputs from cache by hardlink, restored files are read-only')
+    parser.add_argument('--cache-url', help='url of remote action cache')
+    parser.add_argument(
+        '--workers', metavar='ADDR[,ADDR...]',
+        help='run actions declared with remote=True on worker agents at host:port or '
+             'unix:/path, see plsmake.worker')
+    parser.add_argument(
+        '--worker-token', help='secret of worker agents, default: $PLSMAKE_WORKER_TOKEN')
+    parser.add_argument(
+        '--export-plan', metavar='FILE',
+        help='record commands of actions to a plan file instead of building')
+    parser.add_argument(
+        '--export-ninja', metavar='FILE', help='like --export-plan, but write a build.ninja')
+    parser.add_argument(
+        '--run-plan', metavar='FILE',
+        help='build targets with an exported plan, without loading build scripts')
     parser.add_argument('targets', nargs='+', help='target to build')
 
     return parser.parse_args()
 
 
-def print_deps(target: str, resolution: ResolverResults, indent=0, visited=None, stack=None):
+def print_deps(target: str, resolution: 'ResolverResults', indent=0, visited=None, stack=None):
     def iprint(*args):
         print('    ' * indent, *args)
 
@@ -48,23 +107,219 @@ def print_deps(target: str, resolution: ResolverResults, indent=0, visited=None,
     stack.pop()
 
 
-def main():
-    option = parse_args()
-    config_logger(verbose=option.verbose, logfile=option.logfile)
-    logger.info('app.start')
+def create_cache(option):
+    backends = []
+    if option.cache:
+        from plsmake.cache import LocalCache, DEFAULT_CACHE_DIR, parse_size
+        backends.append(LocalCache(
+            root=(option.cache_dir or DEFAULT_CACHE_DIR),
+            max_size=parse_size(option.cache_size), hardlink=option.cache_hardlink,
+        ))
+    if option.cache_url:
+        from plsmake.cache import HttpCache
+        backends.append(HttpCache(option.cache_url))
+
+    if len(backends) > 1:
+        from plsmake.cache import TieredCache
+        return TieredCache(*backends)
+    return backends[0] if backends else None
+
+
+def print_outdated(outdated, db: 'BuildDB', jobs=None):
+    total = 0.0
+    unknown = 0
+    for target in outdated:
+        duration = db.get_duration(target)
+        if duration is None:
+            unknown += 1
+        else:
+            total += duration
+        print(target)
+
+    print('# %d targets out of date, estimated %.1fs of work%s' % (
+        len(outdated), total, unknown and ', %d targets without history' % (unknown,) or '',
+    ))
+    if jobs:
+        print('# about %.1fs with %d jobs' % (total / jobs, jobs))
+
+
+def build(option, exec_options):
+    memo = None
+    if option.incremental:
+        from plsmake.incremental import ResolveMemo
+        memo = ResolveMemo().load()
+    try:
+        build_targets(option, exec_options, memo)
+    finally:
+        if memo is not None:
+            memo.save()
+
+
+def build_targets(option, exec_options, memo):
+    if option.watch:
+        from plsmake.watch import watch
+        try:
+            watch(
+                option.file, option.targets, jobs=(option.jobs or 1),
+                always_make=option.always_make, memo=memo, **exec_options
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    from collections import OrderedDict
+    from plsmake.app import (
+        create_init_env, load_file, resolve, execute, execute_parallel, outdated_targets,
+    )
 
     rule_list, env = load_file(option.file, create_init_env())
+    outdated = OrderedDict()
+    exporting = option.export_plan or option.export_ninja
+    sharding = option.shard or option.list_shards
+    results = []
     for target in option.targets:
         logger.info('app.start_target', target=target)
-        result = resolve(target, rule_list, env)
+        result = resolve(target, rule_list, env, memo=memo)
         if option.resolve:
             print_deps(target, result)
+        elif exporting or sharding:
+            results.append((target, result))
+        elif option.dry_run or option.question:
+            outdated.update((t, True) for t in outdated_targets(
+                target, result, always_make=option.always_make, db=exec_options['db']))
         elif option.jobs is not None:
-            execute_parallel(target, result, option.jobs, always_make=option.always_make)
+            execute_parallel(
+                target, result, option.jobs, always_make=option.always_make,
+                batch_size=option.batch_size, failed_first=option.failed_first, **exec_options)
         else:
-            execute(target, result, always_make=option.always_make)
+            execute(target, result, always_make=option.always_make, **exec_options)
         logger.info('app.finish_target', target=target)
 
+    if option.question:
+        sys.exit(1 if outdated else 0)
+    elif option.dry_run:
+        print_outdated(list(outdated), exec_options['db'], jobs=option.jobs)
+    elif sharding:
+        build_shard(option, exec_options, results)
+    elif exporting:
+        from plsmake.plan import record_plan, save_plan, write_ninja
+        plan = record_plan(results)
+        if option.export_plan:
+            save_plan(plan, option.export_plan)
+        if option.export_ninja:
+            write_ninja(plan, option.export_ninja)
+
+
+def build_shard(option, exec_options, results):
+    from plsmake.app import ParallelExecutor
+    from plsmake.shard import merge_results, parse_shard, plan_shards, print_shards
+
+    howto = merge_results([result for _, result in results])
+    roots = [target for target, _ in results]
+    if option.list_shards:
+        shards = plan_shards(howto, roots, option.list_shards, db=exec_options.get('db'))
+        print_shards(shards, howto, roots)
+        return
+
+    index, count = parse_shard(option.shard)
+    shard = plan_shards(howto, roots, count, db=exec_options.get('db'))[index]
+    logger.info('shard.build', shard=option.shard, units=shard.units, estimated=shard.cost)
+    if not shard.units:
+        return
+    controller = ParallelExecutor(howto)
+    for unit in shard.units:
+        controller.add_target(unit)
+    controller.start(
+        option.jobs or 1, always_make=option.always_make, batch_size=option.batch_size,
+        failed_first=option.failed_first, **exec_options)
+
+
+def setup_pools(option):
+    from plsmake.app import set_pool_size
+    for spec in option.pool:
+        name, _, size = spec.partition('=')
+        set_pool_size(name, int(size), fixed=True)
+
+
+def setup_jobserver(option):
+    if option.dry_run or option.question or option.resolve or option.list_shards:
+        return
+    from plsmake import jobserver
+    if jobserver.setup(option.jobs) is not None and option.jobs is None:
+        # under make -j, the jobserver tokens limit the number of jobs
+        import os
+        option.jobs = os.cpu_count() or 1
+
+
+def main():
+    option = parse_args()
+    config_logger(
+        verbose=option.verbose, logfile=option.logfile, log_format=option.logfile_format,
+        echo_commands=(not option.progress),
+    )
+    setup_pools(option)
+    setup_jobserver(option)
+    if option.spawn != 'subprocess' or option.keep_fds:
+        # after the jobserver, whose pipe is passed to commands by the helper
+        from plsmake import spawn
+        spawn.configure(option.spawn, keep_fds=option.keep_fds)
+    if option.jobs is not None or option.progress:
+        # capture output of actions to avoid interleaving
+        from plsmake import output
+        output.enable(progress=option.progress)
+
+    try:
+        run(option)
+    finally:
+        if option.jobs is not None or option.progress:
+            output.disable()
+        if option.spawn != 'subprocess':
+            spawn.shutdown()
+        flush_logs()
+
+
+def run(option):
+    logger.info('app.start')
+
+    if option.run_plan:
+        from plsmake.plan import run_plan
+        run_plan(option.run_plan, option.targets, always_make=option.always_make)
+        logger.info('app.finish')
+        return
+
+    if option.resolve or option.export_plan or option.export_ninja:
+        # fast path, no need for build database and cache
+        build(option, dict())
+        logger.info('app.finish')
+        return
+
+    import time
+    from plsmake.app import stat_cache
+    from plsmake.db import BuildDB
+
+    cache = create_cache(option)
+    db = BuildDB().load()
+    stat_cache.use_floors(db.restat)
+    exec_options = dict(cache=cache, db=db)
+    if option.workers:
+        import os
+        from plsmake.remote import WorkerPool
+        token = option.worker_token or os.environ.get('PLSMAKE_WORKER_TOKEN')
+        exec_options['remote'] = WorkerPool(option.workers.split(','), token=token)
+        if option.jobs is None:
+            option.jobs = exec_options['remote'].slots
+    started = int(time.time() * 10 ** 9)
+    try:
+        build(option, exec_options)
+    finally:
+        if cache is not None:
+            cache.close()
+        if option.workers:
+            exec_options['remote'].close()
+        if not (option.dry_run or option.question or option.list_shards):
+            db.last_run = started
+            db.save()
+
     logger.info('app.finish')
 
 
@@ -1,30 +1,91 @@
-import subprocess
-
 from plsmake import logger
-from plsmake.app import get_context
+from plsmake.app import get_context, record_input, stat_cache
+
+
+# names a build file gets from `from plsmake.api import *`
+__all__ = [
+    'get_env', 'deps', 'action', 'batch_action', 'task', 'set_pool', 'include',
+    'listdir', 'glob_files', 'run', 'run_many', 'run_with_output',
+]
 
 
 def get_env():
     return get_context().get_env()
 
 
-def deps(urle_url):
-    return get_context().deps(urle_url)
+def deps(*rule_urls):
+    return get_context().deps(*rule_urls)
+
+
+def action(*rule_urls, **options):
+    return get_context().action(*rule_urls, **options)
+
+
+def batch_action(*rule_urls, **options):
+    return get_context().batch_action(*rule_urls, **options)
+
+
+def task(*rule_urls, **options):
+    return get_context().task(*rule_urls, **options)
 
 
-def action(rule_url):
-    return get_context().action(rule_url)
+def set_pool(name, size):
+    return get_context().set_pool(name, size)
 
 
-def task(rule_url):
-    return get_context().task(rule_url)
+def include(filename, prefix=None):
+    return get_context().include(filename, prefix=prefix)
+
+
+def listdir(path='.'):
+    """Return sorted names in directory. Listings are cached during a run and
+    the directory is recorded as an input of the current resolver"""
+    record_input(path)
+    return [name for name, _ in stat_cache.scandir(path)]
+
+
+def glob_files(pattern):
+    """Like glob.glob(pattern, recursive=True) with cached listings,
+    listed directories are recorded as inputs of the current resolver"""
+    listed = []
+    result = stat_cache.glob(pattern, listed)
+    for path in listed:
+        record_input(path)
+    return result
 
 
 def run(*args):
+    from plsmake.plan import recorded_commands
+    commands = recorded_commands()
+    if commands is not None:
+        commands.append(list(args))
+        return 0
+
+    from plsmake.process import run_command
     logger.info('run_cmd', msg=' '.join(args), args=args)
-    return subprocess.check_call(args)
+    return run_command(args)
+
+
+def run_many(commands, jobs=None, check=True, want_stdout=False):
+    """Run commands concurrently with job slots of the build, see process.run_many()"""
+    from plsmake.plan import recorded_commands, NotRecordable
+    recorded = recorded_commands()
+    if recorded is not None:
+        if want_stdout:
+            raise NotRecordable('run_many(want_stdout=True)')
+        from plsmake.process import CommandResult
+        recorded.extend(list(args) for args in commands)
+        return [CommandResult(list(args), 0, None, b'') for args in commands]
+
+    from plsmake.process import run_many
+    return run_many(commands, jobs=jobs, check=check, want_stdout=want_stdout)
 
 
 def run_with_output(*args):
+    from plsmake.plan import recorded_commands, NotRecordable
+    if recorded_commands() is not None:
+        raise NotRecordable('run_with_output(%s)' % (' '.join(args),))
+
+    from plsmake.process import run_command
     logger.info('run_cmd', msg=' '.join(args), args=args)
-    return subprocess.check_output(args)
+    return run_command(args, want_stdout=True)
@@ -1,18 +1,27 @@
-from collections import OrderedDict, deque
-import concurrent.futures as cf
+from collections import OrderedDict, deque, namedtuple
 from contextlib import contextmanager
 from functools import update_wrapper
+import hashlib
+import importlib.util
+import itertools
+import marshal
 import os
 import shlex
-from typing import Callable, Mapping, Sequence, Tuple, Set, Dict, List
+import threading
+import time
+from typing import Callable, Iterable, Mapping, Sequence, Tuple, Set, Dict, List
 
-from plsmake import logger
+from plsmake import logger, output
 from plsmake.env import Env
-from plsmake.rule import Rule
-from plsmake.utils import func_name
+from plsmake.fs import CACHE_DIR, StatCache
+from plsmake.rule import Rule, RuleDispatcher, most_specific
+from plsmake.utils import code_digest, func_name
 
 
 _current_context = None     # type: Context
+stat_cache = StatCache()
+pool_sizes = dict()         # type: Dict[str, int]
+_fixed_pools = set()        # type: Set[str]
 
 
 class DuplicatedRule(Exception):
@@ -28,20 +37,87 @@ class ActionNoResult(Exception):
 
 
 class Action:
-    def __init__(self, func, is_task=False):
+    """outputs: rule urls of targets produced by one call of the action
+    batch: None for normal action, or the max number of targets passed to one call
+    of a batch action, 0 means the default of executor
+    remote: the action may run on remote workers, see plsmake.remote
+    pool: name of the pool limiting concurrent calls in parallel mode, see set_pool_size()
+    task_inputs, task_outputs: file patterns of a task, which runs only when they or
+    the action option and environment changed, see Context.task()"""
+
+    def __init__(
+            self, func, is_task=False, cache=True, restat=False, outputs=(), batch=None,
+            remote=False, pool=None, task_inputs=None, task_outputs=None):
         self.func = func
         self.is_task = is_task
+        self.cache = cache
+        self.restat = restat
+        self.remote = remote
+        self.pool = pool
+        self.task_inputs = task_inputs and list(task_inputs)
+        self.task_outputs = task_outputs and list(task_outputs)
+        self.outputs = list(outputs)
+        self.batch = batch
         update_wrapper(self, func, updated=())
 
     def __call__(self, *args, **kwargs):
         return self.func(*args, **kwargs)
 
+    def group_targets(self, action_option: Mapping) -> List[str]:
+        """Return all targets produced with the action option"""
+        return [url.format_map(action_option) for url in self.outputs]
+
+    @property
+    def stamped(self) -> bool:
+        return self.is_task and (self.task_inputs is not None or self.task_outputs is not None)
+
+    def task_files(self, patterns: Sequence[str], action_option: Mapping) -> List[str]:
+        """Return existing files matching patterns formatted with the action option"""
+        files = []
+        for pattern in patterns or ():
+            files.extend(
+                path for path in stat_cache.glob(pattern.format_map(action_option))
+                if stat_cache.is_file(path))
+        return files
+
+
+BatchItem = namedtuple('BatchItem', ['target', 'env', 'depends', 'option'])
+
+
+class RuleTable(OrderedDict):
+    """An OrderedDict of Rule -> [resolver, action], with build files that are loaded
+    when a target of their prefix is resolved. included lists the build files loaded
+    by include() so far"""
+
+    def __init__(self, context: 'Context'=None):
+        super().__init__()
+        self.context = context
+        self.includes = []  # type: List[Tuple[str, str]]
+        self.included = []  # type: List[str]
+        self._dispatcher = None
+
+    def match(self, target: str):
+        """Return [(rule, params)] of matching rules in definition order"""
+        # rules are only added, the dispatcher is rebuilt when it happens
+        if self._dispatcher is None or len(self._dispatcher.rules) != len(self):
+            self._dispatcher = RuleDispatcher(self.keys())
+        return self._dispatcher.match(target)
+
+    def load_includes(self, target: str):
+        for prefix, filename in list(self.includes):
+            if target.startswith(prefix):
+                logger.info('load.lazy_include', file=filename, prefix=prefix, target=target)
+                self.includes.remove((prefix, filename))
+                self.included.append(filename)
+                with enter_context(self.context):
+                    exec(compile_file(filename), dict())
+
 
 class Context:
     def __init__(self, init_env=None):
         init_env = init_env or create_init_env()
         self.env = init_env.make_child()
-        self.rule_list = OrderedDict()
+        self.rule_list = RuleTable(self)
 
     def get_rule_list(self):
         return self.rule_list
@@ -58,36 +134,98 @@ class Context:
         da[0] = func
         logger.info('load.read_deps', rule=rule_url, func=func.__name__)
 
-    def _set_action(self, rule_url, func, is_task):
-        da = self.rule_list.setdefault(Rule(rule_url), [None, None])
+    def _set_action(self, rule_urls, func, is_task, **options):
+        params = set(Rule(rule_urls[0]).params)
+        for rule_url in rule_urls:
+            if set(Rule(rule_url).params) != params:
+                raise ValueError('outputs of an action must have same params: %r' % (rule_urls,))
 
-        if da[1] is not None:
-            logger.error('load.dup_rule', rule=rule_url)
-            raise DuplicatedRule(rule_url)
-        da[1] = Action(func, is_task=is_task)
-        logger.info('load.read_action', rule=rule_url, func=func.__name__, is_task=is_task)
+        action = Action(func, is_task=is_task, outputs=rule_urls, **options)
+        for rule_url in rule_urls:
+            da = self.rule_list.setdefault(Rule(rule_url), [None, None])
+
+            if da[1] is not None:
+                logger.error('load.dup_rule', rule=rule_url)
+                raise DuplicatedRule(rule_url)
+            da[1] = action
+            logger.info('load.read_action', rule=rule_url, func=func.__name__, is_task=is_task)
+
+    def deps(self, *rule_urls: str):
+        def g(func):
+            for rule_url in rule_urls:
+                self._set_deps(rule_url, func)
+            func.action = self.action(*rule_urls)
+            func.task = self.task(*rule_urls)
+            return func
+        return g
 
-    def deps(self, rule_url: str):
+    def action(self, *rule_urls, cache=True, restat=False, remote=False, pool=None):
+        """Multiple rule urls means the action produces all of them in one call.
+        cache: whether the output can be restored from action cache
+        restat: if the action may leave its output untouched, dependants are not
+        rebuilt in that case
+        remote: the action only runs commands using relative paths of its dependencies
+        and outputs, so it can run on remote workers
+        pool: name of a pool declared with set_pool()"""
         def g(func):
-            self._set_deps(rule_url, func)
-            func.action = self.action(rule_url)
-            func.task = self.task(rule_url)
+            self._set_action(
+                rule_urls, func, False, cache=cache, restat=restat, remote=remote, pool=pool)
             return func
         return g
 
-    def action(self, rule_url):
+    def batch_action(self, *rule_urls, size=0, cache=True, pool=None):
+        """The action is called with a list of BatchItem of ready targets.
+        size: max number of targets in one call, 0 means the default of executor
+        pool: name of a pool declared with set_pool(), a call takes one slot"""
         def g(func):
-            self._set_action(rule_url, func, False)
+            self._set_action(rule_urls, func, False, cache=cache, batch=size, pool=pool)
             return func
         return g
 
-    def task(self, rule_url):
+    def set_pool(self, name: str, size: int):
+        """Run at most size actions of the pool at once in parallel mode"""
+        set_pool_size(name, size)
+
+    def include(self, filename: str, prefix: str=None):
+        """Load another build file. If prefix is given, the file is loaded lazily
+        when a target starts with prefix is resolved."""
+        if prefix is None:
+            logger.info('load.include', file=filename)
+            self.rule_list.included.append(filename)
+            exec(compile_file(filename), dict())
+        else:
+            self.rule_list.includes.append((prefix, filename))
+
+    def task(self, *rule_urls, inputs=None, outputs=None):
+        """A task is always run, unless it declares inputs or outputs. Then it is run
+        only if the input files, the action option or environment changed since the
+        last successful run, or an output file is missing. The state is stored in the
+        build database.
+        inputs, outputs: file paths or glob patterns, formatted with rule params"""
         def g(func):
-            self._set_action(rule_url, func, True)
+            self._set_action(rule_urls, func, True, task_inputs=inputs, task_outputs=outputs)
             return func
         return g
 
 
+def set_pool_size(name: str, size: int, fixed=False):
+    """fixed: the size is given on command line, build files do not change it"""
+    if size < 1:
+        raise ValueError('size of pool %s must be positive: %d' % (name, size))
+    if name in _fixed_pools and not fixed:
+        return
+    if fixed:
+        _fixed_pools.add(name)
+    pool_sizes[name] = size
+    logger.info('load.pool', pool=name, size=size)
+
+
+def _reset_pools():
+    """Forget pools set by a previously loaded build file"""
+    for name in set(pool_sizes) - _fixed_pools:
+        del pool_sizes[name]
+
+
 def get_context() -> Context:
     return _current_context
 
@@ -128,10 +266,52 @@ def create_init_env() -> Env:
     return Env(init)
 
 
-def load_file(filaname: str, env: Env):
-    with open(filaname, 'rt') as fp:
+CODE_CACHE_DIR = os.path.join(CACHE_DIR, 'code')
+
+
+def _read_code_cache(cache_file: str, header: bytes):
+    try:
+        with open(cache_file, 'rb') as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def compile_file(filename: str):
+    """Compile a build file, the code object is cached under CODE_CACHE_DIR
+    and keyed by the path, mtime and size of the file"""
+    st = os.stat(filename)
+    path_hash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    cache_file = os.path.join(CODE_CACHE_DIR, path_hash)
+    header = importlib.util.MAGIC_NUMBER + ('%d:%d\n' % (st.st_mtime_ns, st.st_size)).encode()
+
+    code = _read_code_cache(cache_file, header)
+    if code is not None:
+        logger.debug('load.code_cache_hit', file=filename)
+        return code
+
+    with open(filename, 'rt') as fp:
         string = fp.read()
-    return load_string(string, env)
+    code = compile(string, filename, 'exec')
+    try:
+        os.makedirs(CODE_CACHE_DIR, exist_ok=True)
+        tmp = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(header + marshal.dumps(code))
+        os.replace(tmp, cache_file)
+    except OSError:
+        logger.exception('load.code_cache_fail', file=filename)
+    return code
+
+
+def load_file(filaname: str, env: Env):
+    return load_code(compile_file(filaname), env)
 
 
 RuleList = Mapping[Rule, Tuple[Callable, Action]]
@@ -139,18 +319,68 @@ RuleList = Mapping[Rule, Tuple[Callable, Action]]
 
 def load_string(string: str, env: Env, exec_ns=None) -> Tuple[RuleList, Env]:
     """Return an OrderedDict of Rule -> (resolver, action) and the envrionment after exec()"""
+    return load_code(string, env, exec_ns=exec_ns)
+
+
+def load_code(code, env: Env, exec_ns=None) -> Tuple[RuleList, Env]:
+    """Same as load_string() but accept code object"""
+    _reset_pools()
     context = Context(init_env=env)
     with enter_context(context):
-        exec(string, exec_ns or dict())
+        exec(code, exec_ns or dict())
         return context.get_rule_list(), context.get_env()
 
 
 ResolverResults = Mapping[str, Tuple[Sequence[str], Env, Action, Mapping]]
 
 
-def resolve(target: str, rule_list: RuleList, env: Env) -> ResolverResults:
-    """Return a dict of target -> (deps, env, action)"""
+_resolve_inputs = None     # type: Dict[str, int]
+
+
+def record_input(path: str):
+    """Record a file or directory that current resolver depends on"""
+    if _resolve_inputs is not None and path not in _resolve_inputs:
+        from plsmake.incremental import input_stamp
+        _resolve_inputs[path] = input_stamp(path)
+
+
+def _run_resolvers(target, matches, subenv, depends, log):
+    for rule, resolver, matched in matches:
+        if resolver is not None:
+            try:
+                resolver(subenv, depends, **matched)
+            except Exception:
+                log.exception('resolve.exception', rule=str(rule))
+                raise
+
+
+def _resolve_with_memo(target, matches, subenv, depends, log, memo):
+    global _resolve_inputs
+    signature = [
+        (rule.url, resolver and code_digest(resolver), sorted(matched.items()))
+        for rule, resolver, matched in matches
+    ]
+    record = memo.lookup(target, signature, subenv)
+    if record is not None:
+        log.debug('resolve.reuse')
+        memo.replay(record, depends, subenv)
+        return
+
+    subenv.track_reads()
+    _resolve_inputs = dict()
+    try:
+        _run_resolvers(target, matches, subenv, depends, log)
+    finally:
+        files, _resolve_inputs = _resolve_inputs, None
+        env_reads = subenv.stop_tracking()
+    memo.store(target, signature, env_reads, files, depends, subenv)
+
+
+def resolve(target: str, rule_list: RuleList, env: Env, memo=None) -> ResolverResults:
+    """Return a dict of target -> (deps, env, action)
+    memo: a ResolveMemo to reuse results of resolvers whose inputs are unchanged"""
     result = OrderedDict()
+    dispatcher = rule_list if isinstance(rule_list, RuleTable) else RuleDispatcher(rule_list)
     pending = deque([(target, env.make_child())])
     pending_set = {target}
     while pending:
@@ -164,20 +394,29 @@ def resolve(target: str, rule_list: RuleList, env: Env) -> ResolverResults:
         log = logger.bind(target=target)
 
         log.info('resolve.begin')
-        for rule, (resolver, action) in rule_list.items():
-            matched = rule.match(target)
-            if matched is not None:
-                log.info('resolve.matching', rule=str(rule))
-                if resolver is not None:
-                    try:
-                        resolver(subenv, depends, **matched)
-                    except Exception:
-                        log.exception('resolve.exception', rule=str(rule))
-                        raise
-                if action is not None:
-                    assert only_action is None
-                    only_action = action
-                    action_option = matched
+        if isinstance(rule_list, RuleTable):
+            rule_list.load_includes(target)
+        matches = []
+        action_rules = OrderedDict()     # in definition order for ties in most_specific()
+        for rule, matched in dispatcher.match(target):
+            log.info('resolve.matching', rule=str(rule))
+            resolver, action = rule_list[rule]
+            matches.append((rule, resolver, matched))
+            if action is not None:
+                action_rules[rule] = action, matched
+
+        if action_rules:
+            rule = most_specific(action_rules)
+            if len(action_rules) > 1:
+                log.info(
+                    'resolve.select_action',
+                    rule=str(rule), candidates=[str(candidate) for candidate in action_rules])
+            only_action, action_option = action_rules[rule]
+
+        if memo is None:
+            _run_resolvers(target, matches, subenv, depends, log)
+        else:
+            _resolve_with_memo(target, matches, subenv, depends, log, memo)
 
         log.debug(
             'resolve.result',
@@ -190,15 +429,18 @@ def resolve(target: str, rule_list: RuleList, env: Env) -> ResolverResults:
                 pending.append((dep, subenv.make_child()))
                 pending_set.add(dep)
 
+    if memo is not None:
+        logger.info('resolve.memo', hits=memo.hits, misses=memo.misses)
     return result
 
 
 def file_newer(f1: str, f2: str):
-    return os.stat(f1).st_mtime_ns > os.stat(f2).st_mtime_ns
+    """Return True if f1 is newer than the output f2"""
+    return stat_cache.mtime(f1) > stat_cache.output_mtime(f2)
 
 
 def file_exist(filename: str):
-    return os.path.isfile(filename)
+    return stat_cache.is_file(filename)
 
 
 def should_build(target: str, howto: ResolverResults, always_make=False):
@@ -222,16 +464,74 @@ def should_build(target: str, howto: ResolverResults, always_make=False):
     return False
 
 
-def execute(target: str, howto: ResolverResults, always_make=False, visited=None):
+def _closure(target: str, howto: ResolverResults) -> Set[str]:
+    """Return target and all its dependencies"""
+    result = set()
+    stack = [target]
+    while stack:
+        current = stack.pop()
+        if current not in result:
+            result.add(current)
+            stack.extend(howto[current][0])
+    return result
+
+
+def outdated_targets(
+        target: str, howto: ResolverResults, always_make=False, db=None) -> List[str]:
+    """Return targets that would be built in topological order, without running actions.
+    A target is out of date if should_build() says so or any non-task dependency is out of date.
+    With db, tasks declaring inputs or outputs are skipped as by run_target_action()."""
+    stat_cache.clear()
+    outdated = OrderedDict()    # type: Dict[str, bool]
+    visited = set()
+    stack = [(target, False)]
+    while stack:
+        current, expanded = stack.pop()
+        depends, _, action, _ = howto[current]
+        if not expanded:
+            if current in visited:
+                continue
+            visited.add(current)
+            stack.append((current, True))
+            stack.extend((dep, False) for dep in reversed(depends) if dep not in visited)
+            continue
+
+        dirty = False
+        stamp_known = True  # stamps of task dependencies are known
+        for dep in depends:
+            _, _, dep_action, _ = howto[dep]
+            if dep in outdated:
+                if not (dep_action and dep_action.is_task):
+                    dirty = True
+                    break
+                stamp_known = stamp_known and not dep_action.stamped
+        if (not dirty and stamp_known and not always_make and db is not None
+                and action is not None and action.stamped):
+            from plsmake.cache import task_stamp
+            if _task_up_to_date(current, howto, db, task_stamp(current, howto, db)):
+                continue
+        if dirty or should_build(current, howto, always_make=always_make):
+            if action is None:
+                logger.warning('dry_run.no_action', target=current)
+            outdated[current] = True
+
+    return list(outdated)
+
+
+def execute(target: str, howto: ResolverResults, always_make=False, visited=None, **options):
+    """options are passed to run_target_action()"""
+    if visited is None:
+        _begin_run()
+        output.add_total(len(_closure(target, howto)))
     visited = visited or set()
     visited.add(target)
 
     depends, env, action, action_option = howto[target]
     for dep in depends:
         if dep not in visited:
-            execute(dep, howto, always_make=always_make, visited=visited)
+            execute(dep, howto, always_make=always_make, visited=visited, **options)
 
-    run_target_action(target, howto, always_make=always_make)
+    run_target_action(target, howto, always_make=always_make, **options)
 
 
 class ParallelExecutor:
@@ -241,20 +541,51 @@ class ParallelExecutor:
         self._waiting = dict()      # type: Dict[str, Set[str]]
         self._rev_waiting = dict()  # type: Dict[str, Set[str]]
         self._pending = []          # type: List[str]
+        self._priority = set()      # type: Set[str]
 
-    def add_target(self, target: str):
+    def add_target(self, target: str, limit: Set[str]=None):
+        """Schedule target and its dependencies. If limit is given, dependencies
+        outside of it are considered up to date and not scheduled."""
         if target in self._waiting or target in self._pending:
             return
 
         depends, *_ = self.howto[target]
         waiting = self._waiting.setdefault(target, set())
         for dep in depends:
+            if limit is not None and dep not in limit:
+                continue
             waiting.add(dep)
             self._rev_waiting.setdefault(dep, set()).add(target)
-            self.add_target(dep)
+            self.add_target(dep, limit=limit)
 
         self.check_depends(target)
 
+    def rev_depends(self) -> Dict[str, Set[str]]:
+        """Return a copy of the dependency -> dependants map of scheduled targets"""
+        return dict((dep, rev.copy()) for dep, rev in self._rev_waiting.items())
+
+    def prioritize(self, targets: Iterable[str]):
+        """Run ready targets depending on the given targets, directly or indirectly,
+        before others. Call it after add_target()."""
+        stack = list(targets)
+        while stack:
+            target = stack.pop()
+            if target not in self._priority:
+                self._priority.add(target)
+                stack.extend(self._rev_waiting.get(target, ()))
+
+    def prioritize_failed(self, db):
+        """Prioritize targets failed last time and inputs modified since the last build"""
+        hot = [target for target in db.failures if target in self.howto]
+        if db.last_run is not None:
+            for target in itertools.chain(self._waiting, self._pending):
+                depends, _, action, _ = self.howto[target]
+                if not depends and action is None and file_exist(target) \
+                        and stat_cache.mtime(target) > db.last_run:
+                    hot.append(target)
+        logger.info('execute.prioritize', targets=hot)
+        self.prioritize(hot)
+
     def check_depends(self, target):
         """Check weither target is ready to run"""
         if not self._waiting[target]:
@@ -268,63 +599,340 @@ class ParallelExecutor:
             self._waiting[rev_dep].remove(target)
             self.check_depends(rev_dep)
 
-    def start(self, jobs: int, always_make=False):
+    def _group_pending(self, pending: List[str], jobs: int, batch_size: int) -> List[List[str]]:
+        """Group ready targets of the same batch action, other targets are run alone"""
+        groups = []
+        batches = OrderedDict()     # type: Dict[Action, List[str]]
+        for target in pending:
+            _, _, action, _ = self.howto[target]
+            if action is not None and action.batch is not None:
+                batches.setdefault(action, []).append(target)
+            else:
+                groups.append([target])
+
+        for action, targets in batches.items():
+            # do not make batches so big that jobs are left idle
+            size = min(action.batch or batch_size, -(-len(targets) // jobs))
+            size = max(size, 1)
+            for i in range(0, len(targets), size):
+                groups.append(targets[i:i + size])
+        return groups
+
+    def _pool_of(self, group: List[str]):
+        _, _, action, _ = self.howto[group[0]]
+        return action and action.pool
+
+    def _check_pools(self) -> Dict[str, int]:
+        running = dict()
+        for _, _, action, _ in self.howto.values():
+            if action is not None and action.pool is not None:
+                if action.pool not in pool_sizes:
+                    raise ValueError('unknown pool: %s' % (action.pool,))
+                running[action.pool] = 0
+        return running
+
+    def _update_pool(self, group: List[str], running: Dict[str, int], delta: int):
+        name = self._pool_of(group)
+        if name is not None:
+            running[name] += delta
+            logger.info(
+                'execute.pool', pool=name, running=running[name], size=pool_sizes[name],
+                target=group[0])
+
+    def start(self, jobs: int, always_make=False, batch_size=16, failed_first=False, **options):
+        """batch_size: the default max number of targets passed to a batch action
+        failed_first: run targets depending on failed targets or recently modified
+        files first, requires the db option
+        options are passed to run_target_action()
+        Under a jobserver (see plsmake.jobserver), a job beyond the first one runs
+        only with a token. Actions of a pool run only while the pool is not full."""
+        import concurrent.futures as cf
+        from plsmake import jobserver
+        from plsmake.process import children
         assert self._pending
-
-        with cf.ThreadPoolExecutor(max_workers=jobs) as pool:
-            works = dict()
-            while self._pending or works:
-                pending = self._pending.copy()
+        _begin_run()
+        output.add_total(len(self._waiting) + len(self._pending))
+        if failed_first and options.get('db') is not None:
+            self.prioritize_failed(options['db'])
+
+        pool = cf.ThreadPoolExecutor(max_workers=jobs)
+        works = dict()
+        # groups of ready targets, submitted only when a worker is free
+        ready = _ReadyGroups()
+        slots = jobserver.JobSlots(jobserver.client)
+        running = self._check_pools()   # pool -> number of running groups
+        try:
+            while self._pending or ready or works:
+                for group in self._group_pending(self._pending, jobs, batch_size):
+                    ready.append(group, group[0] in self._priority, self._pool_of(group))
                 self._pending.clear()
-                for target in pending:
-                    logger.debug('execute.submit', target=target)
+
+                waiting_token = False
+                while len(works) < jobs:
+                    queue = ready.first(running)
+                    if queue is None:
+                        break
+                    if not slots.acquire(len(works)):
+                        waiting_token = True
+                        break
+                    _, group = queue.popleft()
+                    logger.debug('execute.submit', target=group[0], group=group)
+                    self._update_pool(group, running, 1)
                     fut = pool.submit(
-                        run_target_action, target, self.howto, always_make=always_make)
-                    works[fut] = target
+                        children.bind(run_targets_action), group, self.howto,
+                        always_make=always_make, **options)
+                    works[fut] = group
 
-                done, not_done = cf.wait(works.keys(), return_when=cf.FIRST_COMPLETED)
+                done, not_done = cf.wait(
+                    works.keys(), timeout=(0.05 if waiting_token else None),
+                    return_when=cf.FIRST_COMPLETED)
                 for fut in done:    # type: cf.Future
                     if fut.exception() is not None:
                         logger.error('execute.stop_all', cause_target=works[fut])
-                        # some task failed, cancel other task and re-raise exception
-                        for not_done_fut in not_done:   # type: cf.Future
-                            not_done_fut.cancel()
                         raise fut.exception()
 
-                    self.action_done(works.pop(fut))
+                    group = works.pop(fut)
+                    self._update_pool(group, running, -1)
+                    for target in group:
+                        self.action_done(target)
+                slots.fit(len(works))
+        except BaseException:
+            # some task failed or interrupted, cancel other tasks and kill running commands
+            for fut in works:
+                fut.cancel()
+            children.terminate_all()
+            # workers still running python code or remote commands are left behind,
+            # they stay in the stopped generation, while later runs and resolvers of
+            # watch mode may start commands again
+            children.reset()
+            pool.shutdown(wait=False)
+            raise
+        finally:
+            slots.fit(0)
+        pool.shutdown()
 
         assert not self._pending
         assert not self._waiting
         assert not self._rev_waiting
 
 
-def run_target_action(target: str, howto: ResolverResults, always_make=False):
-    log = logger.bind(target=target)
-    log.info('execute.begin')
+class _ReadyGroups:
+    """Ready groups in a deque per (priority, pool), so that groups of a full pool
+    are skipped at once instead of one by one"""
 
-    depends, env, action, action_option = howto[target]
+    def __init__(self):
+        self._queues = OrderedDict()    # (hot, pool) -> deque of (seq, group)
+        self._seq = itertools.count()
 
-    if should_build(target, howto, always_make=always_make):
-        if action is None:
-            log.error('execute.no_action')
-            raise NoAction(target)
+    def __bool__(self):
+        return any(self._queues.values())
 
-        log.info('execute.action', action=func_name(action))
-        try:
-            action(env, depends, **action_option)
-        except Exception:
-            log.exception('execute.exception')
-            raise
+    def append(self, group: List[str], hot: bool, pool: str):
+        self._queues.setdefault((hot, pool), deque()).append((next(self._seq), group))
+
+    def first(self, running: Dict[str, int]) -> deque:
+        """Return the deque of the earliest group whose pool is not full, hot ones first,
+        or None"""
+        best, best_rank = None, None
+        for (hot, pool), queue in self._queues.items():
+            if not queue or (pool is not None and running[pool] >= pool_sizes[pool]):
+                continue
+            rank = (not hot, queue[0][0])
+            if best_rank is None or rank < best_rank:
+                best, best_rank = queue, rank
+        return best
+
+
+class _ActionGroups:
+    """Serialize multi-output actions, so that the outputs are produced once per run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = dict()
+        self.done = set()
+
+    def lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def clear(self):
+        self._locks.clear()
+        self.done.clear()
+
+
+_action_groups = _ActionGroups()
 
-    # check weither target exists after build
-    if (not (action and action.is_task)) and should_build(target, howto, always_make=False):
-        log.error('execute.no_result')
-        raise ActionNoResult
 
-    log.info('execute.finish')
+def _begin_run():
+    from plsmake.process import children
+    stat_cache.clear()
+    _action_groups.clear()
+    children.reset()
 
 
-def execute_parallel(target: str, howto: ResolverResults, jobs: int, always_make=False):
+def _newest_depend_mtime(target: str, howto: ResolverResults) -> int:
+    depends, *_ = howto[target]
+    newest = 0
+    for dep in depends:
+        _, _, dep_action, _ = howto[dep]
+        if not (dep_action and dep_action.is_task):
+            newest = max(newest, stat_cache.mtime(dep))
+    return newest
+
+
+def run_target_action(
+        target: str, howto: ResolverResults, always_make=False, cache=None, db=None,
+        remote=None):
+    """Build target if it is out of date.
+    cache: a CacheBackend to restore output from, or None
+    db: a BuildDB to record action durations, or None
+    remote: a WorkerPool to run actions on, or None"""
+    run_targets_action(
+        [target], howto, always_make=always_make, cache=cache, db=db, remote=remote)
+
+
+def run_targets_action(targets: Sequence[str], howto: ResolverResults, always_make=False, **options):
+    """Build targets of a batch action with one call, or build a single target.
+    options are the same as run_target_action()"""
+    _, _, action, action_option = howto[targets[0]]
+    if action is None or len(action.outputs) <= 1:
+        _run_targets_action(targets, howto, always_make=always_make, **options)
+        return
+
+    assert len(targets) == 1
+    key = (id(action), tuple(sorted(action_option.items())))
+    with _action_groups.lock(key):
+        if key in _action_groups.done:
+            always_make = False     # already made with other outputs
+        _run_targets_action(targets, howto, always_make=always_make, **options)
+        _action_groups.done.add(key)
+
+
+def _task_up_to_date(target: str, howto: ResolverResults, db, stamp: str) -> bool:
+    """Whether a task declaring inputs or outputs is skipped, see task_stamp()"""
+    return db.get_stamp(target) == stamp and _task_outputs_exist(target, howto)
+
+
+def _task_outputs_exist(target: str, howto: ResolverResults) -> bool:
+    """Check declared outputs of a task, without stat cache as the task may have made them"""
+    import glob
+    _, _, action, action_option = howto[target]
+    return all(
+        glob.glob(pattern.format_map(action_option), recursive=True)
+        for pattern in action.task_outputs or ())
+
+
+def _run_targets_action(targets, howto, always_make=False, cache=None, db=None, remote=None):
+    jobs = []   # (target, log, cache_key, old_mtime, restored, stamp)
+    for target in targets:
+        log = logger.bind(target=target)
+        log.info('execute.begin')
+        depends, env, action, action_option = howto[target]
+
+        if not should_build(target, howto, always_make=always_make):
+            log.info('execute.finish')
+            output.target_finished(target, False)
+            continue
+
+        if action is None:
+            log.error('execute.no_action')
+            raise NoAction(target)
+
+        stamp = None
+        if action.stamped and db is not None:
+            from plsmake.cache import task_stamp
+            stamp = task_stamp(target, howto, db)
+            if not always_make and _task_up_to_date(target, howto, db, stamp):
+                log.info('execute.task_up_to_date')
+                log.info('execute.finish')
+                output.target_finished(target, False)
+                continue
+
+        old_mtime = None
+        if action.restat and file_exist(target):
+            old_mtime = stat_cache.mtime(target)
+
+        cache_key = None
+        if cache is not None and action.cache and not action.is_task and len(action.outputs) <= 1:
+            from plsmake.cache import action_key
+            cache_key = action_key(target, howto)
+
+        restored = cache_key is not None and cache.fetch(cache_key, target)
+        if restored:
+            log.info('execute.cache_hit', action=func_name(action))
+        jobs.append((target, log, cache_key, old_mtime, restored, stamp))
+
+    to_run = [target for target, _, _, _, restored, _ in jobs if not restored]
+    if to_run:
+        _call_action(to_run, howto, db=db, remote=remote)
+
+    for target, log, cache_key, old_mtime, restored, stamp in jobs:
+        _, _, action, _ = howto[target]
+        if stamp is not None:
+            if not _task_outputs_exist(target, howto):
+                log.error('execute.no_result')
+                raise ActionNoResult(target)
+            db.record_stamp(target, stamp)
+        elif not action.is_task:
+            # only the target is stat'ed again, dependencies are taken from stat cache
+            new_mtime = stat_cache.refresh(target)
+            if old_mtime is not None and new_mtime == old_mtime:
+                log.info('execute.restat_unchanged')
+                stat_cache.set_floor(target, _newest_depend_mtime(target, howto))
+
+            # check weither target exists after build
+            if should_build(target, howto, always_make=False):
+                log.error('execute.no_result')
+                raise ActionNoResult(target)
+
+            if cache_key is not None and not restored:
+                cache.store(cache_key, target)
+
+        log.info('execute.finish')
+        output.target_finished(target, True)
+
+
+def _call_action(targets: Sequence[str], howto: ResolverResults, db=None, remote=None):
+    _, _, action, action_option = howto[targets[0]]
+    if len(targets) == 1:
+        log = logger.bind(target=targets[0])
+    else:
+        log = logger.bind(target=targets[0], batch=list(targets))
+
+    log.info('execute.action', action=func_name(action))
+    start_time = time.monotonic()
+    try:
+        with output.capture(targets[0]):
+            if remote is not None and remote.run_action(targets, howto):
+                log.debug('execute.remote_done')
+            elif action.batch is not None:
+                items = []
+                for target in targets:
+                    depends, env, _, option = howto[target]
+                    items.append(BatchItem(target, env, depends, option))
+                action(items)
+            else:
+                depends, env, _, _ = howto[targets[0]]
+                action(env, depends, **action_option)
+    except Exception:
+        log.exception('execute.exception')
+        if db is not None:
+            for target in targets:
+                db.record_failure(target)
+        raise
+
+    if db is not None:
+        duration = (time.monotonic() - start_time) / len(targets)
+        for target in targets:
+            db.record_duration(target, duration)
+            db.clear_failure(target)
+    if len(action.outputs) > 1:
+        for group_target in action.group_targets(action_option):
+            stat_cache.refresh(group_target)
+
+
+def execute_parallel(target: str, howto: ResolverResults, jobs: int, always_make=False, **options):
+    """options are passed to ParallelExecutor.start()"""
     controller = ParallelExecutor(howto)
     controller.add_target(target)
-    controller.start(jobs, always_make=always_make)
+    controller.start(jobs, always_make=always_make, **options)
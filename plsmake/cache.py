@@ -0,0 +1,395 @@
+import abc
+import errno
+import hashlib
+import os
+import queue
+import shutil
+import stat
+import sys
+import threading
+from typing import Dict, Tuple
+
+from plsmake import logger
+from plsmake.helpers import CACHE_DIR, joinpath
+from plsmake.utils import func_name, update_code_hash
+
+
+CACHE_VERSION = b'plsmake-cache-2'
+DEFAULT_CACHE_DIR = joinpath(CACHE_DIR, 'actions')
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+# variables of the process environment which affect action outputs, other inherited
+# variables (HOME, USER, PATH, CI job ids, ...) are not in cache keys, so that the
+# cache is shared across machines. Variables set by build files are always included.
+CACHE_ENV_INHERITED = {
+    'CC', 'CXX', 'CPP', 'AR', 'AS', 'LD', 'NM', 'RANLIB', 'STRIP', 'OBJCOPY',
+    'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LDLIBS', 'ARFLAGS', 'ASFLAGS',
+    'SOURCE_DATE_EPOCH',
+}
+# inherited variables which differ between shells or runs, they are left out of task
+# stamps. Stamps are local, so other inherited variables are included.
+STAMP_ENV_VOLATILE = {
+    '_', 'PWD', 'OLDPWD', 'SHLVL', 'TERM', 'COLUMNS', 'LINES', 'WINDOWID', 'DISPLAY',
+    'SSH_AUTH_SOCK', 'SSH_AGENT_PID', 'SSH_CLIENT', 'SSH_CONNECTION', 'SSH_TTY',
+    'TMUX', 'TMUX_PANE', 'STY', 'MAKEFLAGS', 'MFLAGS', 'MAKELEVEL',
+}
+
+_FICLONE = 0x40049409   # linux/fs.h
+
+
+def parse_size(string: str) -> int:
+    """Parse size like '100M' or '2G'"""
+    string = string.strip().upper().rstrip('B')
+    units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+    if string and string[-1] in units:
+        return int(float(string[:-1]) * units[string[-1]])
+    return int(string)
+
+
+_hash_memo = dict()     # type: Dict[Tuple[str, int, int], str]
+_hash_memo_lock = threading.Lock()
+
+
+def file_digest(filename: str) -> str:
+    """Return sha256 of file content, memoized by (filename, mtime, size)"""
+    st = os.stat(filename)
+    memo_key = (filename, st.st_mtime_ns, st.st_size)
+    with _hash_memo_lock:
+        digest = _hash_memo.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _hash_memo_lock:
+            _hash_memo[memo_key] = digest
+    return digest
+
+
+def action_key(target: str, howto) -> str:
+    """Return a key of action output that is computed from the action function,
+    the action option, the environment and contents of dependencies. Only variables
+    set by build files and those in CACHE_ENV_INHERITED are taken from the environment."""
+    _, env, _, _ = howto[target]
+    return _action_hash(target, howto, env.changed_keys() | CACHE_ENV_INHERITED).hexdigest()
+
+
+def _action_hash(target: str, howto, env_keys):
+    depends, env, action, action_option = howto[target]
+
+    h = hashlib.sha256(CACHE_VERSION)
+    h.update(repr((target, func_name(action))).encode())
+    update_code_hash(h, action.func.__code__)
+    h.update(repr(sorted(action_option.items())).encode())
+    env_items = sorted((key, repr(env.lookup(key))) for key in env_keys)
+    h.update(repr(env_items).encode())
+
+    for dep in depends:
+        _, _, dep_action, _ = howto[dep]
+        if dep_action is not None and dep_action.is_task:
+            h.update(repr((dep, None)).encode())
+        else:
+            h.update(repr((dep, file_digest(dep))).encode())
+
+    return h
+
+
+def task_stamp(target: str, howto, db) -> str:
+    """Return a stamp of a task declaring inputs or outputs, computed like action_key()
+    but from the whole environment except STAMP_ENV_VOLATILE, and from the declared
+    input files and stamps of task dependencies"""
+    depends, env, action, action_option = howto[target]
+
+    env_keys = set(key for key, _ in env.items()) | env.changed_keys()
+    h = _action_hash(target, howto, env_keys - STAMP_ENV_VOLATILE)
+    for path in action.task_files(action.task_inputs, action_option):
+        h.update(repr((path, file_digest(path))).encode())
+    h.update(repr(action.task_outputs).encode())
+    for dep in depends:
+        _, _, dep_action, _ = howto[dep]
+        if dep_action is not None and dep_action.is_task:
+            h.update(repr((dep, db.get_stamp(dep))).encode())
+    return h.hexdigest()
+
+
+def _clone_file(src: str, dst: str):
+    """Copy file with reflink if supported by filesystem"""
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)
+
+
+class CacheBackend(abc.ABC):
+    """Interface of action caches used by run_target_action()"""
+
+    @abc.abstractmethod
+    def fetch(self, key: str, target: str) -> bool:
+        """Restore target from cache, return False if not found"""
+
+    @abc.abstractmethod
+    def store(self, key: str, target: str):
+        """Save target to cache"""
+
+    def close(self):
+        """Wait for pending operations"""
+        pass
+
+
+class LocalCache(CacheBackend):
+    """A content-addressed store of action outputs.
+
+    Layout: `ac/<key>` contains the digest of output, `cas/<digest>` is the output content.
+    Entries are evicted in least recently used order when the size limit is exceeded.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, hardlink=False):
+        self.root = root
+        self.max_size = max_size
+        self.hardlink = hardlink
+
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _entry_path(self, key: str):
+        return os.path.join(self.root, 'ac', key[:2], key)
+
+    def _object_path(self, digest: str):
+        return os.path.join(self.root, 'cas', digest[:2], digest)
+
+    def fetch(self, key: str, target: str) -> bool:
+        """Restore target from cache, return False if not found"""
+        entry = self._entry_path(key)
+        tmp = target + '.plstmp'
+        try:
+            with open(entry, 'rt') as fp:
+                digest = fp.read().strip()
+            obj = self._object_path(digest)
+
+            if self.hardlink:
+                try:
+                    os.link(obj, tmp)
+                except OSError:
+                    _clone_file(obj, tmp)
+            else:
+                _clone_file(obj, tmp)
+            os.utime(tmp)
+            os.replace(tmp, target)
+        except FileNotFoundError:
+            self._remove_tmp(tmp)
+            return False
+        except OSError as exc:
+            # e.g. permission, disk full or cross-device, the action is run instead
+            logger.warning('cache.local_error', target=target, key=key, error=str(exc))
+            self._remove_tmp(tmp)
+            return False
+
+        try:
+            os.utime(entry)     # mark as recently used
+        except OSError:
+            pass    # evicted meanwhile, the target is restored anyway
+        logger.debug('cache.hit', target=target, key=key)
+        return True
+
+    @staticmethod
+    def _remove_tmp(tmp: str):
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+
+    def store(self, key: str, target: str):
+        digest = file_digest(target)
+        obj = self._object_path(digest)
+        added = 0
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            tmp = '%s.%d.%d.tmp' % (obj, os.getpid(), threading.get_ident())
+            _clone_file(target, tmp)
+            # objects may be hardlinked to targets, protect them from writing
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp, obj)
+            added = os.path.getsize(obj)
+
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.get_ident())
+        with open(tmp, 'wt') as fp:
+            fp.write(digest + '\n')
+        os.replace(tmp, entry)
+        logger.debug('cache.store', target=target, key=key, digest=digest)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += added
+            if self._size > self.max_size:
+                self._evict()
+
+    def _walk(self, subdir):
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, subdir)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def _scan_size(self):
+        return sum(st.st_size for _, st in self._walk('cas'))
+
+    def _evict(self):
+        """Remove least recently used entries until size is under 90% of limit"""
+        entries = sorted(self._walk('ac'), key=lambda item: item[1].st_mtime_ns)
+        objects = dict((os.path.basename(path), st.st_size) for path, st in self._walk('cas'))
+        size = sum(objects.values())
+        low_mark = self.max_size * 0.9
+
+        for entry, _ in entries:
+            if size <= low_mark:
+                break
+            try:
+                with open(entry, 'rt') as fp:
+                    digest = fp.read().strip()
+                os.remove(entry)
+            except FileNotFoundError:
+                continue
+            if digest in objects:
+                try:
+                    os.remove(self._object_path(digest))
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+                size -= objects.pop(digest)
+
+        logger.info('cache.evict', size=size, max_size=self.max_size)
+        self._size = size
+
+
+class HttpCache(CacheBackend):
+    """A remote cache with a simple protocol: `GET <url>/<key>` returns the output
+    or 404, `PUT <url>/<key>` saves the output. Uploads are done in background."""
+
+    def __init__(self, url: str, max_connections=8, timeout=30):
+        from urllib.parse import urlsplit
+        parsed = urlsplit(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ValueError('unsupported cache url: %s' % (url,))
+
+        self.url = url
+        self.timeout = timeout
+        self._scheme = parsed.scheme
+        self._netloc = parsed.netloc
+        self._path = parsed.path.rstrip('/')
+
+        self._connections = queue.LifoQueue(maxsize=max_connections)
+        import concurrent.futures as cf
+        self._uploader = cf.ThreadPoolExecutor(max_workers=max_connections)
+
+    def _new_connection(self):
+        import http.client
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self._netloc, timeout=self.timeout)
+
+    def _request(self, method: str, key: str, body=None):
+        """Return (status, body), connections are reused"""
+        import http.client
+        try:
+            conn = self._connections.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._new_connection()
+            reused = False
+
+        while True:
+            try:
+                conn.request(method, '%s/%s' % (self._path, key), body=body)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # the server may have closed an idle connection, GET and PUT can be retried
+                logger.debug('cache.remote_reconnect', url=self.url)
+                conn = self._new_connection()
+                reused = False
+            except Exception:
+                conn.close()
+                raise
+
+        try:
+            self._connections.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        return resp.status, data
+
+    def fetch(self, key: str, target: str) -> bool:
+        import http.client
+        try:
+            status, data = self._request('GET', key)
+        except (OSError, ValueError, http.client.HTTPException) as exc:
+            logger.warning('cache.remote_error', url=self.url, key=key, error=str(exc))
+            return False
+        if status != 200:
+            if status != 404:
+                logger.warning('cache.remote_error', url=self.url, key=key, status=status)
+            return False
+
+        tmp = target + '.plstmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, target)
+        logger.debug('cache.remote_hit', target=target, key=key)
+        return True
+
+    def _upload(self, key: str, data: bytes):
+        import http.client
+        try:
+            status, _ = self._request('PUT', key, body=data)
+        except (OSError, ValueError, http.client.HTTPException) as exc:
+            logger.warning('cache.remote_error', url=self.url, key=key, error=str(exc))
+            return
+        if status not in (200, 201, 204):
+            logger.warning('cache.remote_error', url=self.url, key=key, status=status)
+
+    def store(self, key: str, target: str):
+        with open(target, 'rb') as fp:
+            data = fp.read()
+        self._uploader.submit(self._upload, key, data)
+
+    def close(self):
+        self._uploader.shutdown(wait=True)
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+class TieredCache(CacheBackend):
+    """Look up caches in order, outputs found in later caches are saved to earlier ones"""
+
+    def __init__(self, *backends: CacheBackend):
+        self.backends = backends
+
+    def fetch(self, key: str, target: str) -> bool:
+        for i, backend in enumerate(self.backends):
+            if backend.fetch(key, target):
+                for prev in self.backends[:i]:
+                    prev.store(key, target)
+                return True
+        return False
+
+    def store(self, key: str, target: str):
+        for backend in self.backends:
+            backend.store(key, target)
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
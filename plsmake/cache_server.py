@@ -0,0 +1,106 @@
+"""A reference server of HttpCache for testing. Usage:
+
+    python -m plsmake.cache_server --port 8080 --root /tmp/plscache
+"""
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import os
+import re
+from socketserver import ThreadingMixIn
+import threading
+
+from plsmake.helpers import CACHE_DIR, joinpath
+
+
+_KEY_RE = re.compile(r'^/(?:.*/)?([0-9a-f]{16,128})$')
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+
+    def _key_path(self):
+        matched = _KEY_RE.match(self.path)
+        if not matched:
+            self.send_error(400, 'bad key')
+            return None
+        key = matched.group(1)
+        return os.path.join(self.server.root, key[:2], key)
+
+    def _send(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = self._key_path()
+        if path is None:
+            return
+        try:
+            with open(path, 'rb') as fp:
+                body = fp.read()
+        except FileNotFoundError:
+            self._send(404)
+        else:
+            self._send(200, body)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        path = self._key_path()
+        if path is None:
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as fp:
+            fp.write(body)
+        os.replace(tmp, path)
+        self._send(201)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root: str, host='127.0.0.1', port=0, quiet=False):
+        self.root = root
+        self.quiet = quiet
+        super().__init__((host, port), CacheRequestHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen')
+    parser.add_argument('--root', default=joinpath(CACHE_DIR, 'server'), help='storage directory')
+    option = parser.parse_args()
+
+    server = CacheServer(option.root, host=option.host, port=option.port)
+    print('serving cache at', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from plsmake import logger
+from plsmake.fs import CACHE_DIR
+
+
+DB_FILE = os.path.join(CACHE_DIR, 'build.json')
+DB_VERSION = 1
+
+
+class BuildDB:
+    """Persistent information of previous builds, stored as json."""
+
+    def __init__(self, filename=DB_FILE):
+        self.filename = filename
+        self.durations = dict()     # target -> seconds of the last action run
+        self.restat = dict()        # target -> mtime_ns, see StatCache.floors
+        self.failures = dict()      # target -> time of the last failed action run
+        self.stamps = dict()        # task -> stamp of the last successful run, see task_stamp()
+        self.last_run = None        # start time of the last build in ns
+        self._lock = threading.Lock()
+
+    def load(self) -> 'BuildDB':
+        try:
+            with open(self.filename, 'rt', encoding='utf8') as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return self
+        except ValueError:
+            logger.warning('db.corrupted', file=self.filename)
+            return self
+
+        if data.get('version') != DB_VERSION:
+            logger.info('db.version_mismatch', file=self.filename)
+            return self
+        self.durations.update(data.get('durations', {}))
+        self.restat.update(data.get('restat', {}))
+        self.failures.update(data.get('failures', {}))
+        self.stamps.update(data.get('stamps', {}))
+        self.last_run = data.get('last_run')
+        return self
+
+    def save(self):
+        with self._lock:
+            data = dict(
+                version=DB_VERSION, durations=self.durations, restat=self.restat,
+                failures=self.failures, stamps=self.stamps, last_run=self.last_run,
+            )
+            string = json.dumps(data, sort_keys=True)
+
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'wt', encoding='utf8') as fp:
+            fp.write(string)
+        os.replace(tmp, self.filename)
+
+    def record_duration(self, target: str, seconds: float):
+        with self._lock:
+            self.durations[target] = seconds
+
+    def get_duration(self, target: str) -> Optional[float]:
+        return self.durations.get(target)
+
+    def record_failure(self, target: str):
+        with self._lock:
+            self.failures[target] = time.time()
+            self.stamps.pop(target, None)
+
+    def clear_failure(self, target: str):
+        with self._lock:
+            self.failures.pop(target, None)
+
+    def get_stamp(self, target: str) -> Optional[str]:
+        return self.stamps.get(target)
+
+    def record_stamp(self, target: str, stamp: str):
+        with self._lock:
+            self.stamps[target] = stamp
@@ -1,6 +1,14 @@
 from collections import abc
 
 
+class _Missing:
+    def __repr__(self):
+        return '<missing>'
+
+
+_MISSING = _Missing()
+
+
 class Env:
     def __init__(self, init_dict=None):
         self._local = dict()
@@ -8,12 +16,15 @@ class Env:
             self._local.update(init_dict)
         self._removed = set()
         self.parent = None
+        self._reads = None
 
     def __setitem__(self, key, value):
         self._local[key] = value
         self._removed.discard(key)
 
     def __getitem__(self, key):
+        if self._reads is not None:
+            self._record_read(key)
         if key in self._removed:
             raise KeyError(key)
 
@@ -44,8 +55,58 @@ class Env:
         except KeyError:
             return default
 
+    def lookup(self, key, default=None):
+        """Get value without recording or copying mutable data from parent."""
+        env = self
+        while env is not None:
+            if key in env._removed:
+                return default
+            if key in env._local:
+                return env._local[key]
+            env = env.parent
+        return default
+
+    def _record_read(self, key):
+        if key in self._reads or key in self._local or key in self._removed:
+            return      # values set by self are not inputs
+        if self.parent is None:
+            self._reads[key] = repr(None)
+        else:
+            self._reads[key] = repr(self.parent.lookup(key, _MISSING))
+
+    def changed_keys(self) -> set:
+        """Return keys set or removed by self and its ancestors, except the root
+        environment, which is usually made from the process environment"""
+        keys = set()
+        env = self
+        while env is not None and env.parent is not None:
+            keys.update(env._local)
+            keys.update(env._removed)
+            env = env.parent
+        return keys
+
+    def local_state(self):
+        """Return (local dict, removed keys), see set_local_state()"""
+        return self._local.copy(), self._removed.copy()
+
+    def set_local_state(self, local, removed):
+        self._local.update(local)
+        self._removed.update(removed)
+
+    def track_reads(self):
+        """Start recording keys read from parent and their values"""
+        self._reads = dict()
+
+    def stop_tracking(self) -> dict:
+        """Return key -> repr of value read from parent, None key means all items are read"""
+        reads, self._reads = self._reads, None
+        return reads
+
     def items(self):
         """Return items from local and parent."""
+        if self._reads is not None and None not in self._reads:
+            parent_items = self.parent.items() if self.parent is not None else []
+            self._reads[None] = repr(sorted(parent_items))
         yield from self._local.items()
         if self.parent is not None:
             for key, value in self.parent.items():
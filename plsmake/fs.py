@@ -0,0 +1,161 @@
+from fnmatch import fnmatchcase
+import os
+import stat
+from typing import Dict, List, Optional, Set, Tuple
+
+
+CACHE_DIR = '.plscache'
+
+_MAGIC_CHARS = set('*?[')
+
+
+class StatCache:
+    """Cache of file stat results during a build.
+
+    Files are stat'ed at most once unless refresh() is called, which is done
+    after an action writes its target. `floors` holds the restat records:
+    target -> the newest dependency mtime when an action left target unchanged.
+
+    Directory listings are cached as well, and the stat results of listed entries
+    are kept, so that resolvers globbing sources save the stat calls of the build.
+    """
+
+    def __init__(self):
+        self._stats = dict()    # type: Dict[str, Optional[Tuple[int, bool]]]
+        self._dirs = dict()     # type: Dict[str, List[Tuple[str, bool]]]
+        self._primed = set()    # type: Set[str]
+        self.floors = dict()    # type: Dict[str, int]
+
+    def _stat(self, path: str):
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            result = None
+        else:
+            result = st.st_mtime_ns, stat.S_ISREG(st.st_mode)
+        self._stats[path] = result
+        return result
+
+    def _get(self, path: str):
+        try:
+            return self._stats[path]
+        except KeyError:
+            return self._stat(path)
+
+    def mtime(self, path: str) -> int:
+        result = self._get(path)
+        if result is None:
+            raise FileNotFoundError(path)
+        return result[0]
+
+    def output_mtime(self, path: str) -> int:
+        """Return mtime of target considering restat record"""
+        return max(self.mtime(path), self.floors.get(path, 0))
+
+    def is_file(self, path: str) -> bool:
+        result = self._get(path)
+        return result is not None and result[1]
+
+    def refresh(self, path: str) -> Optional[int]:
+        """Stat path again, return mtime or None"""
+        result = self._stat(path)
+        return result and result[0]
+
+    def scandir(self, path: str) -> List[Tuple[str, bool]]:
+        """Return sorted (name, is_dir) of entries in directory, [] if it does not exist"""
+        try:
+            return self._dirs[path]
+        except KeyError:
+            pass
+
+        entries = []
+        try:
+            it = os.scandir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            it = None
+        if it is not None:
+            try:
+                for entry in it:
+                    entry_path = entry.name if path == '.' else os.path.join(path, entry.name)
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        result = None
+                    else:
+                        result = st.st_mtime_ns, stat.S_ISREG(st.st_mode)
+                    self._stats[entry_path] = result
+                    self._primed.add(entry_path)
+                    entries.append((entry.name, entry.is_dir()))
+            finally:
+                # the iterator is a context manager since 3.6
+                if hasattr(it, 'close'):
+                    it.close()
+        entries.sort()
+        self._dirs[path] = entries
+        return entries
+
+    def glob(self, pattern: str, listed: List[str] = None) -> List[str]:
+        """Like glob.glob(pattern, recursive=True) using cached listings,
+        listed directories are appended to `listed`"""
+        if listed is None:
+            listed = []
+        parts = pattern.replace('\\', '/').split('/')
+        if parts[0] == '':
+            paths = ['/']
+            parts.pop(0)
+        else:
+            paths = ['']
+
+        def list_dir(path):
+            path = path or '.'
+            listed.append(path)
+            return self.scandir(path)
+
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            matched = []
+            if part == '**':
+                stack = list(reversed(paths))
+                while stack:
+                    path = stack.pop()
+                    matched.append(path)
+                    subdirs = []
+                    for name, is_dir in list_dir(path):
+                        if name.startswith('.'):
+                            continue
+                        if is_dir:
+                            subdirs.append(os.path.join(path, name))
+                        elif last:
+                            matched.append(os.path.join(path, name))
+                    stack.extend(reversed(subdirs))
+            elif _MAGIC_CHARS.isdisjoint(part):
+                matched = [os.path.join(path, part) for path in paths]
+                if last:
+                    matched = [path for path in matched if self._get(path) is not None]
+            else:
+                for path in paths:
+                    for name, is_dir in list_dir(path):
+                        if name.startswith('.') and not part.startswith('.'):
+                            continue
+                        if (last or is_dir) and fnmatchcase(name, part):
+                            matched.append(os.path.join(path, name))
+            paths = matched
+
+        return sorted(set(path for path in paths if path))
+
+    def set_floor(self, path: str, mtime: int):
+        self.floors[path] = mtime
+
+    def use_floors(self, floors: Dict[str, int]):
+        """Share restat records with a persistent storage"""
+        self.floors = floors
+
+    def clear(self):
+        """Forget stat results, restat records are kept.
+        Stat results of entries listed since the last clear() survive once, so
+        the listings done while resolving are used by the following build."""
+        kept = dict((path, self._stats[path]) for path in self._primed if path in self._stats)
+        self._stats.clear()
+        self._stats.update(kept)
+        self._dirs.clear()
+        self._primed.clear()
@@ -1,15 +1,16 @@
 import os
-from typing import Optional, Sequence
+import threading
+from typing import Dict, Optional, Sequence
 
 from plsmake import logger
 from plsmake.api import run_with_output
+from plsmake.fs import CACHE_DIR
 
 
 SOURCE_SUFFIX = [
     '.c', '.cc', '.cpp', '.cxx', '.c++',
     '.h', '.hh', '.hpp', '.hxx',
 ]
-CACHE_DIR = '.plscache'
 
 
 def is_source(filename: str):
@@ -39,6 +40,18 @@ def get_deps_with_cxx(env, sourcefile: str) -> Sequence[str]:
     return [normpath(dep) for dep in depends]
 
 
+def get_deps_uncached(env, sourcefile: str) -> Sequence[str]:
+    """Use the built-in include scanner if env['DEPS_SCANNER'] == 'builtin',
+    fallback to the compiler if the scanner can not handle the source"""
+    if env.get('DEPS_SCANNER') == 'builtin':
+        from plsmake.scan import scan_includes
+        depends = scan_includes(sourcefile, env['CXXFLAGS'])
+        if depends is not None:
+            return depends
+        logger.debug('get_deps.scanner_fallback', source=sourcefile)
+    return get_deps_with_cxx(env, sourcefile)
+
+
 def get_deps_cache_filename(sourcefile: str):
     return joinpath(CACHE_DIR, sourcefile) + '.deps'
 
@@ -73,27 +86,70 @@ def get_deps_with_cache(env, sourcefile: str) -> Optional[Sequence[str]]:
 def set_deps_cache(env, sourcefile: str, depends: Sequence[str]):
     cache_file = get_deps_cache_filename(sourcefile)
     logger.debug('get_deps.set_cache', cache_file=cache_file)
-    with open(cache_file, 'wt+', newline='\n', encoding='utf8') as fp:
+    # write and rename, concurrent runs sharing the cache never see partial files
+    tmp = '%s.%d.%d.tmp' % (cache_file, os.getpid(), threading.get_ident())
+    with open(tmp, 'wt+', newline='\n', encoding='utf8') as fp:
         fp.write('\n'.join(depends) + '\n')
+    os.replace(tmp, cache_file)
 
 
 def get_deps(env, sourcefile: str) -> Sequence[str]:
+    from plsmake.app import record_input
     depends = get_deps_with_cache(env, sourcefile)
     if depends is None:
-        depends = get_deps_with_cxx(env, sourcefile)
+        depends = get_deps_uncached(env, sourcefile)
         set_deps_cache(env, sourcefile, depends)
         cache_hit = False
     else:
         cache_hit = True
 
     logger.debug('get_deps.result', depends=depends, cache_hit=cache_hit)
+    for dep in [sourcefile] + list(depends):
+        record_input(dep)
     return depends
 
 
-def extend_depends_by_compiler(env, depends):
+def get_deps_many(env, sourcefiles: Sequence[str], jobs=None) -> Dict[str, Sequence[str]]:
+    """Like get_deps() for many sources, cache misses are computed by up to
+    `jobs` (default: number of CPUs) concurrent compiler processes"""
+    from plsmake.app import record_input
+    result = dict()
+    misses = []
+    for sourcefile in sourcefiles:
+        depends = get_deps_with_cache(env, sourcefile)
+        if depends is None:
+            misses.append(sourcefile)
+        else:
+            result[sourcefile] = depends
+
+    logger.debug('get_deps_many.begin', total=len(sourcefiles), misses=len(misses))
+    if len(misses) == 1:
+        result[misses[0]] = get_deps_uncached(env, misses[0])
+        set_deps_cache(env, misses[0], result[misses[0]])
+    elif misses:
+        import concurrent.futures as cf
+        jobs = min(jobs or os.cpu_count() or 1, len(misses))
+
+        def work(sourcefile):
+            depends = get_deps_uncached(env, sourcefile)
+            set_deps_cache(env, sourcefile, depends)
+            return depends
+
+        with cf.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for sourcefile, depends in zip(misses, pool.map(work, misses)):
+                result[sourcefile] = depends
+
+    for sourcefile in sourcefiles:
+        for dep in [sourcefile] + list(result[sourcefile]):
+            record_input(dep)
+    return result
+
+
+def extend_depends_by_compiler(env, depends, jobs=None):
     srcs = [dep for dep in depends if is_source(dep)]
+    all_deps = get_deps_many(env, srcs, jobs=jobs)
     for sourcefile in srcs:
-        extra_deps = get_deps(env, sourcefile)
+        extra_deps = all_deps[sourcefile]
         for dep in extra_deps:
             if dep not in depends:
                 depends.append(dep)
@@ -0,0 +1,113 @@
+"""Reuse resolver results of previous runs.
+
+While a resolver runs, its inputs are recorded: the matched rules and params,
+the code of resolvers, the Env keys read from parent environments, and the
+files passed to record_input() (helpers and glob functions do this). A later
+resolve() re-runs resolvers of a target only if any of these changed.
+Inputs that are not recorded, like files opened directly or global variables
+of the build file, are not tracked.
+"""
+from collections import namedtuple
+import os
+import pickle
+from typing import Dict, Optional
+
+from plsmake import logger
+from plsmake.fs import CACHE_DIR
+
+
+RESOLVE_CACHE_FILE = os.path.join(CACHE_DIR, 'resolve.pickle')
+RESOLVE_CACHE_VERSION = 1
+
+# env_state is the pickled Env.local_state(), so that replayed values are fresh copies
+ResolveRecord = namedtuple(
+    'ResolveRecord', ['signature', 'env_reads', 'files', 'depends', 'env_state'])
+
+
+def input_stamp(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ResolveMemo:
+    def __init__(self, filename=RESOLVE_CACHE_FILE):
+        self.filename = filename
+        self.records = dict()   # type: Dict[str, ResolveRecord]
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+
+    def load(self) -> 'ResolveMemo':
+        try:
+            with open(self.filename, 'rb') as fp:
+                version, records = pickle.load(fp)
+        except FileNotFoundError:
+            return self
+        except Exception:
+            logger.warning('resolve_memo.corrupted', file=self.filename)
+            return self
+
+        if version == RESOLVE_CACHE_VERSION:
+            self.records = records
+        return self
+
+    def save(self):
+        if not self._dirty:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'wb') as fp:
+            pickle.dump((RESOLVE_CACHE_VERSION, self.records), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.filename)
+        self._dirty = False
+
+    def lookup(self, target: str, signature, env) -> Optional[ResolveRecord]:
+        """Return the record if all recorded inputs are unchanged"""
+        record = self.records.get(target)
+        if record is None or record.signature != signature:
+            self.misses += 1
+            return None
+
+        for key, value in record.env_reads.items():
+            if key is None:
+                parent_items = env.parent.items() if env.parent is not None else []
+                current = repr(sorted(parent_items))
+            else:
+                current = repr(env.lookup(key, _missing()))
+            if current != value:
+                logger.debug('resolve_memo.env_changed', target=target, key=key)
+                self.misses += 1
+                return None
+
+        for path, stamp in record.files.items():
+            if input_stamp(path) != stamp:
+                logger.debug('resolve_memo.file_changed', target=target, file=path)
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        return record
+
+    def store(self, target: str, signature, env_reads, files, depends, env):
+        try:
+            env_state = pickle.dumps(env.local_state(), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug('resolve_memo.unpicklable', target=target)
+            self.records.pop(target, None)
+            return
+        self.records[target] = ResolveRecord(signature, env_reads, files, list(depends), env_state)
+        self._dirty = True
+
+    @staticmethod
+    def replay(record: ResolveRecord, depends, env):
+        depends.extend(record.depends)
+        env.set_local_state(*pickle.loads(record.env_state))
+
+
+def _missing():
+    from plsmake.env import _MISSING
+    return _MISSING
@@ -0,0 +1,151 @@
+"""GNU make jobserver support.
+
+Under `make -j`, MAKEFLAGS carries `--jobserver-auth=R,W` (inherited pipe fds) or
+`--jobserver-auth=fifo:PATH`. A job beyond the first one needs a token read from
+it, and the token is written back when the job finishes. When plsmake is the top
+level with -j N, it creates a pipe with N - 1 tokens, uses it for its own jobs and
+exports it to commands run by api.run(), so sub-makes share the same budget.
+"""
+import os
+import re
+import threading
+from typing import List, Optional
+
+from plsmake import logger
+
+
+_AUTH_RE = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+
+client = None   # type: Optional[JobServerClient]
+
+
+def parse_makeflags(makeflags: str) -> Optional[str]:
+    """Return the value of the last --jobserver-auth option, or None"""
+    found = _AUTH_RE.findall(makeflags or '')
+    return found[-1] if found else None
+
+
+class JobServerClient:
+    def __init__(self, read_fd: int, write_fd: int):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self._held = []     # type: List[bytes]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_auth(cls, auth: str) -> 'JobServerClient':
+        if auth.startswith('fifo:'):
+            path = auth[len('fifo:'):]
+            # our own open file descriptions, so O_NONBLOCK does not affect others
+            return cls(
+                os.open(path, os.O_RDONLY | os.O_NONBLOCK), os.open(path, os.O_WRONLY))
+
+        read_fd, write_fd = (int(fd) for fd in auth.split(','))
+        os.fstat(read_fd)   # raise if make did not pass fds to us
+        os.fstat(write_fd)
+        try:
+            # a new open file description of the pipe, which can be made non-blocking
+            read_fd = os.open('/proc/self/fd/%d' % (read_fd,), os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            pass
+        return cls(read_fd, write_fd)
+
+    def try_acquire(self) -> bool:
+        """Take a token without blocking, return whether one is taken"""
+        import select
+        try:
+            readable, _, _ = select.select([self.read_fd], [], [], 0)
+            if not readable:
+                return False
+            token = os.read(self.read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not token:
+            return False
+        with self._lock:
+            self._held.append(token)
+        return True
+
+    def release(self):
+        with self._lock:
+            token = self._held.pop()
+        os.write(self.write_fd, token)
+
+    @property
+    def held(self) -> int:
+        return len(self._held)
+
+
+class JobSlots:
+    """Slots of a group of concurrent jobs, e.g. of ParallelExecutor or run_many().
+    The first job uses the slot of the caller, others take tokens of the jobserver.
+    Without a jobserver, the number of jobs is only limited by the caller."""
+
+    def __init__(self, client: Optional[JobServerClient]):
+        self.client = client
+        self.borrowed = 0
+
+    def acquire(self, running: int) -> bool:
+        """Return whether a job can start while `running` jobs are running"""
+        if running == 0 or self.client is None:
+            return True
+        if self.client.try_acquire():
+            self.borrowed += 1
+            return True
+        return False
+
+    def fit(self, running: int):
+        """Return tokens not needed by `running` jobs"""
+        while self.borrowed > max(running - 1, 0):
+            self.client.release()
+            self.borrowed -= 1
+
+
+class JobServer(JobServerClient):
+    """A token pool of `jobs` slots, the caller has the implicit one"""
+
+    def __init__(self, jobs: int):
+        read_fd, write_fd = os.pipe()
+        super().__init__(read_fd, write_fd)
+        self.jobs = jobs
+        os.write(write_fd, b'+' * (jobs - 1))
+        os.set_blocking(read_fd, False)
+
+    def export(self):
+        """Pass the pool to commands through MAKEFLAGS"""
+        from plsmake import process
+        # sub-makes read tokens blocking, give them a blocking file description
+        read_fd = os.open('/proc/self/fd/%d' % (self.read_fd,), os.O_RDONLY) \
+            if os.path.exists('/proc/self/fd') else self.read_fd
+        process.inherited_fds = (read_fd, self.write_fd)
+        flags = os.environ.get('MAKEFLAGS', '')
+        flags = _AUTH_RE.sub('', re.sub(r'(^|\s)-j\d*', ' ', flags)).strip()
+        os.environ['MAKEFLAGS'] = ' '.join(filter(None, [
+            flags, '-j%d' % (self.jobs,), '--jobserver-auth=%d,%d' % (read_fd, self.write_fd),
+        ]))
+
+
+def setup(jobs: Optional[int]) -> Optional[JobServerClient]:
+    """Join the jobserver of parent make, or serve `jobs` slots if given.
+    The result is also stored in `client`, which ParallelExecutor uses."""
+    global client
+    auth = parse_makeflags(os.environ.get('MAKEFLAGS'))
+    if auth is not None:
+        try:
+            client = JobServerClient.from_auth(auth)
+        except (OSError, ValueError):
+            logger.warning('jobserver.unavailable', auth=auth)
+        else:
+            if not auth.startswith('fifo:'):
+                from plsmake import process
+                # MAKEFLAGS is passed on as is, keep the fds it names open in commands
+                process.inherited_fds = tuple(int(fd) for fd in auth.split(','))
+            logger.info('jobserver.client', auth=auth)
+            return client
+
+    if jobs is not None and jobs > 1 and os.name == 'posix':
+        server = JobServer(jobs)
+        server.export()
+        logger.info('jobserver.server', jobs=jobs, makeflags=os.environ['MAKEFLAGS'])
+        client = server
+    return client
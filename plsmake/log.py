@@ -1,24 +1,28 @@
-import json
-import logging
+import atexit
+from collections import deque
 import sys
+import threading
 import time
-import traceback
 
-from structlog import configure, DropEvent
-from structlog.stdlib import add_log_level
-from structlog.processors import format_exc_info, StackInfoRenderer
+# structlog, json and traceback are imported when needed to keep startup fast
 
+CRITICAL = 50
+ERROR = 40
+WARNING = 30
+INFO = 20
+DEBUG = 10
+NOTSET = 0
 
 # from: structlog/stdlib.py
 _NAME_TO_LEVEL = {
-    'critical': logging.CRITICAL,
-    'exception': logging.ERROR,
-    'error': logging.ERROR,
-    'warn': logging.WARNING,
-    'warning': logging.WARNING,
-    'info': logging.INFO,
-    'debug': logging.DEBUG,
-    'notset': logging.NOTSET,
+    'critical': CRITICAL,
+    'exception': ERROR,
+    'error': ERROR,
+    'warn': WARNING,
+    'warning': WARNING,
+    'info': INFO,
+    'debug': DEBUG,
+    'notset': NOTSET,
 }
 
 _LEVEL_TO_NAME = dict(
@@ -27,6 +31,64 @@ _LEVEL_TO_NAME = dict(
 )
 
 
+_min_level = None       # events below the level are dropped before reaching structlog
+_echo_commands = True   # whether run_cmd events are shown regardless of level
+_pending_config = None  # function returning processors, applied on first use of structlog
+
+
+def _import_structlog():
+    global _pending_config
+    import structlog
+    if _pending_config is not None:
+        structlog.configure(processors=_pending_config())
+        _pending_config = None
+    return structlog
+
+
+class LazyLogger:
+    """A logger which imports structlog on first use. When there is no log file,
+    events below the level set by config_logger() never reach structlog."""
+
+    def __init__(self, name: str, context=None):
+        self._name = name
+        self._context = context or dict()
+
+    def bind(self, **kwargs) -> 'LazyLogger':
+        context = self._context.copy()
+        context.update(kwargs)
+        return LazyLogger(self._name, context)
+
+    def _log(self, method: str, event: str, **kwargs):
+        if _min_level is not None and _NAME_TO_LEVEL[method] < _min_level:
+            if not (event == 'run_cmd' and _echo_commands):
+                return
+
+        logger = _import_structlog().get_logger(self._name)
+        if self._context:
+            logger = logger.bind(**self._context)
+        return getattr(logger, method)(event, **kwargs)
+
+    def debug(self, event, **kwargs):
+        return self._log('debug', event, **kwargs)
+
+    def info(self, event, **kwargs):
+        return self._log('info', event, **kwargs)
+
+    def warning(self, event, **kwargs):
+        return self._log('warning', event, **kwargs)
+
+    warn = warning
+
+    def error(self, event, **kwargs):
+        return self._log('error', event, **kwargs)
+
+    def exception(self, event, **kwargs):
+        return self._log('exception', event, **kwargs)
+
+    def critical(self, event, **kwargs):
+        return self._log('critical', event, **kwargs)
+
+
 def add_timestamp(logger, name, event_dict):
     event_dict['timestamp'] = time.time()
     return event_dict
@@ -47,23 +109,108 @@ class LogDispatcher:
             try:
                 handler(logger, name, event_dict)
             except Exception:
+                import traceback
                 print('exception thrown by hander %r' % (handler,), file=sys.stderr)
                 traceback.print_exc()
 
         return event_dict
 
 
-class LogWriter:
-    def __init__(self, filename):
+LOG_FORMATS = ('json', 'ndjson-interned')
+
+
+class AsyncLogWriter:
+    """Write log events in batches from a background thread.
+
+    Logging threads only append events to a deque, which is thread-safe without
+    locking. Formats:
+        json: one json object per line
+        ndjson-interned: keys are replaced by integers, a line of `["$key", id, name]`
+            is written before the first use of a key, events are `[id, value, id, value...]`
+    """
+
+    def __init__(self, filename, fmt='json', flush_interval=0.2, batch_size=1024):
+        if fmt not in LOG_FORMATS:
+            raise ValueError('unknown log format: %s' % (fmt,))
         self.filename = filename
+        self.format = fmt
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
         self._fp = open(self.filename, 'at')
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._keys = dict()
+        self._thread = threading.Thread(target=self._run, name='plsmake-log', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
 
     def __call__(self, logger, name, event_dict):
-        string = json.dumps(event_dict, default=_json_fallback)
-        self._fp.write(string + '\n')
+        if not self._closed:
+            self._queue.append(event_dict.copy())
+            if len(self._queue) >= self.batch_size:
+                self._wakeup.set()
+
+    def _encode(self, event_dict, lines):
+        import json
+        if self.format == 'json':
+            lines.append(json.dumps(event_dict, default=_json_fallback))
+            return
+
+        record = []
+        for key, value in event_dict.items():
+            key_id = self._keys.get(key)
+            if key_id is None:
+                key_id = self._keys[key] = len(self._keys)
+                lines.append(json.dumps(['$key', key_id, key]))
+            record.append(key_id)
+            record.append(value)
+        lines.append(json.dumps(record, default=_json_fallback))
+
+    def _drain(self):
+        lines = []
+        while True:
+            try:
+                event_dict = self._queue.popleft()
+            except IndexError:
+                break
+            self._encode(event_dict, lines)
+
+        if lines:
+            self._fp.write('\n'.join(lines) + '\n')
+            self._fp.flush()
 
-    def __del__(self):
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._drain()
         self._fp.close()
+        atexit.unregister(self.close)
+
+
+def read_log(filename):
+    """Yield event dicts from a log file of any format"""
+    import json
+    keys = dict()
+    with open(filename, 'rt') as fp:
+        for line in fp:
+            data = json.loads(line)
+            if isinstance(data, dict):
+                yield data
+            elif data and data[0] == '$key':
+                keys[data[1]] = data[2]
+            else:
+                yield dict((keys[key_id], value) for key_id, value in zip(data[::2], data[1::2]))
 
 
 # from structlog/processors.py
@@ -81,12 +228,15 @@ def _json_fallback(obj):
 
 
 class LogRenderer:
-    def __init__(self, level=logging.INFO):
+    def __init__(self, level=INFO, echo_commands=True):
         self.level = level
+        self.echo_commands = echo_commands
 
     def __call__(self, logger, name: str, event_dict):
         if _NAME_TO_LEVEL[name] < self.level:       # filter by level
-            if event_dict['event'] != 'run_cmd':    # run_cmd is shown anyway
+            # run_cmd is shown anyway unless disabled
+            if not (event_dict['event'] == 'run_cmd' and self.echo_commands):
+                from structlog import DropEvent
                 raise DropEvent
 
         event = event_dict['event']
@@ -105,23 +255,43 @@ class LogRenderer:
 _LOG_DISPATCHER = LogDispatcher()
 
 
-def config_logger(verbose=0, logfile=None):
+def config_logger(verbose=0, logfile=None, log_format='json', echo_commands=True):
+    """echo_commands: show commands run by actions regardless of verbosity"""
+    global _min_level, _pending_config, _echo_commands
     if verbose >= 2:
-        level = logging.DEBUG
+        level = DEBUG
     elif verbose >= 1:
-        level = logging.INFO
+        level = INFO
     else:
-        level = logging.WARNING
+        level = WARNING
 
+    _echo_commands = echo_commands
     if logfile is not None:
-        _LOG_DISPATCHER.add_handler(LogWriter(logfile))
-
-    processors = [
-        add_log_level,
-        add_timestamp,
-        format_exc_info,
-        StackInfoRenderer(),
-        _LOG_DISPATCHER,
-        LogRenderer(level=level),
-    ]
-    configure(processors=processors)
+        _LOG_DISPATCHER.add_handler(AsyncLogWriter(logfile, fmt=log_format))
+        _min_level = None   # log file receives all events
+    else:
+        _min_level = level
+
+    def processors():
+        from structlog.stdlib import add_log_level
+        from structlog.processors import format_exc_info, StackInfoRenderer
+        return [
+            add_log_level,
+            add_timestamp,
+            format_exc_info,
+            StackInfoRenderer(),
+            _LOG_DISPATCHER,
+            LogRenderer(level=level, echo_commands=echo_commands),
+        ]
+
+    _pending_config = processors
+    if 'structlog' in sys.modules:
+        _import_structlog()
+
+
+def flush_logs():
+    """Write out all pending events of log files"""
+    for handler in list(_LOG_DISPATCHER.handlers):
+        if isinstance(handler, AsyncLogWriter):
+            handler.close()
+            _LOG_DISPATCHER.remove_handler(handler)
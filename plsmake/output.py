@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+import sys
+import threading
+
+
+SPILL_SIZE = 1024 * 1024    # captured output larger than this is kept in temp file
+
+console = None      # type: Console
+_local = threading.local()
+
+
+class Console:
+    """Print captured output of targets atomically, and optionally show a
+    status line like `[12/345] target` instead of echoing commands."""
+
+    def __init__(self, stream=None, progress=False):
+        self.stream = stream or sys.stdout
+        self.progress = progress
+        self.total = 0
+        self.finished = 0
+
+        self._lock = threading.Lock()
+        self._status = ''
+        self._isatty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+    def add_total(self, count: int):
+        with self._lock:
+            self.total += count
+
+    def _clear_status(self):
+        if self._status and self._isatty:
+            self.stream.write('\r\x1b[K')
+            self._status = ''
+
+    def _write_bytes(self, fp):
+        self.stream.flush()
+        buffer = getattr(self.stream, 'buffer', None)
+        if buffer is not None:
+            import shutil
+            shutil.copyfileobj(fp, buffer)
+            buffer.flush()
+        else:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                self.stream.write(chunk.decode(errors='replace'))
+
+    def write_output(self, target: str, fp):
+        """Print captured output of target from a binary file object"""
+        fp.seek(0)
+        if not fp.read(1):
+            return
+        fp.seek(0)
+        with self._lock:
+            self._clear_status()
+            self._write_bytes(fp)
+            self._draw_status()
+
+    def target_finished(self, target: str, built: bool):
+        with self._lock:
+            self.finished += 1
+            if self.progress and built:
+                self._clear_status()
+                self._status = '[%d/%d] %s' % (self.finished, self.total, target)
+                self._draw_status()
+
+    def _draw_status(self):
+        if self._status:
+            if self._isatty:
+                self.stream.write(self._status)
+            else:
+                self.stream.write(self._status + '\n')
+                self._status = ''
+        self.stream.flush()
+
+    def close(self):
+        with self._lock:
+            if self._status and self._isatty:
+                self.stream.write('\n')
+            self._status = ''
+            self.stream.flush()
+
+
+def enable(progress=False, stream=None) -> Console:
+    """Capture output of actions, printed when the action finishes"""
+    global console
+    console = Console(stream=stream, progress=progress)
+    return console
+
+
+def disable():
+    global console
+    if console is not None:
+        console.close()
+    console = None
+
+
+def current_output():
+    """Return the binary file object capturing output of current action, or None"""
+    return getattr(_local, 'output', None)
+
+
+@contextmanager
+def capture(target: str):
+    if console is None:
+        yield None
+        return
+
+    import tempfile
+    fp = tempfile.SpooledTemporaryFile(max_size=SPILL_SIZE)
+    _local.output = fp
+    try:
+        yield fp
+    finally:
+        _local.output = None
+        console.write_output(target, fp)
+        fp.close()
+
+
+def target_finished(target: str, built: bool):
+    if console is not None:
+        console.target_finished(target, built)
+
+
+def add_total(count: int):
+    if console is not None:
+        console.add_total(count)
@@ -0,0 +1,223 @@
+"""Build plans: resolved graphs with the commands of actions, run without the build file.
+
+A plan is recorded by calling actions while api.run() records its arguments
+instead of running them, so it is only correct for actions that do nothing but
+running commands. Actions calling run_with_output() can not be recorded, nor
+actions of files which run no commands, e.g. those writing files in Python.
+Batch actions are recorded one target per call.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from plsmake import logger
+
+
+PLAN_VERSION = 1
+
+_local = threading.local()
+
+
+class NotRecordable(Exception):
+    pass
+
+
+class PlanError(Exception):
+    pass
+
+
+def recorded_commands() -> Optional[List[List[str]]]:
+    """Return the list commands are recorded to, None if not recording"""
+    return getattr(_local, 'commands', None)
+
+
+@contextmanager
+def record_commands():
+    _local.commands = []
+    try:
+        yield _local.commands
+    finally:
+        _local.commands = None
+
+
+def _record_action(target: str, howto) -> List[List[str]]:
+    from plsmake.app import BatchItem
+    depends, env, action, action_option = howto[target]
+    try:
+        with record_commands() as commands:
+            if action.batch is not None:
+                action([BatchItem(target, env, depends, action_option)])
+            else:
+                action(env, depends, **action_option)
+    except NotRecordable:
+        raise
+    except Exception as exc:
+        raise NotRecordable(target) from exc
+    if not commands and not action.is_task:
+        # the file is made by python code, replaying nothing would leave it missing
+        raise NotRecordable('%s: no commands run' % (target,))
+    return commands
+
+
+def record_plan(results: Iterable[Tuple[str, 'ResolverResults']]) -> dict:
+    """Return a plan of (target, resolve() result) pairs. Entries are in topological order,
+    source files without action are not included"""
+    entries = []
+    index = dict()  # type: Dict[str, int]
+    defaults = []
+    for root, howto in results:
+        defaults.append(root)
+        stack = [(root, False)]
+        while stack:
+            target, expanded = stack.pop()
+            if target in index:
+                continue
+            depends, _, action, action_option = howto[target]
+            if not expanded:
+                stack.append((target, True))
+                stack.extend((dep, False) for dep in reversed(depends) if dep not in index)
+                continue
+            if action is None and not depends:
+                continue
+
+            entry = dict(
+                outputs=[target], deps=list(OrderedDict.fromkeys(depends)), task=False, commands=None)
+            if action is not None:
+                entry['task'] = action.is_task
+                if len(action.outputs) > 1:
+                    entry['outputs'] = action.group_targets(action_option)
+                logger.debug('plan.record', target=target)
+                entry['commands'] = _record_action(target, howto)
+            for output in entry['outputs']:
+                index[output] = len(entries)
+            entries.append(entry)
+
+    return dict(version=PLAN_VERSION, default=defaults, entries=entries)
+
+
+def save_plan(plan: dict, filename: str):
+    import json
+    tmp = filename + '.tmp'
+    with open(tmp, 'wt', encoding='utf8') as fp:
+        json.dump(plan, fp, separators=(',', ':'))
+    os.replace(tmp, filename)
+
+
+def load_plan(filename: str) -> dict:
+    import json
+    with open(filename, 'rt', encoding='utf8') as fp:
+        plan = json.load(fp)
+    if plan.get('version') != PLAN_VERSION:
+        raise PlanError('unsupported plan version: %r' % (plan.get('version'),))
+    return plan
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class PlanRunner:
+    """Run a plan with mtime checks like execute()"""
+
+    def __init__(self, plan: dict):
+        self.entries = plan['entries']
+        self.default = plan['default']
+        self._index = dict()    # type: Dict[str, dict]
+        for entry in self.entries:
+            for output in entry['outputs']:
+                self._index[output] = entry
+        self._done = set()      # first outputs of finished entries
+
+    def _should_run(self, entry, always_make):
+        if entry['task'] or always_make:
+            return True
+        mtimes = [_mtime(output) for output in entry['outputs']]
+        if None in mtimes:
+            return True
+        oldest = min(mtimes)
+        for dep in entry['deps']:
+            dep_entry = self._index.get(dep)
+            if dep_entry is not None and dep_entry['task']:
+                continue
+            mtime = _mtime(dep)
+            if mtime is not None and mtime > oldest:
+                return True
+        return False
+
+    def build(self, targets: Sequence[str] = None, always_make=False) -> int:
+        """Return the number of entries whose commands were run"""
+        from plsmake.process import run_command
+        ran = 0
+        stack = [(target, False) for target in reversed(targets or self.default)]
+        while stack:
+            target, expanded = stack.pop()
+            entry = self._index.get(target)
+            if entry is None:
+                if _mtime(target) is None:
+                    raise PlanError('no entry to make target: %s' % (target,))
+                continue
+            if entry['outputs'][0] in self._done:
+                continue
+            if not expanded:
+                stack.append((target, True))
+                stack.extend((dep, False) for dep in reversed(entry['deps']))
+                continue
+
+            self._done.add(entry['outputs'][0])
+            if not self._should_run(entry, always_make):
+                continue
+            if entry['commands'] is None:
+                raise PlanError('no action to make target: %s' % (target,))
+            logger.info('plan.run', target=target)
+            for args in entry['commands']:
+                logger.info('run_cmd', msg=' '.join(args), args=args)
+                run_command(args)
+            ran += 1
+        return ran
+
+
+def run_plan(filename: str, targets: Sequence[str] = None, always_make=False) -> int:
+    return PlanRunner(load_plan(filename)).build(targets, always_make=always_make)
+
+
+def _ninja_escape(path: str) -> str:
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def write_ninja(plan: dict, filename: str):
+    """Write a build.ninja equivalent to the plan"""
+    import shlex
+    lines = [
+        '# generated by plsmake',
+        'rule cmd',
+        '  command = $cmd',
+        '',
+    ]
+    tasks = set()
+    for entry in plan['entries']:
+        if entry['task']:
+            tasks.update(entry['outputs'])
+
+    for entry in plan['entries']:
+        outputs = ' '.join(map(_ninja_escape, entry['outputs']))
+        deps = ' '.join(_ninja_escape(dep) for dep in entry['deps'] if dep not in tasks)
+        # tasks do not make dependants out of date, like should_build()
+        order_only = [_ninja_escape(dep) for dep in entry['deps'] if dep in tasks]
+        if order_only:
+            deps += ' || ' + ' '.join(order_only)
+        if not entry['commands']:
+            lines.append('build %s: phony %s' % (outputs, deps))
+            continue
+        command = ' && '.join(' '.join(map(shlex.quote, args)) for args in entry['commands'])
+        lines.append('build %s: cmd %s' % (outputs, deps))
+        lines.append('  cmd = %s' % (command.replace('$', '$$'),))
+        lines.append('')
+    lines.append('default %s' % (' '.join(map(_ninja_escape, plan['default'])),))
+
+    with open(filename, 'wt', encoding='utf8') as fp:
+        fp.write('\n'.join(lines) + '\n')
@@ -0,0 +1,289 @@
+from collections import namedtuple
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from plsmake import logger
+from plsmake.output import current_output
+from plsmake.spawn import spawn as spawn_command
+
+
+class BuildAborted(Exception):
+    pass
+
+
+# stdout: output of the command if want_stdout, output: its other output
+CommandResult = namedtuple('CommandResult', ['args', 'returncode', 'stdout', 'output'])
+
+
+class CommandsFailed(subprocess.CalledProcessError):
+    """A command of run_many() failed, results has a CommandResult or None (not
+    started) for each command"""
+
+    def __init__(self, failed: CommandResult, results):
+        super().__init__(failed.returncode, failed.args, output=failed.stdout)
+        self.results = results
+
+
+if os.name != 'posix':
+    _GROUP_OPTIONS = dict()
+elif sys.version_info >= (3, 11):
+    _GROUP_OPTIONS = dict(process_group=0)
+else:
+    _GROUP_OPTIONS = dict(start_new_session=True)
+
+# file descriptors passed to commands, the jobserver pipe
+inherited_fds = ()
+
+
+class ChildProcesses:
+    """Processes spawned by run_command(). Each one is in its own process group,
+    so that it can be killed with its descendants when the build stops.
+
+    Each run is a generation. Worker threads are bound to the generation they are
+    submitted in, so threads left over from a stopped run can not start commands
+    in the next one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._local = threading.local()
+        self._generation = 0
+        self._stopped = -1      # generations up to this one are stopped
+
+    def _current(self) -> int:
+        return getattr(self._local, 'generation', self._generation)
+
+    @property
+    def stopping(self) -> bool:
+        """Whether the run of the calling thread is stopped"""
+        return self._current() <= self._stopped
+
+    def bind(self, func):
+        """Return func that runs in the generation of the caller, for worker threads"""
+        generation = self._current()
+
+        def bound(*args, **kwargs):
+            self._local.generation = generation
+            try:
+                return func(*args, **kwargs)
+            finally:
+                del self._local.generation
+        return bound
+
+    def spawn(self, args, **kwargs) -> subprocess.Popen:
+        if self.stopping:
+            raise BuildAborted(args)
+        proc = spawn_command(
+            args, pass_fds=inherited_fds, group_options=_GROUP_OPTIONS, **kwargs)
+        with self._lock:
+            self._procs.add(proc)
+            stopping = self.stopping
+        if stopping:
+            # terminate_all() was called while spawning
+            self.kill(proc)
+        return proc
+
+    def finished(self, proc: subprocess.Popen):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def kill(self, proc: subprocess.Popen):
+        self._signal(proc, signal.SIGKILL if os.name == 'posix' else signal.SIGTERM)
+
+    @staticmethod
+    def _signal(proc, sig):
+        try:
+            if _GROUP_OPTIONS:
+                os.killpg(proc.pid, sig)
+            else:
+                proc.send_signal(sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def terminate_all(self, timeout=1.0):
+        """Stop the run of the caller: refuse new processes, send SIGTERM to running
+        ones, and SIGKILL those still alive after timeout"""
+        with self._lock:
+            self._stopped = max(self._stopped, self._current())
+            procs = list(self._procs)
+        if not procs:
+            return
+
+        logger.info('process.terminate_all', count=len(procs))
+        for proc in procs:
+            self._signal(proc, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for proc in procs:
+            try:
+                proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.kill(proc)
+
+    def reset(self):
+        """Start a new generation, threads bound to stopped ones stay stopped"""
+        with self._lock:
+            self._generation = max(self._generation, self._stopped) + 1
+
+
+children = ChildProcesses()
+
+
+def _pump(proc, capture, want_stdout: bool) -> bytes:
+    """Read stdout and stderr without blocking, stderr and unwanted stdout go to capture"""
+    stdout_chunks = []
+    if os.name != 'posix':
+        stdout, stderr = proc.communicate()
+        if want_stdout:
+            stdout_chunks.append(stdout)
+        else:
+            capture.write(stdout)
+        capture.write(stderr)
+        return b''.join(stdout_chunks)
+
+    import selectors
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ, want_stdout)
+        selector.register(proc.stderr, selectors.EVENT_READ, False)
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, 64 * 1024)
+                if not data:
+                    selector.unregister(key.fileobj)
+                elif key.data:
+                    stdout_chunks.append(data)
+                else:
+                    capture.write(data)
+    return b''.join(stdout_chunks)
+
+
+def run_command(args, want_stdout=False):
+    """Run command and raise CalledProcessError on failure. Return stdout if
+    want_stdout. Output is captured if an action output capture is active."""
+    capture = current_output()
+    if capture is None:
+        proc = children.spawn(args, stdout=(subprocess.PIPE if want_stdout else None))
+    else:
+        proc = children.spawn(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        if capture is None:
+            stdout, _ = proc.communicate()
+        else:
+            stdout = _pump(proc, capture, want_stdout)
+    except BaseException:
+        # e.g. KeyboardInterrupt, SIGINT of terminal is not sent to other process groups
+        children.kill(proc)
+        raise
+    finally:
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe is not None:
+                pipe.close()
+        retcode = proc.wait()
+        children.finished(proc)
+
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, args, output=stdout)
+    return stdout if want_stdout else retcode
+
+
+class _Batch:
+    """Processes of one run_many() call"""
+
+    def __init__(self, want_stdout: bool):
+        self.want_stdout = want_stdout
+        self.stopped = False
+        self._procs = dict()
+        self._lock = threading.Lock()
+
+    def run(self, index: int, args) -> CommandResult:
+        with self._lock:
+            if self.stopped:
+                return None
+            stderr = subprocess.PIPE if self.want_stdout else subprocess.STDOUT
+            proc = children.spawn(args, stdout=subprocess.PIPE, stderr=stderr)
+            self._procs[index] = proc
+        try:
+            stdout, output = proc.communicate()
+        finally:
+            children.finished(proc)
+        if not self.want_stdout:
+            stdout, output = None, stdout
+        return CommandResult(args, proc.returncode, stdout, output)
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            procs = list(self._procs.values())
+        for proc in procs:
+            if proc.poll() is None:
+                children.kill(proc)
+
+
+def run_many(commands, jobs=None, check=True, want_stdout=False):
+    """Run commands concurrently and return a CommandResult for each one.
+    Commands beyond the first one take tokens of the jobserver, so they use job
+    slots left idle by the executor. Without a jobserver, at most `jobs` (default 1)
+    commands run at once. Output of each command is captured and written as a
+    whole when it finishes.
+    check: on a failure, kill the running commands, start no more and raise
+    CommandsFailed, otherwise run all commands"""
+    import concurrent.futures as cf
+    from plsmake import jobserver
+
+    commands = [list(args) for args in commands]
+    results = [None] * len(commands)
+    if not commands:
+        return results
+    client = jobserver.client
+    limit = min(jobs or (len(commands) if client is not None else 1), len(commands))
+    slots = jobserver.JobSlots(client)
+    batch = _Batch(want_stdout)
+    capture = current_output()
+    failed = None
+    pending = list(enumerate(commands))
+    pending.reverse()
+    works = dict()
+    pool = cf.ThreadPoolExecutor(max_workers=limit)
+    try:
+        while (pending and failed is None) or works:
+            waiting_token = False
+            while pending and failed is None and len(works) < limit:
+                if not slots.acquire(len(works)):
+                    waiting_token = True
+                    break
+                index, args = pending.pop()
+                logger.info('run_cmd', msg=' '.join(args), args=args)
+                works[pool.submit(children.bind(batch.run), index, args)] = index
+
+            done, _ = cf.wait(
+                works.keys(), timeout=(0.05 if waiting_token else None),
+                return_when=cf.FIRST_COMPLETED)
+            for fut in done:
+                index = works.pop(fut)
+                result = results[index] = fut.result()
+                if result is None:
+                    continue
+                if result.output:
+                    if capture is not None:
+                        capture.write(result.output)
+                    else:
+                        sys.stderr.buffer.write(result.output)
+                        sys.stderr.flush()
+                if result.returncode and check and failed is None:
+                    logger.error('run_many.failed', args=result.args, code=result.returncode)
+                    failed = result
+                    batch.stop()
+            slots.fit(len(works))
+    except BaseException:
+        batch.stop()
+        raise
+    finally:
+        pool.shutdown()
+        slots.fit(0)
+
+    if failed is not None:
+        raise CommandsFailed(failed, results)
+    return results
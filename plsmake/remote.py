@@ -0,0 +1,305 @@
+"""Run command-running actions on worker agents, see plsmake.worker.
+
+Actions are recorded like plsmake.plan does, then the commands are sent to a
+worker with the action's dependencies as inputs. Inputs and outputs are moved by
+sha256 digest, so files a worker already has are not sent again, and targets are
+preferably sent to the worker having most of their inputs. Commands run in a
+scratch directory on the worker, so they must use relative paths of inputs and
+outputs, only actions declared with remote=True are sent. Actions recording no
+command or that can not be recorded run in-process, as their Python code may
+write files the commands need.
+
+Messages are a 4 bytes big endian length followed by a json object, file
+contents follow the message carrying their `size` and are streamed in chunks.
+Sockets time out after CONNECT_TIMEOUT and IO_TIMEOUT, except while commands run,
+as they may run for long, where TCP keepalive detects lost workers instead.
+"""
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+from typing import Dict, List, Sequence, Set, Tuple
+
+from plsmake import logger
+
+
+_LENGTH = struct.Struct('>I')
+CHUNK_SIZE = 256 * 1024
+CONNECT_TIMEOUT = 10
+IO_TIMEOUT = 60
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def parse_address(address: str):
+    """'host:port' or 'unix:/path' -> (family, sockaddr)"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        data = sock.recv(min(size, CHUNK_SIZE))
+        if not data:
+            raise ProtocolError('connection closed')
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+def send_message(sock: socket.socket, message: dict, payload: bytes = b''):
+    data = json.dumps(message).encode()
+    sock.sendall(_LENGTH.pack(len(data)) + data + payload)
+
+
+def recv_message(sock: socket.socket) -> dict:
+    length, = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return json.loads(_recv_exact(sock, length).decode())
+
+
+def recv_payload(sock: socket.socket, message: dict) -> bytes:
+    return _recv_exact(sock, message.get('size', 0))
+
+
+def send_file(sock: socket.socket, message: dict, fp):
+    """Send message with the content of fp as payload, without reading it in memory"""
+    size = os.fstat(fp.fileno()).st_size
+    data = json.dumps(dict(message, size=size)).encode()
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+    if size and sock.sendfile(fp, count=size) != size:
+        raise ProtocolError('file truncated while sending')
+
+
+def recv_file(sock: socket.socket, size: int, fp) -> str:
+    """Write a payload of size bytes to fp in chunks, return its sha256"""
+    h = hashlib.sha256()
+    while size:
+        data = sock.recv(min(size, CHUNK_SIZE))
+        if not data:
+            raise ProtocolError('connection closed')
+        h.update(data)
+        fp.write(data)
+        size -= len(data)
+    return h.hexdigest()
+
+
+def _set_keepalive(sock: socket.socket):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+class RemoteCommandError(Exception):
+    pass
+
+
+class _Worker:
+    def __init__(self, address: str, token=None, timeout=IO_TIMEOUT):
+        self.address = address
+        self.token = token
+        self.timeout = timeout
+        self.slots = 0
+        self.advertised = 0     # slots the worker has
+        self.running = 0
+        self.known = set()      # type: Set[str]
+        self._idle = []         # type: List[socket.socket]
+        self._lock = threading.Lock()
+
+    def connect(self) -> socket.socket:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        family, sockaddr = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(sockaddr)
+            sock.settimeout(self.timeout)
+            if family != socket.AF_UNIX:
+                _set_keepalive(sock)
+            reply, _ = self.request(sock, dict(op='hello', token=self.token))
+        except BaseException:
+            sock.close()
+            raise
+        self.advertised = reply['slots']
+        return sock
+
+    def release(self, sock: socket.socket):
+        with self._lock:
+            self._idle.append(sock)
+
+    def close(self):
+        with self._lock:
+            for sock in self._idle:
+                sock.close()
+            self._idle.clear()
+
+    def _reply(self, sock) -> dict:
+        reply = recv_message(sock)
+        if reply.get('error'):
+            raise ProtocolError('%s: %s' % (self.address, reply['error']))
+        return reply
+
+    def request(self, sock, message: dict, payload=b'') -> Tuple[dict, bytes]:
+        send_message(sock, message, payload)
+        reply = self._reply(sock)
+        return reply, recv_payload(sock, reply)
+
+    def run(self, sock, message: dict) -> Tuple[dict, bytes]:
+        sock.settimeout(None)   # commands may run for long
+        try:
+            return self.request(sock, message)
+        finally:
+            sock.settimeout(self.timeout)
+
+    def put_file(self, sock, digest: str, path: str):
+        with open(path, 'rb') as fp:
+            send_file(sock, dict(op='put', digest=digest), fp)
+        self._reply(sock)
+
+    def get_file(self, sock, digest: str, fp):
+        send_message(sock, dict(op='get', digest=digest))
+        reply = self._reply(sock)
+        if recv_file(sock, reply['size'], fp) != digest:
+            raise ProtocolError('%s: digest mismatch of %s' % (self.address, digest))
+
+
+class WorkerPool:
+    """The coordinator side: dispatch recorded actions to workers"""
+
+    def __init__(self, addresses: Sequence[str], slots=None, token=None, timeout=IO_TIMEOUT):
+        """token: the secret of workers, see plsmake.worker
+        timeout: of a transfer, running commands is not limited"""
+        self.workers = [_Worker(address, token=token, timeout=timeout) for address in addresses]
+        self._cond = threading.Condition()
+        for worker in self.workers:
+            worker.release(worker.connect())
+            worker.slots = slots or worker.advertised
+            logger.info('remote.worker', address=worker.address, slots=worker.slots)
+
+    @property
+    def slots(self) -> int:
+        return sum(worker.slots for worker in self.workers)
+
+    def _acquire(self, digests: Dict[str, int]) -> _Worker:
+        """Wait for a free worker, prefer the one having most bytes of inputs"""
+        with self._cond:
+            while True:
+                free = [worker for worker in self.workers if worker.running < worker.slots]
+                if free:
+                    worker = max(free, key=lambda w: (
+                        sum(size for digest, size in digests.items() if digest in w.known),
+                        w.slots - w.running,
+                    ))
+                    worker.running += 1
+                    return worker
+                self._cond.wait()
+
+    def _release(self, worker: _Worker):
+        with self._cond:
+            worker.running -= 1
+            self._cond.notify()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def run_action(self, targets: Sequence[str], howto) -> bool:
+        """Run action of targets on a worker, return False if it must run locally"""
+        from plsmake.plan import NotRecordable, _record_action
+        _, _, action, action_option = howto[targets[0]]
+        if action.is_task or not action.remote or len(targets) > 1:
+            return False
+        try:
+            commands = _record_action(targets[0], howto)
+        except NotRecordable:
+            logger.debug('remote.not_recordable', target=targets[0])
+            return False
+
+        outputs = list(targets)
+        if len(action.outputs) > 1:
+            outputs = action.group_targets(action_option)
+        self.run_commands(targets[0], commands, howto[targets[0]][0], outputs)
+        return True
+
+    def run_commands(self, target: str, commands, inputs: Sequence[str], outputs: Sequence[str]):
+        from plsmake.cache import file_digest
+        from plsmake.output import current_output
+
+        files = dict()      # relative path -> digest
+        sizes = dict()      # digest -> size
+        for path in inputs:
+            if os.path.isabs(path) or not os.path.isfile(path):
+                continue    # absolute paths are taken from the worker's file system
+            digest = file_digest(path)
+            files[path] = digest
+            sizes[digest] = os.path.getsize(path)
+
+        worker = self._acquire(sizes)
+        sock = None
+        try:
+            sock = worker.connect()
+            self._upload(worker, sock, files, sizes)
+            for args in commands:
+                logger.info(
+                    'remote.run_cmd', msg=' '.join(args), args=args, worker=worker.address)
+            reply, log_output = worker.run(sock, dict(
+                op='run', commands=commands, inputs=files, outputs=list(outputs)))
+            capture = current_output()
+            if log_output:
+                if capture is not None:
+                    capture.write(log_output)
+                else:
+                    import sys
+                    sys.stderr.buffer.write(log_output)
+                    sys.stderr.flush()
+            if reply['returncode'] != 0:
+                raise RemoteCommandError(
+                    '%s failed on %s with %d' % (target, worker.address, reply['returncode']))
+            for path, digest in reply['outputs'].items():
+                self._download(worker, sock, path, digest)
+                worker.known.add(digest)
+            worker.release(sock)
+            sock = None
+        finally:
+            if sock is not None:
+                sock.close()
+            self._release(worker)
+
+    @staticmethod
+    def _upload(worker: _Worker, sock, files: Dict[str, str], sizes: Dict[str, int]):
+        unknown = [digest for digest in sizes if digest not in worker.known]
+        if not unknown:
+            return
+        reply, _ = worker.request(sock, dict(op='has', digests=unknown))
+        paths = dict((digest, path) for path, digest in files.items())
+        for digest in reply['missing']:
+            worker.put_file(sock, digest, paths[digest])
+            logger.debug('remote.upload', file=paths[digest], worker=worker.address)
+        worker.known.update(unknown)
+
+    @staticmethod
+    def _download(worker: _Worker, sock, path: str, digest: str):
+        from plsmake.cache import file_digest
+        if os.path.isfile(path) and file_digest(path) == digest:
+            os.utime(path)
+            return
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = '%s.%d.plstmp' % (path, threading.get_ident())
+        try:
+            with open(tmp, 'wb') as fp:
+                worker.get_file(sock, digest, fp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
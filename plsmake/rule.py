@@ -1,4 +1,5 @@
 import re
+from typing import Dict, Iterable, List, Tuple
 
 
 class Rule:
@@ -10,9 +11,17 @@ class Rule:
     def __init__(self, url: str):
         self.url = url
         self.words, self.params = self.parse(url)
-        regex = self.VALUE_RE.join(re.escape(wd) for wd in self.words)
+        if len(set(self.params)) == len(self.params):
+            # named groups, so that groupdict() builds the result
+            value_res = [r'(?P<%s>[\w-]+)' % (par,) for par in self.params]
+        else:
+            value_res = [self.VALUE_RE] * len(self.params)
+        regex = ''.join(
+            re.escape(wd) + value_re for wd, value_re in zip(self.words, value_res + ['']))
         regex = '^{}$'.format(regex)
         self.match_re = re.compile(regex)
+        # rules with more literal characters and fewer params are more specific
+        self.specificity = (not self.params, sum(map(len, self.words)), -len(self.params))
 
     @classmethod
     def parse(cls, url: str):
@@ -25,6 +34,8 @@ class Rule:
     def match(self, target: str):
         matched = self.match_re.fullmatch(target)
         if matched:
+            if self.match_re.groupindex:
+                return matched.groupdict()
             return dict(zip(self.params, matched.groups()))
         else:
             return None
@@ -40,3 +51,67 @@ class Rule:
 
     def __hash__(self):
         return hash(self.url)
+
+
+class RuleDispatcher:
+    """Find all rules matching a target.
+
+    Pattern rules are indexed by a trie of their leading literal word, so one pass
+    over the target collects the rules whose prefix matches. Only these are checked
+    with their regex. Results are cached per target.
+    """
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules = list(rules)
+        self._literals = dict()     # type: Dict[str, Tuple[int, Rule]]
+        self._trie = dict()         # char -> child node, None -> [(index, rule)]
+        self._cache = dict()        # type: Dict[str, List[Tuple[Rule, Dict[str, str]]]]
+        for index, rule in enumerate(self.rules):
+            if not rule.params:
+                self._literals[rule.url] = index, rule
+                continue
+            node = self._trie
+            for ch in rule.words[0]:
+                node = node.setdefault(ch, dict())
+            node.setdefault(None, []).append((index, rule))
+
+    def _candidates(self, target: str):
+        node = self._trie
+        yield from node.get(None, ())
+        for ch in target:
+            node = node.get(ch)
+            if node is None:
+                return
+            yield from node.get(None, ())
+
+    def match(self, target: str) -> List[Tuple[Rule, Dict[str, str]]]:
+        """Return [(rule, params)] of matching rules in definition order"""
+        try:
+            return self._cache[target]
+        except KeyError:
+            pass
+
+        candidates = list(self._candidates(target))
+        literal = self._literals.get(target)
+        if literal is not None:
+            candidates.append(literal)
+        candidates.sort(key=lambda item: item[0])
+
+        result = []
+        for _, rule in candidates:
+            if not rule.params:
+                result.append((rule, dict()))
+                continue
+            if not target.endswith(rule.words[-1]):
+                continue
+            params = rule.match(target)
+            if params is not None:
+                result.append((rule, params))
+
+        self._cache[target] = result
+        return result
+
+
+def most_specific(rules: Iterable[Rule]) -> Rule:
+    """Return the most specific rule, the first one among equally specific rules"""
+    return max(rules, key=lambda rule: rule.specificity)
@@ -0,0 +1,136 @@
+"""A fast in-process alternative to `$CXX -MM`.
+
+It follows #include directives through -I/-iquote/-isystem paths. Includes in
+all branches of conditional blocks are followed, so the result may be a superset
+of what the compiler reports, which only costs extra rebuilds. Headers found in
+system directories (-isystem or not found with <...>) are omitted like -MM does.
+scan_includes() returns None when it can not give a safe answer: computed
+includes, #include_next, -include flags or quoted headers that are not found.
+"""
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from plsmake import logger
+
+
+_TOKEN_RE = re.compile(
+    r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.DOTALL)
+_DIRECTIVE_RE = re.compile(r'^[ \t]*#[ \t]*(include|include_next|import)\b[ \t]*(.*)$', re.MULTILINE)
+_HEADER_RE = re.compile(r'^(?:<([^>\n]+)>|"([^"\n]+)")')
+
+# search paths: (quote dirs, angle dirs, system dirs)
+SearchPaths = Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]]
+
+_memo = dict()      # type: Dict[Tuple[str, SearchPaths], Tuple[int, Optional[List[str]]]]
+_memo_lock = threading.Lock()
+
+
+def parse_include_flags(flags: Sequence[str]) -> Optional[SearchPaths]:
+    """Return search paths from compiler flags, or None if flags are not supported"""
+    quote, angle, system = [], [], []
+    targets = {'-I': angle, '-iquote': quote, '-isystem': system, '-idirafter': system}
+    flags = list(flags)
+    i = 0
+    while i < len(flags):
+        flag = flags[i]
+        i += 1
+        if flag in ('-include', '-imacros', '-nostdinc++', '-I-') or flag.startswith('-iprefix'):
+            return None
+        for prefix, dirs in targets.items():
+            if flag == prefix:
+                if i >= len(flags):
+                    return None
+                dirs.append(flags[i])
+                i += 1
+                break
+            if flag.startswith(prefix):
+                dirs.append(flag[len(prefix):])
+                break
+    return tuple(quote), tuple(angle), tuple(system)
+
+
+def _strip_comments(text: str) -> str:
+    def repl(m):
+        token = m.group(0)
+        if token.startswith('/*'):
+            return ' ' + '\n' * token.count('\n')
+        if token.startswith('//'):
+            return ''
+        return token
+
+    return _TOKEN_RE.sub(repl, text.replace('\\\r\n', '').replace('\\\n', ''))
+
+
+def _find(name: str, dirs: Sequence[str]) -> Optional[str]:
+    for dirname in dirs:
+        path = os.path.join(dirname, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _parse_includes(path: str, paths: SearchPaths) -> Optional[List[str]]:
+    quote, angle, system = paths
+    with open(path, 'rt', encoding='latin-1') as fp:
+        text = _strip_comments(fp.read())
+
+    result = []
+    for m in _DIRECTIVE_RE.finditer(text):
+        kind, arg = m.groups()
+        header = _HEADER_RE.match(arg.strip())
+        if kind == 'include_next' or header is None:
+            return None
+        angle_name, quote_name = header.groups()
+        if quote_name is not None:
+            found = _find(quote_name, (os.path.dirname(path) or '.',) + quote + angle)
+            if found is None and _find(quote_name, system) is None:
+                logger.debug('scan.not_found', file=path, header=quote_name)
+                return None
+        else:
+            found = _find(angle_name, angle)
+        if found is not None:
+            result.append(os.path.normpath(found).replace('\\', '/'))
+    return result
+
+
+def direct_includes(path: str, paths: SearchPaths) -> Optional[List[str]]:
+    """Return non-system headers included by file, memoized by (path, mtime)"""
+    mtime = os.stat(path).st_mtime_ns
+    key = path, paths
+    with _memo_lock:
+        cached = _memo.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    includes = _parse_includes(path, paths)
+    with _memo_lock:
+        _memo[key] = mtime, includes
+    return includes
+
+
+def scan_includes(sourcefile: str, flags: Sequence[str]) -> Optional[List[str]]:
+    """Return sourcefile and the headers it includes directly or indirectly,
+    in the order of `$CXX -MM`, or None if the scanner can not handle it"""
+    paths = parse_include_flags(flags)
+    if paths is None:
+        return None
+
+    result = []
+    seen = set()
+    stack = [iter([os.path.normpath(sourcefile).replace('\\', '/')])]
+    while stack:
+        path = next(stack[-1], None)
+        if path is None:
+            stack.pop()
+            continue
+        if path in seen:
+            continue
+        seen.add(path)
+        result.append(path)
+        includes = direct_includes(path, paths)
+        if includes is None:
+            return None
+        stack.append(iter(includes))
+    return result
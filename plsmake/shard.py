@@ -0,0 +1,143 @@
+"""Split a build across machines.
+
+The requested targets are expanded into smaller units (their dependencies, then
+dependencies of the heaviest units, ...) and the units are assigned to shards,
+heaviest first, to the shard where the unit adds the least work on top of the
+shard's current load. Work shared with units already in the shard is not counted
+again, so units with common dependencies tend to stay together. Each shard builds
+the closures of its units, shared dependencies may be built by several shards.
+"""
+from collections import OrderedDict, namedtuple
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from plsmake.app import ResolverResults, _closure
+
+
+Shard = namedtuple('Shard', ['units', 'targets', 'cost'])
+
+UNITS_PER_SHARD = 8
+
+
+def parse_shard(string: str) -> Tuple[int, int]:
+    """Parse 'i/N', return zero based (index, count)"""
+    index, _, count = string.partition('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError('shard index out of range: %s' % (string,))
+    return index - 1, count
+
+
+def merge_results(results: Sequence[ResolverResults]) -> ResolverResults:
+    merged = dict()
+    for howto in results:
+        for target, value in howto.items():
+            merged.setdefault(target, value)
+    return merged
+
+
+def target_costs(howto: ResolverResults, db=None) -> Dict[str, float]:
+    """Return target -> estimated seconds of its action. Targets without history
+    cost the median of known durations, or 1 if nothing is known."""
+    known = []
+    if db is not None:
+        known = sorted(
+            duration for target, duration in db.durations.items() if target in howto)
+    default = known[len(known) // 2] if known else 1.0
+
+    costs = dict()
+    for target, (_, _, action, _) in howto.items():
+        if action is None:
+            costs[target] = 0.0
+        else:
+            duration = db and db.get_duration(target)
+            costs[target] = default if duration is None else duration
+    return costs
+
+
+def _expand_units(howto, roots, costs, count: int) -> List[str]:
+    closures = dict()   # type: Dict[str, Set[str]]
+
+    def weight(target):
+        if target not in closures:
+            closures[target] = _closure(target, howto)
+        return sum(costs[t] for t in closures[target])
+
+    units = list(OrderedDict.fromkeys(roots))
+    while len(units) < count * UNITS_PER_SHARD:
+        expandable = [unit for unit in units if any(weight(dep) for dep in howto[unit][0])]
+        if not expandable:
+            break
+        heaviest = max(expandable, key=weight)
+        index = units.index(heaviest)
+        children = [dep for dep in howto[heaviest][0] if weight(dep) and dep not in units]
+        units[index:index + 1] = children
+    return [unit for unit in units if weight(unit)]
+
+
+def plan_shards(
+        howto: ResolverResults, roots: Sequence[str], count: int, db=None) -> List[Shard]:
+    """Split the closure of roots into count shards. Targets depending on units of
+    several shards (e.g. an 'all' task) are not built by any shard."""
+    costs = target_costs(howto, db)
+    units = _expand_units(howto, roots, costs, count)
+    closures = dict((unit, _closure(unit, howto)) for unit in units)
+    unit_costs = dict((unit, sum(costs[t] for t in closures[unit])) for unit in units)
+
+    shards = [([], set(), [0.0]) for _ in range(count)]
+    for unit in sorted(units, key=lambda unit: (-unit_costs[unit], unit)):
+        best = None     # type: Optional[Tuple[float, float, int]]
+        for index, (_, covered, load) in enumerate(shards):
+            extra = sum(costs[t] for t in closures[unit] if t not in covered)
+            key = (load[0] + extra, extra, index)
+            if best is None or key < best:
+                best = key
+        _, extra, index = best
+        shard_units, covered, load = shards[index]
+        shard_units.append(unit)
+        covered.update(closures[unit])
+        load[0] += extra
+
+    # targets above units are built by a shard if their dependencies are all there
+    expanded = set().union(*(_closure(root, howto) for root in roots))
+    expanded -= set().union(*closures.values())
+    expanded = set(target for target in expanded if costs[target] or howto[target][0])
+    changed = True
+    while changed:
+        changed = False
+        for target in sorted(expanded):
+            for shard_units, covered, load in shards:
+                if covered.issuperset(howto[target][0]):
+                    shard_units.append(target)
+                    covered.add(target)
+                    load[0] += costs[target]
+                    expanded.remove(target)
+                    changed = True
+                    break
+
+    return [
+        Shard(units=sorted(units), targets=covered, cost=load[0])
+        for units, covered, load in shards
+    ]
+
+
+def print_shards(shards: List[Shard], howto: ResolverResults, roots: Sequence[str]):
+    owners = dict()     # type: Dict[str, int]
+    for shard in shards:
+        for target in shard.targets:
+            owners[target] = owners.get(target, 0) + 1
+    costs = [shard.cost for shard in shards]
+    for i, shard in enumerate(shards):
+        shared = sum(1 for target in shard.targets if owners[target] > 1)
+        print('shard %d/%d: %d units, %d targets (%d shared), estimated %.1fs' % (
+            i + 1, len(shards), len(shard.units), len(shard.targets), shared, shard.cost))
+    excluded = set()
+    for root in roots:
+        excluded.update(
+            target for target in _closure(root, howto)
+            if target not in owners and howto[target][2] is not None)
+    if excluded:
+        print('# %d targets depending on shard units are not built by any shard: %s' % (
+            len(excluded), ' '.join(sorted(excluded))))
+    if costs and max(costs):
+        print('# balance: max %.1fs, mean %.1fs, %.0f%% efficiency' % (
+            max(costs), sum(costs) / len(costs), 100 * sum(costs) / len(costs) / max(costs)))
@@ -0,0 +1,473 @@
+"""Ways of starting commands, used by process.ChildProcesses.
+
+subprocess: subprocess.Popen, which uses vfork() on Linux with Python 3.10+.
+posix_spawn: os.posix_spawnp(), no Python code runs between fork and exec.
+    Descriptors opened by Python are non-inheritable already, other inheritable
+    ones are closed by file actions unless --keep-fds is given.
+helper: a small process started at startup, before build files are loaded, starts
+    commands for the main process, so the page tables of a big graph are never
+    copied. It is a fresh interpreter rather than a fork, as the main process may
+    run threads already. Pipes are passed to it over a unix socket.
+
+The spawn throughput of each method can be measured with:
+
+    python -m plsmake.spawn --ballast 2000 -n 500
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from plsmake import logger
+
+
+METHODS = ('subprocess', 'posix_spawn', 'helper')
+# signals ignored by Python which commands expect to have the default action
+_DEFAULT_SIGNALS = tuple(
+    getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name))
+_MAX_REQUEST = 64 * 1024
+
+method = 'subprocess'
+close_fds = True
+_helper = None      # type: Optional[SpawnHelper]
+# held while pass_fds are made inheritable for posix_spawn
+_inheritable_lock = threading.Lock()
+
+
+class SpawnedProcess:
+    """A minimal Popen-like handle of a process started by posix_spawn or the helper"""
+
+    def __init__(self, args, pid: int, stdout=None, stderr=None):
+        self.args = args
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None  # type: Optional[int]
+        self._exited = threading.Event()
+        self._lock = threading.Lock()
+
+    def _set_returncode(self, returncode: int):
+        self.returncode = returncode
+        self._exited.set()
+
+    def _try_wait(self, block: bool) -> bool:
+        """Reap the child if it is ours (posix_spawn), the helper reports exits itself"""
+        if self._exited.is_set():
+            return True
+        if not self._lock.acquire(block):
+            return False    # another thread is waiting
+        try:
+            if self._exited.is_set():
+                return True
+            pid, status = os.waitpid(self.pid, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return False
+            self._set_returncode(os.waitstatus_to_exitcode(status))
+        finally:
+            self._lock.release()
+        return True
+
+    def poll(self) -> Optional[int]:
+        self._try_wait(False)
+        return self.returncode
+
+    def wait(self, timeout=None) -> int:
+        if timeout is None:
+            self._try_wait(True)
+            return self.returncode
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while not self._try_wait(False):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            self._exited.wait(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
+
+    def communicate(self):
+        """Read stdout and stderr pipes until EOF, then wait"""
+        import selectors
+        chunks = {}
+        with selectors.DefaultSelector() as selector:
+            for pipe in (self.stdout, self.stderr):
+                if pipe is not None:
+                    chunks[pipe] = []
+                    selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, 64 * 1024)
+                    if data:
+                        chunks[key.fileobj].append(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+        self.wait()
+        return tuple(
+            None if pipe is None else b''.join(chunks[pipe]) for pipe in (self.stdout, self.stderr))
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class _HelperProcess(SpawnedProcess):
+    def _try_wait(self, block: bool) -> bool:
+        if block:
+            self._exited.wait()
+        return self._exited.is_set()
+
+
+def _open_pipes(stdout, stderr):
+    """Return (child fds for 1 and 2, parent read ends, fds to close after spawning)"""
+    child, parents, to_close = [None, None], [None, None], []
+    for i, spec in enumerate((stdout, stderr)):
+        if spec == subprocess.PIPE:
+            r, w = os.pipe()
+            child[i] = w
+            parents[i] = open(r, 'rb', buffering=0)
+            to_close.append(w)
+        elif spec == subprocess.STDOUT:
+            child[i] = subprocess.STDOUT
+        elif spec is not None:
+            raise ValueError('unsupported output: %r' % (spec,))
+    return child, parents, to_close
+
+
+def _close_actions(keep) -> list:
+    """File actions closing inheritable descriptors except keep, like close_fds of Popen"""
+    fd_dir = '/proc/self/fd' if os.path.isdir('/proc/self/fd') else '/dev/fd'
+    try:
+        names = os.listdir(fd_dir)
+    except OSError:
+        return []
+    actions = []
+    for name in names:
+        fd = int(name)
+        if fd <= 2 or fd in keep:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                actions.append((os.POSIX_SPAWN_CLOSE, fd))
+        except OSError:
+            pass    # closed meanwhile, e.g. the descriptor of listdir()
+    return actions
+
+
+def _posix_spawn(args, stdout=None, stderr=None, pass_fds=(), env=None) -> SpawnedProcess:
+    child, parents, to_close = _open_pipes(stdout, stderr)
+    file_actions = []
+    for target, fd in ((1, child[0]), (2, child[1])):
+        if fd == subprocess.STDOUT:
+            file_actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+        elif fd is not None:
+            file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+    if close_fds:
+        file_actions.extend(_close_actions(set(pass_fds)))
+
+    def start():
+        return os.posix_spawnp(
+            args[0], list(args), os.environ if env is None else env,
+            file_actions=file_actions, setpgroup=0, setsigdef=_DEFAULT_SIGNALS)
+
+    try:
+        if not pass_fds:
+            pid = start()
+        else:
+            # pass_fds are inheritable only while spawning, other threads wait for that
+            with _inheritable_lock:
+                changed = [fd for fd in pass_fds if not os.get_inheritable(fd)]
+                for fd in changed:
+                    os.set_inheritable(fd, True)
+                try:
+                    pid = start()
+                finally:
+                    for fd in changed:
+                        os.set_inheritable(fd, False)
+    except BaseException:
+        for pipe in parents:
+            if pipe is not None:
+                pipe.close()
+        raise
+    finally:
+        for fd in to_close:
+            os.close(fd)
+    return SpawnedProcess(args, pid, parents[0], parents[1])
+
+
+class SpawnHelper:
+    """The main process side of the helper process"""
+
+    def __init__(self, pass_fds=()):
+        """pass_fds: inherited by the helper, which passes them to commands"""
+        import socket
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = (
+            'import socket, sys; sys.path.insert(0, %r); from plsmake import spawn; '
+            'spawn.close_fds = %r; spawn._helper_main(socket.socket(fileno=%d))'
+        ) % (root, close_fds, child_sock.fileno())
+        fds = [child_sock.fileno()] + list(pass_fds)
+        try:
+            if close_fds:
+                self._proc = subprocess.Popen([sys.executable, '-c', code], pass_fds=fds)
+            else:
+                # pass_fds of Popen implies close_fds
+                changed = [fd for fd in fds if not os.get_inheritable(fd)]
+                for fd in changed:
+                    os.set_inheritable(fd, True)
+                try:
+                    self._proc = subprocess.Popen([sys.executable, '-c', code], close_fds=False)
+                finally:
+                    for fd in changed:
+                        os.set_inheritable(fd, False)
+        finally:
+            child_sock.close()
+        self.pid = self._proc.pid
+        self._sock = parent_sock
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._requests = dict()     # type: Dict[int, list]
+        self._procs = dict()        # type: Dict[int, _HelperProcess]
+        self._exits = dict()        # type: Dict[int, int] exits reported before spawn() returned
+        self._env = dict(os.environ)
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def _read_replies(self):
+        import json
+        while True:
+            try:
+                data = self._sock.recv(_MAX_REQUEST)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            reply = json.loads(data.decode())
+            with self._lock:
+                if 'returncode' in reply:
+                    proc = self._procs.pop(reply['id'], None)
+                    if proc is not None:
+                        proc._set_returncode(reply['returncode'])
+                    else:
+                        self._exits[reply['id']] = reply['returncode']
+                    continue
+                slot = self._requests.pop(reply['id'])
+            slot[1] = reply
+            slot[0].set()
+        with self._lock:
+            for slot in self._requests.values():
+                slot[1] = dict(error='spawn helper exited')
+                slot[0].set()
+            self._requests.clear()
+
+    def spawn(self, args, stdout=None, stderr=None, pass_fds=(), env=None) -> SpawnedProcess:
+        import json
+        import socket
+        request = dict(args=list(args), cwd=os.getcwd(), pass_fds=list(pass_fds), outputs=[
+            'inherit' if spec is None else 'stdout' if spec == subprocess.STDOUT else 'fd'
+            for spec in (stdout, stderr)
+        ])
+        env = dict(os.environ if env is None else env)
+        if env != self._env:
+            request['env'] = env
+        if len(json.dumps(request)) + 32 > _MAX_REQUEST:     # 32 bytes for the id
+            # e.g. a long link command line, it does not fit in a packet
+            logger.debug('spawn.helper_bypass', args=args[:1])
+            return _posix_spawn(args, stdout=stdout, stderr=stderr, pass_fds=pass_fds, env=env)
+
+        child, parents, to_close = _open_pipes(stdout, stderr)
+        fds = [fd for fd in child if fd not in (None, subprocess.STDOUT)]
+        event = threading.Event()
+        slot = [event, None]
+        try:
+            with self._lock:
+                self._next_id += 1
+                request['id'] = self._next_id
+                self._requests[request['id']] = slot
+            data = json.dumps(request).encode()
+            with self._send_lock:
+                socket.send_fds(self._sock, [data], fds)
+                if 'env' in request:
+                    self._env = env
+        except BaseException:
+            with self._lock:
+                self._requests.pop(request['id'], None)
+            for pipe in parents:
+                if pipe is not None:
+                    pipe.close()
+            raise
+        finally:
+            for fd in to_close:
+                os.close(fd)
+
+        event.wait()
+        reply = slot[1]
+        if 'error' in reply:
+            for pipe in parents:
+                if pipe is not None:
+                    pipe.close()
+            errno = reply.get('errno')
+            if errno:
+                raise OSError(errno, reply['error'], args[0])
+            raise OSError(reply['error'])
+        proc = _HelperProcess(args, reply['pid'], parents[0], parents[1])
+        with self._lock:
+            returncode = self._exits.pop(request['id'], None)
+            if returncode is not None:
+                proc._set_returncode(returncode)
+            else:
+                self._procs[request['id']] = proc
+        return proc
+
+    def close(self):
+        import socket
+        self._sock.shutdown(socket.SHUT_RDWR)     # wakes up the reader thread
+        self._sock.close()
+        self._proc.wait()
+
+
+def _helper_main(sock):
+    """Loop of the helper process: start commands, report their pids and exit codes"""
+    import json
+    import socket
+    for sig in _DEFAULT_SIGNALS:
+        signal.signal(sig, signal.SIG_DFL)
+    # Ctrl-C of the terminal is for the main process, which stops the helper by closing
+    # the socket. SIGINT is not ignored, as commands would inherit that.
+    os.setpgid(0, 0)
+    send_lock = threading.Lock()
+
+    def reply(message):
+        with send_lock:
+            sock.send(json.dumps(message).encode())
+
+    def wait_exit(request_id, proc):
+        reply(dict(id=request_id, returncode=proc.wait()))
+
+    env = None
+    while True:
+        try:
+            data, fds, _, _ = socket.recv_fds(sock, _MAX_REQUEST, 2)
+        except OSError:
+            break
+        if not data:
+            break
+        request = json.loads(data.decode())
+        env = request.get('env', env)
+        fds = list(fds)
+        outputs = []
+        for kind in request['outputs']:
+            outputs.append(
+                None if kind == 'inherit' else subprocess.STDOUT if kind == 'stdout'
+                else fds.pop(0))
+        try:
+            proc = subprocess.Popen(
+                request['args'], stdout=outputs[0], stderr=outputs[1], cwd=request['cwd'],
+                env=env, pass_fds=request['pass_fds'], close_fds=close_fds,
+                start_new_session=(sys.version_info < (3, 11)),
+                **(dict(process_group=0) if sys.version_info >= (3, 11) else {}))
+        except OSError as exc:
+            reply(dict(id=request['id'], error=str(exc), errno=exc.errno))
+            continue
+        finally:
+            for fd in outputs:
+                if fd not in (None, subprocess.STDOUT):
+                    os.close(fd)
+        reply(dict(id=request['id'], pid=proc.pid))
+        threading.Thread(target=wait_exit, args=(request['id'], proc), daemon=True).start()
+
+
+def configure(spawn_method='subprocess', keep_fds=False):
+    """Select how commands are started. The helper is started now, so call this
+    early, before the build file is loaded and after the jobserver is set up,
+    as the helper passes file descriptors it inherits.
+    keep_fds: do not close inherited file descriptors in commands"""
+    import socket
+    from plsmake import process
+    global method, close_fds, _helper
+    if spawn_method not in METHODS:
+        raise ValueError('unknown spawn method: %s' % (spawn_method,))
+    if spawn_method == 'helper' and not hasattr(socket, 'send_fds'):
+        logger.warning('spawn.unsupported', spawn_method=spawn_method)
+        spawn_method = 'posix_spawn'
+    # the helper also uses posix_spawn for commands too long to be sent to it
+    if spawn_method != 'subprocess' and not (
+            hasattr(os, 'posix_spawnp') and hasattr(os, 'waitstatus_to_exitcode')):
+        logger.warning('spawn.unsupported', spawn_method=spawn_method)
+        spawn_method = 'subprocess'
+    close_fds = not keep_fds
+    if spawn_method == 'helper' and _helper is None:
+        _helper = SpawnHelper(pass_fds=process.inherited_fds)
+    method = spawn_method
+    logger.info('spawn.configure', spawn_method=method, close_fds=close_fds)
+
+
+def shutdown():
+    global _helper, method
+    if _helper is not None:
+        _helper.close()
+        _helper = None
+    if method == 'helper':
+        method = 'subprocess'
+
+
+def spawn(args, stdout=None, stderr=None, pass_fds=(), group_options=None):
+    """Start a command in its own process group, return a Popen-like object"""
+    if method == 'posix_spawn':
+        return _posix_spawn(args, stdout=stdout, stderr=stderr, pass_fds=pass_fds)
+    if method == 'helper' and _helper is not None:
+        return _helper.spawn(args, stdout=stdout, stderr=stderr, pass_fds=pass_fds)
+    kwargs = dict(group_options or {})
+    if pass_fds:
+        kwargs['pass_fds'] = pass_fds
+    return subprocess.Popen(args, stdout=stdout, stderr=stderr, close_fds=close_fds, **kwargs)
+
+
+def _measure(count: int, jobs: int) -> float:
+    import concurrent.futures as cf
+
+    def run_one(_):
+        spawn(['true'], stdout=subprocess.PIPE).communicate()
+
+    start = time.monotonic()
+    with cf.ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(run_one, range(count)))
+    return count / (time.monotonic() - start)
+
+
+def main():
+    import argparse
+    global method
+    parser = argparse.ArgumentParser(description='measure spawn throughput of each method')
+    parser.add_argument('-n', type=int, default=500, help='number of commands per method')
+    parser.add_argument('-j', type=int, default=4, help='threads starting commands')
+    parser.add_argument(
+        '--ballast', type=int, default=0, metavar='MB',
+        help='memory touched by this process before measuring, like a big build graph')
+    option = parser.parse_args()
+
+    # the helper is started before the ballast, like plsmake starts it before loading
+    configure('helper')
+    available = method
+    ballast = [bytearray(b'x' * 1024 * 1024) for _ in range(option.ballast)]
+    try:
+        for name in METHODS:
+            if name == 'helper' and available != 'helper':
+                continue
+            method = name
+            print('%-12s %8.1f spawns/s (ballast %d MB)' % (
+                name, _measure(option.n, option.j), len(ballast)))
+    finally:
+        shutdown()
+
+
+if __name__ == '__main__':
+    main()
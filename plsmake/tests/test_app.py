@@ -1,9 +1,13 @@
 from contextlib import contextmanager
+import os
 
 import pytest
 
 import plsmake.app
-from plsmake.app import DuplicatedRule, load_string, resolve, execute
+from plsmake.app import (
+    DuplicatedRule, ParallelExecutor, load_string, resolve, execute, execute_parallel,
+    outdated_targets,
+)
 from plsmake.env import Env
 from plsmake.rule import Rule
 from plsmake.utils import func_name
@@ -143,6 +147,44 @@ def test_resolve():
             assert action is None
 
 
+def test_resolve_specific_action():
+    source = """
+from plsmake.api import *
+
+@action('{name}.o')
+def compile_object(env, depends, name):
+    pass
+
+@deps('lib_{name}.o')
+def lib_object(env, depends, name):
+    depends.append(name + '.c')
+
+@action('lib_{name}.o')
+def lib_object(env, depends, name):
+    pass
+    """
+    rule_list, env = load_string(source, Env())
+    result = resolve('lib_a.o', rule_list, env)
+    _, _, action, action_option = result['lib_a.o']
+    assert func_name(action) == 'lib_object'
+    assert action_option == dict(name='a')
+    assert result['a.c'][2] is None
+
+    _, _, action, action_option = resolve('b.o', rule_list, env)['b.o']
+    assert func_name(action) == 'compile_object'
+
+
+def test_resolve_specific_action_tie():
+    rules = [('{name}.o', 'by_suffix'), ('x.{ext}', 'by_prefix')]
+    for ordered in (rules, rules[::-1]):
+        source = 'from plsmake.api import *\n' + ''.join(
+            "@action('%s')\ndef %s(env, depends, **kwargs):\n    pass\n" % rule for rule in ordered)
+        rule_list, env = load_string(source, Env())
+        # equally specific, the first defined one wins
+        _, _, action, _ = resolve('x.o', rule_list, env)['x.o']
+        assert func_name(action) == ordered[0][1]
+
+
 @contextmanager
 def patch_multi(obj, pairs):
     olds = []
@@ -181,3 +223,491 @@ def test_execute():
     with patch_multi(plsmake.app, [('file_exist', file_exist), ('file_newer', file_newer)]):
         execute('test_asdf', result)
     assert compiled == ['asdf', 'haha']
+
+
+def test_outdated_targets():
+    file_times = {
+        'test_asdf': 400,
+        'test_asdf.o': 100,
+        'test_asdf.c': 50,
+        'asdf.o': 200,
+        'asdf.c': 300,
+    }
+
+    def file_exist(filename):
+        return filename in file_times
+
+    def file_newer(f1, f2):
+        return file_times[f1] > file_times[f2]
+
+    compiled = []
+    init_env = Env()
+    init_env['CFLAGS'] = []
+    ns = dict(compiled=compiled, file_times=file_times)
+    rule_list, env = load_string(TEST_SOURCE, init_env, exec_ns=ns)
+    result = resolve('test_asdf', rule_list, env)
+    with patch_multi(plsmake.app, [('file_exist', file_exist), ('file_newer', file_newer)]):
+        # test_asdf is newer than its dependencies, but asdf.o is out of date
+        assert outdated_targets('test_asdf', result) == ['asdf.o', 'test_asdf']
+        assert outdated_targets('test_asdf', result, always_make=True) == [
+            'test_asdf.o', 'asdf.o', 'test_asdf']
+    assert compiled == []
+
+
+RESTAT_SOURCE = """
+from plsmake.api import *
+
+@deps('gen.h')
+def gen(env, depends):
+    depends.append('gen.txt')
+
+@action('gen.h', restat=True)
+def gen(env, depends):
+    compiled.append('gen.h')
+    with open('gen.txt') as fp:
+        content = fp.read().strip()
+    try:
+        with open('gen.h') as fp:
+            if fp.read() == content:
+                return  # unchanged, keep mtime
+    except FileNotFoundError:
+        pass
+    with open('gen.h', 'wt') as fp:
+        fp.write(content)
+
+@deps('main.o')
+def main(env, depends):
+    depends.append('gen.h')
+
+@action('main.o')
+def main(env, depends):
+    compiled.append('main.o')
+    open('main.o', 'wt').close()
+"""
+
+
+def test_restat(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(plsmake.app.stat_cache, 'floors', {})
+
+    def touch(filename, content, mtime):
+        with open(filename, 'wt') as fp:
+            fp.write(content)
+        os.utime(filename, ns=(mtime, mtime))
+
+    compiled = []
+    rule_list, env = load_string(RESTAT_SOURCE, Env(), exec_ns=dict(compiled=compiled))
+    result = resolve('main.o', rule_list, env)
+    touch('gen.txt', 'a', 10 ** 9)
+    execute('main.o', result)
+    assert compiled == ['gen.h', 'main.o']
+
+    # gen.h is regenerated with the same content
+    touch('gen.txt', 'a', 2 ** 62)
+    execute('main.o', result)
+    assert compiled == ['gen.h', 'main.o', 'gen.h']
+    assert plsmake.app.stat_cache.floors['gen.h'] == 2 ** 62
+    execute('main.o', result)
+    assert compiled == ['gen.h', 'main.o', 'gen.h']
+
+
+GROUP_SOURCE = """
+import threading
+from plsmake.api import *
+
+@deps('{name}.h', '{name}.cc')
+def gen(env, depends, name):
+    depends.append(name + '.proto')
+
+@gen.action
+def gen(env, depends, name):
+    compiled.append(name + '.proto')
+    for suffix in ('.h', '.cc'):
+        open(name + suffix, 'wt').close()
+
+@deps('{name}.o')
+def obj(env, depends, name):
+    depends.append(name + '.c')
+
+@batch_action('{name}.o', size=2)
+def obj(batch):
+    compiled.append(sorted(item.target for item in batch))
+    for item in batch:
+        assert item.depends == [item.option['name'] + '.c']
+        open(item.target, 'wt').close()
+
+@deps('all')
+def all(env, depends):
+    depends.extend(['a.o', 'b.o', 'c.o', 'a.h', 'a.cc', 'b.cc', 'b.h'])
+
+@task('all')
+def all(env, depends):
+    pass
+"""
+
+
+def test_group_and_batch(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for filename in ['a.proto', 'b.proto', 'a.c', 'b.c', 'c.c']:
+        open(filename, 'wt').close()
+
+    compiled = []
+    rule_list, env = load_string(GROUP_SOURCE, Env(), exec_ns=dict(compiled=compiled))
+    result = resolve('all', rule_list, env)
+    execute_parallel('all', result, 4)
+    assert sorted(c for c in compiled if isinstance(c, str)) == ['a.proto', 'b.proto']
+
+    compiled.clear()
+    execute_parallel('all', result, 1, always_make=True)
+    assert sorted(c for c in compiled if isinstance(c, str)) == ['a.proto', 'b.proto']
+    batches = [c for c in compiled if isinstance(c, list)]
+    assert sorted(sum(batches, [])) == ['a.o', 'b.o', 'c.o']
+    assert max(len(batch) for batch in batches) <= 2
+
+    controller = ParallelExecutor(result)
+    pending = ['a.o', 'a.h', 'b.o', 'c.o']
+    assert controller._group_pending(pending, 1, 16) == [['a.h'], ['a.o', 'b.o'], ['c.o']]
+    assert controller._group_pending(pending, 4, 16) == [['a.h'], ['a.o'], ['b.o'], ['c.o']]
+
+    compiled.clear()
+    execute('all', result, always_make=True)
+    assert sorted(c for c in compiled if isinstance(c, str)) == ['a.proto', 'b.proto']
+
+
+def test_parallel_fail_fast(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    source = """
+from plsmake.api import *
+
+@deps('all')
+def all(env, depends):
+    depends.extend(['slow', 'fail'])
+
+@task('all')
+def all(env, depends):
+    pass
+
+@task('slow')
+def slow(env, depends):
+    run('sh', '-c', 'sleep 30 & echo $! > child.pid; wait')
+
+@task('fail')
+def fail(env, depends):
+    import time
+    while not os.path.exists('child.pid'):
+        time.sleep(0.01)
+    run('false')
+"""
+    import subprocess
+    import time
+    from plsmake.process import children
+    rule_list, env = load_string(source, Env(), exec_ns=dict(os=os))
+    result = resolve('all', rule_list, env)
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        execute_parallel('all', result, 2)
+    assert time.monotonic() - start < 10
+    assert not children.stopping
+
+    # the grandchild in the same process group is killed too
+    with open('child.pid') as fp:
+        pid = int(fp.read())
+    for _ in range(100):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        assert False, 'process is alive'
+
+
+def test_parallel_fail_no_wait(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    source = """
+from plsmake.api import *
+
+@deps('all')
+def all(env, depends):
+    depends.extend(['python', 'fail'])
+
+@task('all')
+def all(env, depends):
+    pass
+
+@task('python')
+def python(env, depends):
+    started.set()
+    release.wait(10)
+    try:
+        run('touch', 'late')
+    except Exception as exc:
+        errors.append(exc)
+    finished.set()
+
+@task('fail')
+def fail(env, depends):
+    started.wait(10)
+    run('false')
+"""
+    import subprocess
+    import threading
+    from plsmake.process import BuildAborted, run_command
+    ns = dict((name, threading.Event()) for name in ('started', 'release', 'finished'))
+    ns['errors'] = []
+    rule_list, env = load_string(source, Env(), exec_ns=ns)
+    result = resolve('all', rule_list, env)
+    # the build fails without waiting for the python action
+    with pytest.raises(subprocess.CalledProcessError):
+        execute_parallel('all', result, 2)
+    assert not ns['finished'].is_set()
+
+    # commands can be started again, except by the action left from the failed run
+    assert run_command(['true']) == 0
+    ns['release'].set()
+    assert ns['finished'].wait(10)
+    assert [type(exc) for exc in ns['errors']] == [BuildAborted]
+    assert not tmpdir.join('late').exists()
+
+
+def test_parallel_failed_first(tmpdir, monkeypatch):
+    from plsmake.db import BuildDB
+    monkeypatch.chdir(tmpdir)
+    source = """
+from plsmake.api import *
+
+@deps('all')
+def all(env, depends):
+    depends.extend(['a.o', 'b.o', 'c.o', 'd.o'])
+
+@task('all')
+def all(env, depends):
+    pass
+
+@deps('{name}.o')
+def obj(env, depends, name):
+    depends.append(name + '.c')
+
+@action('{name}.o')
+def obj(env, depends, name):
+    built.append(name)
+    if name in fail:
+        raise RuntimeError(name)
+    open(name + '.o', 'w').close()
+"""
+    for name in 'abcd':
+        tmpdir.join(name + '.c').ensure()
+        os.utime(name + '.c', ns=(10 ** 9, 10 ** 9))
+    built, fail = [], {'c'}
+    rule_list, env = load_string(source, Env(), exec_ns=dict(built=built, fail=fail))
+    result = resolve('all', rule_list, env)
+    db = BuildDB('build.json')
+    with pytest.raises(RuntimeError):
+        execute_parallel('all', result, 1, db=db)
+    assert built == ['a', 'b', 'c']
+    assert list(db.failures) == ['c.o']
+
+    built.clear()
+    fail.clear()
+    db.last_run = 2 * 10 ** 9
+    os.utime('d.c', ns=(3 * 10 ** 9, 3 * 10 ** 9))
+    execute_parallel('all', result, 1, always_make=True, failed_first=True, db=db)
+    assert built[:2] == ['c', 'd'] or built[:2] == ['d', 'c']
+    assert db.failures == {}
+
+
+def test_load_file_code_cache(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    with open('Plsmakefile.py', 'wt') as fp:
+        fp.write("""
+from plsmake.api import *
+
+include('sub.py', prefix='sub/')
+
+@deps('all')
+def all(env, depends):
+    depends.append('sub/x')
+""")
+    with open('sub.py', 'wt') as fp:
+        fp.write("""
+from plsmake.api import *
+
+get_env()['SUB'] = 'sub'
+
+@deps('sub/{name}')
+def sub(env, depends, name):
+    depends.append(name + '.c')
+""")
+
+    rule_list, env = plsmake.app.load_file('Plsmakefile.py', Env())
+    assert list(rule_list) == [Rule('all')]
+    result = resolve('all', rule_list, env)
+    assert [Rule('all'), Rule('sub/{name}')] == list(rule_list)
+    assert result['sub/x'][0] == ['x.c']
+    assert env['SUB'] == 'sub'
+    assert len(os.listdir(plsmake.app.CODE_CACHE_DIR)) == 2
+
+    # loaded from cache
+    compile_calls = []
+
+    def compile_patched(*args):
+        compile_calls.append(args)
+        return compile(*args)
+
+    monkeypatch.setattr(plsmake.app, 'compile', compile_patched, raising=False)
+    plsmake.app.load_file('Plsmakefile.py', Env())
+    assert compile_calls == []
+
+    with open('Plsmakefile.py', 'at') as fp:
+        fp.write('\n')
+    plsmake.app.load_file('Plsmakefile.py', Env())
+    assert len(compile_calls) == 1
+
+
+def test_parallel_pool(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    source = """
+from plsmake.api import *
+set_pool('test_link', 1)
+
+@deps('all')
+def all(env, depends):
+    depends.extend(['a', 'b', 'c', 'x.o', 'y.o'])
+
+@task('all')
+def all(env, depends):
+    pass
+
+@action('{name}.o')
+def obj(env, depends, name):
+    track(name)
+    open(name + '.o', 'w').close()
+
+@action('{name}', pool='test_link')
+def link(env, depends, name):
+    track('link')
+    open(name, 'w').close()
+"""
+    import threading
+    import time
+    lock = threading.Lock()
+    running = dict()
+    peak = dict()
+
+    def track(name):
+        with lock:
+            running[name] = running.get(name, 0) + 1
+            peak[name] = max(peak.get(name, 0), running[name])
+        time.sleep(0.05)
+        with lock:
+            running[name] -= 1
+
+    rule_list, env = load_string(source, Env(), exec_ns=dict(track=track))
+    result = resolve('all', rule_list, env)
+    execute_parallel('all', result, 4, always_make=True)
+    assert peak == {'link': 1, 'x': 1, 'y': 1}
+
+    monkeypatch.setitem(plsmake.app.pool_sizes, 'test_link', 2)
+    peak.clear()
+    execute_parallel('all', result, 4, always_make=True)
+    assert peak['link'] == 2
+
+    monkeypatch.delitem(plsmake.app.pool_sizes, 'test_link')
+    with pytest.raises(ValueError):
+        execute_parallel('all', result, 4, always_make=True)
+
+
+def test_ready_groups(monkeypatch):
+    monkeypatch.setitem(plsmake.app.pool_sizes, 'test_link', 1)
+    ready = plsmake.app._ReadyGroups()
+    for i in range(1000):
+        ready.append(['link%d' % i], False, 'test_link')
+    ready.append(['a'], False, None)
+    ready.append(['b'], True, None)
+    ready.append(['c'], False, None)
+
+    def pop(running):
+        queue = ready.first(running)
+        return queue and queue.popleft()[1][0]
+
+    # hot first, then in order, groups of a full pool are skipped
+    assert pop(dict(test_link=1)) == 'b'
+    assert pop(dict(test_link=0)) == 'link0'
+    assert [pop(dict(test_link=1)) for _ in range(3)] == ['a', 'c', None]
+    assert ready
+
+
+def test_pool_reload(monkeypatch):
+    monkeypatch.setattr(plsmake.app, 'pool_sizes', dict())
+    monkeypatch.setattr(plsmake.app, '_fixed_pools', set())
+    plsmake.app.set_pool_size('link', 2, fixed=True)
+    load_string("from plsmake.api import *\nset_pool('link', 1)\nset_pool('test', 3)", Env())
+    assert plsmake.app.pool_sizes == {'link': 2, 'test': 3}
+
+    # e.g. watch mode re-loads the build file after set_pool() is removed
+    load_string("from plsmake.api import *", Env())
+    assert plsmake.app.pool_sizes == {'link': 2}
+
+
+def test_task_stamps(tmpdir, monkeypatch):
+    from plsmake.db import BuildDB
+    monkeypatch.chdir(tmpdir)
+    source = """
+from plsmake.api import *
+
+@task('gen-{name}', inputs=['schema/{name}/*.json'], outputs=['gen/{name}.py'])
+def gen(env, depends, name):
+    ran.append(name)
+    os.makedirs('gen', exist_ok=True)
+    open('gen/%s.py' % name, 'w').close()
+
+@task('always')
+def always(env, depends):
+    ran.append('always')
+"""
+    tmpdir.join('schema', 'api', 'a.json').ensure()
+    ran = []
+    db = BuildDB('build.json')
+
+    def load(target, env=Env()):
+        rule_list, env = load_string(source, env, exec_ns=dict(os=os, ran=ran))
+        return resolve(target, rule_list, env)
+
+    def build(target, env=Env()):
+        execute(target, load(target, env), db=db)
+
+    build('gen-api')
+    build('gen-api')
+    build('always')
+    build('always')
+    assert ran == ['api', 'always', 'always']
+
+    tmpdir.join('schema', 'api', 'a.json').write('{}')
+    build('gen-api')
+    tmpdir.join('schema', 'api', 'b.json').ensure()
+    build('gen-api')
+    os.remove('gen/api.py')
+    build('gen-api')
+    build('gen-api', env=Env(dict(SCHEMA_VERSION='2')))
+    build('gen-api', env=Env(dict(SCHEMA_VERSION='2', SHLVL='3')))
+    assert ran[3:] == ['api'] * 4
+
+    # -n and -q skip the task as well
+    env = Env(dict(SCHEMA_VERSION='2'))
+    assert outdated_targets('gen-api', load('gen-api', env), db=db) == []
+    assert outdated_targets('gen-api', load('gen-api', env)) == ['gen-api']
+    tmpdir.join('schema', 'api', 'a.json').write('{"a": 1}')
+    assert outdated_targets('gen-api', load('gen-api', env), db=db) == ['gen-api']
+    assert list(BuildDB('build.json').load().stamps) == []
+    db.save()
+    assert list(BuildDB('build.json').load().stamps) == ['gen-api']
+
+
+
+def test_api_star_import():
+    import glob
+    ns = dict(__name__='build')
+    load_string('import glob\nfrom plsmake.api import *\n', Env(), exec_ns=ns)
+    # only the helpers are imported, they do not shadow modules of build files
+    assert ns['glob'] is glob
+    assert 'glob_files' in ns and 'stat_cache' not in ns and 'record_input' not in ns
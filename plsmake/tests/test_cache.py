@@ -0,0 +1,196 @@
+import os
+
+import pytest
+
+from plsmake.app import load_string, resolve, execute
+from plsmake.cache import (
+    CacheBackend, HttpCache, LocalCache, TieredCache, action_key, parse_size,
+)
+from plsmake.cache_server import CacheServer
+from plsmake.env import Env
+
+
+SOURCE = """
+from plsmake.api import *
+
+@deps('{name}.o')
+def obj(env, depends, name):
+    depends.append(name + '.c')
+
+@action('{name}.o')
+def obj(env, depends, name):
+    compiled.append(name)
+    with open(name + '.c') as src, open(name + '.o', 'wt') as dst:
+        dst.write(env['CC'] + ' ' + src.read())
+"""
+
+
+def write(filename, content):
+    with open(filename, 'wt') as fp:
+        fp.write(content)
+
+
+def read(filename):
+    with open(filename, 'rt') as fp:
+        return fp.read()
+
+
+def test_parse_size():
+    assert parse_size('123') == 123
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5mb') == 1024 ** 2 * 3 // 2
+
+
+def test_cache_backend_abstract():
+    class Incomplete(CacheBackend):
+        def fetch(self, key, target):
+            return False
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_cache_restore(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    compiled = []
+    init_env = Env(dict(CC='cc'))
+    rule_list, env = load_string(SOURCE, init_env, exec_ns=dict(compiled=compiled))
+    cache = LocalCache(root='cache')
+
+    write('a.c', 'v1')
+    howto = resolve('a.o', rule_list, env)
+    key_v1 = action_key('a.o', howto)
+    execute('a.o', howto, cache=cache)
+    assert compiled == ['a']
+
+    write('a.c', 'v2')
+    assert action_key('a.o', howto) != key_v1
+    execute('a.o', howto, always_make=True, cache=cache)
+    assert compiled == ['a', 'a']
+    assert read('a.o') == 'cc v2'
+
+    # switch back
+    write('a.c', 'v1')
+    execute('a.o', howto, cache=cache)
+    assert compiled == ['a', 'a']
+    assert read('a.o') == 'cc v1'
+
+    # environment is part of key
+    env['CC'] = 'gcc'
+    howto = resolve('a.o', rule_list, env)
+    execute('a.o', howto, always_make=True, cache=cache)
+    assert compiled == ['a', 'a', 'a']
+
+
+def test_cache_fetch_error(tmpdir, monkeypatch):
+    import errno
+    from plsmake import cache as cache_module
+    monkeypatch.chdir(tmpdir)
+    cache = LocalCache(root='cache')
+    write('out', 'content')
+    cache.store('key', 'out')
+
+    def clone_file(src, dst):
+        write(dst, 'partial')
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(cache_module, '_clone_file', clone_file)
+    assert not cache.fetch('key', 'restored')
+    assert sorted(os.listdir('.')) == ['cache', 'out']
+
+
+def test_cache_evict(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    cache = LocalCache(root='cache', max_size=250)
+    for i in range(5):
+        write('out', str(i) * 100)
+        cache.store('key%d' % i, 'out')
+        os.utime(cache._entry_path('key%d' % i), ns=(i, i))
+
+    assert cache._scan_size() <= 250
+    assert not cache.fetch('key0', 'out')
+    assert cache.fetch('key4', 'out')
+    assert read('out') == '4' * 100
+
+
+def test_http_cache(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    server = CacheServer(str(tmpdir.join('server')), quiet=True)
+    server.start_in_thread()
+    try:
+        remote = HttpCache(server.url + '/prefix', max_connections=2)
+        assert not remote.fetch('00' * 32, 'out')
+
+        write('out', 'content')
+        remote.store('01' * 32, 'out')
+        remote.close()
+
+        remote = HttpCache(server.url + '/prefix')
+        local = LocalCache(root='cache')
+        tiered = TieredCache(local, remote)
+        assert tiered.fetch('01' * 32, 'restored')
+        assert read('restored') == 'content'
+        assert local.fetch('01' * 32, 'restored2')
+        tiered.close()
+
+        # unreachable server falls back to cache miss
+        down = HttpCache('http://127.0.0.1:1')
+        assert not down.fetch('01' * 32, 'out')
+        down.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_cache_reconnect(tmpdir, monkeypatch):
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    monkeypatch.chdir(tmpdir)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path.endswith('bad'):
+                self.wfile.write(b'garbage\r\n')
+            else:
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+            # close without telling the client, like an idle keep-alive timeout
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        remote = HttpCache('http://127.0.0.1:%d' % (server.server_port,))
+        assert remote.fetch('01' * 32, 'out')
+        # the pooled connection is stale, a new one is used
+        assert remote.fetch('02' * 32, 'out')
+        assert read('out') == 'ok'
+        # http.client errors are cache misses too
+        assert not remote.fetch('bad', 'out')
+        remote.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_action_key_env(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    write('a.c', 'v1')
+
+    def key(init, source=SOURCE):
+        rule_list, env = load_string(source, Env(init), exec_ns=dict(compiled=[]))
+        return action_key('a.o', resolve('a.o', rule_list, env))
+
+    base = key(dict(CC='cc', HOME='/home/a', CI_JOB_ID='1'))
+    # inherited variables unrelated to the build do not change the key
+    assert key(dict(CC='cc', HOME='/home/b', CI_JOB_ID='2')) == base
+    assert key(dict(CC='clang', HOME='/home/a')) != base
+    # variables set by the build file do
+    assert key(dict(CC='cc'), SOURCE + "get_env()['MODE'] = 'debug'\n") != base
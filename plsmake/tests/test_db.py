@@ -0,0 +1,22 @@
+from plsmake.db import BuildDB
+
+
+def test_build_db(tmpdir):
+    filename = str(tmpdir.join('sub', 'build.json'))
+    db = BuildDB(filename).load()
+    assert db.get_duration('a') is None
+    db.record_duration('a', 1.5)
+    db.record_failure('b')
+    db.record_failure('c')
+    db.clear_failure('c')
+    db.last_run = 123
+    db.save()
+
+    db = BuildDB(filename).load()
+    assert db.get_duration('a') == 1.5
+    assert list(db.failures) == ['b']
+    assert db.last_run == 123
+
+    with open(filename, 'wt') as fp:
+        fp.write('{corrupted')
+    assert BuildDB(filename).load().durations == {}
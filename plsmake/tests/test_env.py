@@ -74,3 +74,21 @@ class TestEnv(unittest.TestCase):
 
         assert dict(self.child.local_items()) == dict(b='bb', c='c', a=None)
         assert dict(self.parent.local_items()) == parent_dict
+
+    def test_changed_keys(self):
+        self.child['c'] = 'c'
+        del self.child['a']
+        grandchild = self.child.make_child()
+        grandchild['d'] = 'd'
+        assert grandchild.changed_keys() == {'a', 'c', 'd'}
+        assert self.parent.changed_keys() == set()
+
+    def test_track_reads(self):
+        self.child.track_reads()
+        self.child['c'] = 'c'
+        assert self.child['c'] == 'c'
+        self.child['list'].append(3)
+        assert self.child.get('xxx') is None
+        assert self.child.lookup('list2') == [1, 2, 3]
+        assert self.child.stop_tracking() == {'list': '[1, 2]', 'xxx': '<missing>'}
+        assert self.child._reads is None
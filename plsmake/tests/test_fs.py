@@ -0,0 +1,42 @@
+import glob
+import os
+
+from plsmake.fs import StatCache
+
+
+def make_tree(tmpdir):
+    for path in ['a.c', 'b.cc', '.hidden.c', 'src/x.c', 'src/y.h', 'src/sub/z.c', 'src/.git/w.c']:
+        tmpdir.join(path).ensure()
+
+
+def test_glob(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    make_tree(tmpdir)
+    cache = StatCache()
+    for pattern in ['*.c', '*', '.*', 'src/*', 'src/*.[ch]', '**/*.c', '**', '*/*.c',
+                    'src/x.c', 'src/none.c', 'none/*.c', 'src/sub', str(tmpdir) + '/src/*.c']:
+        assert cache.glob(pattern) == sorted(glob.glob(pattern, recursive=True)), pattern
+    # glob.glob() returns 'src/' here
+    assert cache.glob('src/**') == ['src', 'src/sub', 'src/sub/z.c', 'src/x.c', 'src/y.h']
+
+
+def test_scandir_primes_stat(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    make_tree(tmpdir)
+    cache = StatCache()
+    listed = []
+    assert cache.glob('src/*.c', listed) == ['src/x.c']
+    assert listed == ['src']
+
+    os.remove('src/x.c')
+    tmpdir.join('src/new.c').ensure()
+    # listings are cached during a run
+    assert cache.glob('src/*.c') == ['src/x.c']
+    assert cache.is_file('src/x.c')
+
+    # stat results of listed entries are kept for the following build
+    cache.clear()
+    assert cache.is_file('src/x.c')
+    assert cache.glob('src/*.c') == ['src/new.c']
+    cache.clear()
+    assert not cache.is_file('src/x.c')
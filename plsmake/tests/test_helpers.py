@@ -1,6 +1,8 @@
+import os
 import unittest
 
-from plsmake.helpers import parse_make_deps, MakeDepsParser
+from plsmake.fs import CACHE_DIR
+from plsmake.helpers import extend_depends_by_compiler, get_deps_many, parse_make_deps, MakeDepsParser
 
 
 class TestParseMakeDeps(unittest.TestCase):
@@ -28,3 +30,27 @@ class TestParseMakeDepsAlt(TestParseMakeDeps):
 
     def method(self, s):
         return self.parser.parse(s)
+
+
+def test_get_deps_many(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    compiler = tmpdir.join('cxx')
+    compiler.write('#!/bin/sh\necho "$@" >> calls\necho "dummy: $4 common.h"\n')
+    compiler.chmod(0o755)
+    sources = ['a.c', 'b.c', 'c.c']
+    for name in sources + ['common.h']:
+        tmpdir.join(name).ensure()
+    env = dict(CXX=str(compiler), CXXFLAGS=[])
+
+    expect = dict((name, [name, 'common.h']) for name in sources)
+    assert get_deps_many(env, sources, jobs=2) == expect
+    assert len(tmpdir.join('calls').readlines()) == 3
+    assert sorted(os.listdir(os.path.join(CACHE_DIR))) == sorted(name + '.deps' for name in sources)
+
+    # cached
+    assert get_deps_many(env, sources) == expect
+    assert len(tmpdir.join('calls').readlines()) == 3
+
+    depends = ['b.c', 'x.o']
+    extend_depends_by_compiler(env, depends)
+    assert depends == ['b.c', 'x.o', 'common.h']
@@ -0,0 +1,92 @@
+import os
+
+import plsmake.app
+from plsmake.app import load_string, resolve
+from plsmake.env import Env
+from plsmake.incremental import ResolveMemo
+
+
+SOURCE = """
+from plsmake.api import *
+from plsmake.app import record_input
+
+@deps('app')
+def app(env, depends):
+    calls.append('app')
+    env['LDFLAGS'] += ['-lm']
+    depends.extend(['a.o', 'b.o'])
+
+@deps('{name}.o')
+def obj(env, depends, name):
+    calls.append(name)
+    record_input(name + '.list')
+    with open(name + '.list') as fp:
+        depends.extend(fp.read().split())
+    if env['DEBUG']:
+        env['CFLAGS'] += ['-g']
+"""
+
+
+def resolve_deps(howto):
+    return dict((target, (deps, dict(env.items()))) for target, (deps, env, _, _) in howto.items())
+
+
+def test_resolve_memo(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for name in 'ab':
+        tmpdir.join(name + '.list').write(name + '.c')
+
+    calls = []
+    init = Env(dict(DEBUG='', CFLAGS=[], LDFLAGS=[]))
+    rule_list, env = load_string(SOURCE, init, exec_ns=dict(calls=calls))
+    memo = ResolveMemo('memo')
+    expect = resolve_deps(resolve('app', rule_list, env))
+    assert calls == ['app', 'a', 'b']
+    memo_result = resolve('app', rule_list, env, memo=memo)
+    assert resolve_deps(memo_result) == expect
+    memo.save()
+
+    calls.clear()
+    memo = ResolveMemo('memo').load()
+    assert resolve_deps(resolve('app', rule_list, env, memo=memo)) == expect
+    assert calls == []
+    assert memo.hits == 5
+
+    # the replayed env is not shared with memo
+    memo_result['a.o'][1]['CFLAGS'].append('-O2')
+    assert resolve_deps(resolve('app', rule_list, env, memo=memo)) == expect
+
+    # changed file
+    tmpdir.join('b.list').write('b.c b.h')
+    os.utime('b.list', ns=(1, 1))
+    resolve('app', rule_list, env, memo=memo)
+    assert calls == ['b']
+
+    # changed env
+    calls.clear()
+    env['DEBUG'] = '1'
+    howto = resolve('app', rule_list, env, memo=memo)
+    assert calls == ['a', 'b']
+    assert howto['a.o'][1]['CFLAGS'] == ['-g']
+    assert howto['b.o'][0] == ['b.c', 'b.h']
+
+
+def test_resolve_memo_glob(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('src/a.c').ensure()
+    source = """
+from plsmake.api import *
+
+@deps('app')
+def app(env, depends):
+    depends.extend(glob_files('src/*.c'))
+"""
+    rule_list, env = load_string(source, Env())
+    memo = ResolveMemo('memo')
+    assert resolve('app', rule_list, env, memo=memo)['app'][0] == ['src/a.c']
+
+    tmpdir.join('src/b.c').ensure()
+    os.utime('src', ns=(1, 1))
+    plsmake.app.stat_cache.clear()
+    assert resolve('app', rule_list, env, memo=memo)['app'][0] == ['src/a.c', 'src/b.c']
+    assert memo.hits == 1   # src/a.c
@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+import time
+
+from plsmake import jobserver, process
+from plsmake.app import Action, ParallelExecutor
+from plsmake.process import run_command
+
+
+def test_parse_makeflags():
+    assert jobserver.parse_makeflags('') is None
+    assert jobserver.parse_makeflags(' -j4') is None
+    assert jobserver.parse_makeflags(' -j4 --jobserver-fds=3,4 --jobserver-auth=5,6') == '5,6'
+    assert jobserver.parse_makeflags('-j --jobserver-auth=fifo:/tmp/GMfifo1') == 'fifo:/tmp/GMfifo1'
+
+
+def test_client_tokens():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'ab')
+    client = jobserver.JobServerClient.from_auth('%d,%d' % (read_fd, write_fd))
+    assert client.try_acquire() and client.try_acquire()
+    assert not client.try_acquire()
+    assert client.held == 2
+    client.release()
+    client.release()
+    assert client.held == 0
+    assert sorted(os.read(read_fd, 2)) == sorted(b'ab')
+
+
+def test_client_setup(monkeypatch):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'+')
+    monkeypatch.setenv('MAKEFLAGS', ' -j4 --jobserver-auth=%d,%d' % (read_fd, write_fd))
+    monkeypatch.setattr(jobserver, 'client', None)
+    monkeypatch.setattr(process, 'inherited_fds', ())
+    client = jobserver.setup(None)
+    assert jobserver.client is client
+    assert process.inherited_fds == (read_fd, write_fd)
+
+    # a sub-make can use the pipe of parent make
+    out = run_command([sys.executable, '-c', (
+        'import os, sys; sys.stdout.write(os.read(%d, 1).decode())' % (read_fd,)
+    )], want_stdout=True)
+    assert out == b'+'
+
+
+def test_server(monkeypatch, tmpdir):
+    monkeypatch.setenv('MAKEFLAGS', 'k -j8')
+    monkeypatch.setattr(jobserver, 'client', None)
+    monkeypatch.setattr(process, 'inherited_fds', ())
+    server = jobserver.setup(2)
+    assert jobserver.client is server
+    assert os.environ['MAKEFLAGS'].startswith('k -j2 --jobserver-auth=')
+
+    # a command can take the token of the pool
+    out = run_command([sys.executable, '-c', (
+        'import os, sys; fd = os.environ["MAKEFLAGS"].split("=")[1].split(",")[0]; '
+        'sys.stdout.write(os.read(int(fd), 1).decode())'
+    )], want_stdout=True)
+    assert out == b'+'
+    assert not server.try_acquire()
+    os.write(server.write_fd, b'+')
+
+    # jobs beyond the first one are limited by tokens
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def work(env, depends):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    action = Action(work, is_task=True)
+    howto = dict(('t%d' % i, ([], None, action, {})) for i in range(6))
+    controller = ParallelExecutor(howto)
+    for target in howto:
+        controller.add_target(target)
+    controller.start(4)
+    assert running[1] == 2
+    assert server.held == 0
+    assert server.try_acquire()
@@ -0,0 +1,30 @@
+import threading
+
+import pytest
+
+from plsmake.log import AsyncLogWriter, read_log
+
+
+@pytest.mark.parametrize('fmt', ['json', 'ndjson-interned'])
+def test_async_log_writer(tmpdir, fmt):
+    filename = str(tmpdir.join('log'))
+    writer = AsyncLogWriter(filename, fmt=fmt, flush_interval=0.01, batch_size=16)
+
+    def log(thread_id):
+        for i in range(100):
+            writer(None, 'info', dict(event='test', thread=thread_id, i=i, obj=object()))
+
+    threads = [threading.Thread(target=log, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+    writer(None, 'info', dict(event='after_close'))
+
+    events = list(read_log(filename))
+    assert len(events) == 400
+    for n in range(4):
+        assert [e['i'] for e in events if e['thread'] == n] == list(range(100))
+    assert events[0]['event'] == 'test'
+    assert events[0]['obj'].startswith('<object')
@@ -0,0 +1,51 @@
+import io
+import sys
+
+from plsmake import output
+from plsmake.app import load_string, resolve, execute_parallel
+from plsmake.env import Env
+
+
+SOURCE = """
+import sys
+from plsmake.api import *
+
+@deps('all')
+def all(env, depends):
+    depends.extend(['t%d' % i for i in range(8)])
+
+@task('all')
+def all(env, depends):
+    pass
+
+@task('t{n}')
+def t(env, depends, n):
+    # whole lines are written at once, stdout and stderr are read from separate pipes
+    line = n + ' %d\\n'
+    code = 'import sys\\nfor i in range(50): [sys.stdout, sys.stderr][i %% 2].write(%r %% i)' % line
+    run(sys.executable, '-c', code)
+    if n == '3':
+        out = run_with_output(sys.executable, '-c', 'print("hidden")')
+        assert out.strip() == b'hidden'
+"""
+
+
+def test_capture_output():
+    stream = io.TextIOWrapper(io.BytesIO(), write_through=True)
+    output.enable(progress=True, stream=stream)
+    try:
+        rule_list, env = load_string(SOURCE, Env())
+        result = resolve('all', rule_list, env)
+        execute_parallel('all', result, 8)
+    finally:
+        output.disable()
+
+    lines = stream.buffer.getvalue().decode().splitlines()
+    assert 'hidden' not in lines
+    for n in range(8):
+        block = [line for line in lines if line.split()[0] == str(n)]
+        assert len(block) == 50
+        start = lines.index(block[0])
+        # output of a target is not interleaved
+        assert lines[start:start + 50] == block
+    assert lines[-1] == '[9/9] all'
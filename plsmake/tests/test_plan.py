@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from plsmake.app import load_string, resolve
+from plsmake.env import Env
+from plsmake.plan import (
+    NotRecordable, PlanRunner, load_plan, record_plan, save_plan, write_ninja,
+)
+
+
+SOURCE = """
+from plsmake.api import *
+
+@deps('app')
+def app(env, depends):
+    depends.extend(['a.o', 'b.o', 'version'])
+
+@action('app')
+def app(env, depends):
+    run('sh', '-c', 'cat a.o b.o > app')
+
+@deps('{name}.o')
+def obj(env, depends, name):
+    depends.append(name + '.c')
+
+@action('{name}.o')
+def obj(env, depends, name):
+    run('cp', name + '.c', name + '.o')
+
+@task('version')
+def version(env, depends):
+    run('sh', '-c', 'echo 1 >> version.log')
+
+@action('bad')
+def bad(env, depends):
+    run_with_output('echo')
+
+@action('python')
+def python(env, depends):
+    open('python', 'w').close()
+"""
+
+
+def test_plan(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('a.c').write('a')
+    tmpdir.join('b.c').write('b')
+    rule_list, env = load_string(SOURCE, Env())
+
+    plan = record_plan([('app', resolve('app', rule_list, env))])
+    assert not tmpdir.join('a.o').exists()
+    assert [entry['outputs'] for entry in plan['entries']] == [['a.o'], ['b.o'], ['version'], ['app']]
+    assert plan['entries'][0]['commands'] == [['cp', 'a.c', 'a.o']]
+    save_plan(plan, 'plan.json')
+
+    runner = PlanRunner(load_plan('plan.json'))
+    assert runner.build() == 4
+    assert tmpdir.join('app').read() == 'ab'
+    # only the task
+    assert PlanRunner(plan).build(['app']) == 1
+    assert tmpdir.join('version.log').read() == '1\n1\n'
+
+    os.utime('b.c', ns=(2 ** 62, 2 ** 62))
+    assert PlanRunner(plan).build(['app']) == 3
+
+    write_ninja(plan, 'build.ninja')
+    ninja = tmpdir.join('build.ninja').read()
+    assert 'build app: cmd a.o b.o || version\n  cmd = sh -c \'cat a.o b.o > app\'\n' in ninja
+    assert ninja.endswith('default app\n')
+
+    with pytest.raises(NotRecordable):
+        record_plan([('bad', resolve('bad', rule_list, env))])
+    with pytest.raises(NotRecordable):
+        record_plan([('python', resolve('python', rule_list, env))])
+
+
+def test_record_run_many(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    source = """
+from plsmake.api import *
+
+@action('objs')
+def objs(env, depends):
+    run_many([['cp', 'a.c', 'a.o'], ['cp', 'b.c', 'b.o']])
+    run('sh', '-c', 'cat a.o b.o > objs')
+
+@action('bad')
+def bad(env, depends):
+    run_many([['echo']], want_stdout=True)
+"""
+    tmpdir.join('a.c').write('a')
+    tmpdir.join('b.c').write('b')
+    rule_list, env = load_string(source, Env())
+
+    plan = record_plan([('objs', resolve('objs', rule_list, env))])
+    assert not tmpdir.join('a.o').exists()
+    assert plan['entries'][0]['commands'] == [
+        ['cp', 'a.c', 'a.o'], ['cp', 'b.c', 'b.o'], ['sh', '-c', 'cat a.o b.o > objs']]
+    assert PlanRunner(plan).build() == 1
+    assert tmpdir.join('objs').read() == 'ab'
+
+    with pytest.raises(NotRecordable):
+        record_plan([('bad', resolve('bad', rule_list, env))])
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+
+import pytest
+
+from plsmake import jobserver
+from plsmake.process import CommandsFailed, run_many
+
+
+def py(code):
+    return [sys.executable, '-c', code]
+
+
+def test_run_many(capfd):
+    results = run_many([py('print("a")'), py('import sys; sys.exit(3)')], check=False)
+    assert [r.returncode for r in results] == [0, 3]
+    assert results[0].output.strip() == b'a' and results[0].stdout is None
+    assert 'a' in capfd.readouterr().err
+
+    results = run_many([py('print("b")')], want_stdout=True)
+    assert results[0].stdout.strip() == b'b'
+    assert run_many([]) == []
+
+
+def test_run_many_fail_fast():
+    start = time.monotonic()
+    commands = [py('import time; time.sleep(30)'), py('import sys; sys.exit(2)')]
+    commands += [py('pass')] * 3
+    with pytest.raises(CommandsFailed) as exc_info:
+        run_many(commands, jobs=2)
+    assert time.monotonic() - start < 10
+    assert exc_info.value.returncode == 2
+    results = exc_info.value.results
+    assert results[0].returncode != 0
+    assert results[2:] == [None] * 3
+
+
+def test_run_many_jobserver(monkeypatch, tmpdir):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'++')
+    client = jobserver.JobServerClient(read_fd, write_fd)
+    monkeypatch.setattr(jobserver, 'client', client)
+
+    # each command appends its start and end time, 3 run at once with 2 tokens
+    log = str(tmpdir.join('log'))
+    code = (
+        'import time; t = time.time(); time.sleep(0.3); '
+        'open(%r, "a").write("%%f %%f\\n" %% (t, time.time()))' % (log,))
+    run_many([py(code)] * 6)
+    with open(log) as fp:
+        spans = [tuple(map(float, line.split())) for line in fp]
+    peak = max(sum(1 for s, e in spans if s <= t < e) for t, _ in spans)
+    assert peak == 3
+    assert client.held == 0
+    assert os.read(read_fd, 8) == b'++'
@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from plsmake.app import load_string, resolve, execute_parallel
+from plsmake.cache import file_digest
+from plsmake.env import Env
+from plsmake.remote import CHUNK_SIZE, ProtocolError, RemoteCommandError, WorkerPool
+from plsmake.worker import WorkerServer
+
+
+SOURCE = """
+from plsmake.api import *
+
+@deps('app')
+def app(env, depends):
+    depends.extend(['out/a.o', 'out/b.o', 'gen.h', 'stamp'])
+
+@action('app', remote=True)
+def app(env, depends):
+    run('sh', '-c', 'cat out/a.o out/b.o gen.h > app')
+
+@deps('out/{name}.o')
+def obj(env, depends, name):
+    depends.append(name + '.c')
+
+@action('out/{name}.o', remote=True)
+def obj(env, depends, name):
+    run('sh', '-c', 'tr a-z A-Z < %s.c > out/%s.o' % (name, name))
+
+@action('gen.h')
+def gen(env, depends):
+    local_pids.append(os.getpid())
+    with open('gen.h', 'w') as fp:
+        fp.write('gen')
+
+@action('stamp', remote=True)
+def stamp(env, depends):
+    open('stamp', 'w').close()
+"""
+
+
+def test_remote_build(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    servers = [
+        WorkerServer(str(tmpdir.join('w1')), slots=1),
+        WorkerServer(str(tmpdir.join('w2')), address='unix:' + str(tmpdir.join('w2.sock'))),
+    ]
+    for server in servers:
+        server.start_in_thread()
+    tmpdir.join('a.c').write('a')
+    tmpdir.join('b.c').write('b')
+
+    pool = WorkerPool([server.address for server in servers])
+    try:
+        assert pool.slots == 1 + servers[1].slots
+        local_pids = []
+        rule_list, env = load_string(SOURCE, Env(), exec_ns=dict(local_pids=local_pids, os=os))
+        result = resolve('app', rule_list, env)
+        execute_parallel('app', result, 4, remote=pool)
+        assert tmpdir.join('app').read() == 'ABgen'
+        assert local_pids == [os.getpid()]
+        assert tmpdir.join('stamp').check()     # no command, run locally
+        assert any(file_digest('app') in worker.known for worker in pool.workers)
+        # inputs are only sent once
+        assert all(len(worker.known) >= 2 for worker in pool.workers if worker.known)
+
+        # prefer the worker having inputs
+        digests = dict((digest, 1) for digest in pool.workers[1].known)
+        assert pool._acquire(digests) is pool.workers[1]
+        pool._release(pool.workers[1])
+
+        with pytest.raises(RemoteCommandError):
+            pool.run_commands('x', [['sh', '-c', 'echo oops; exit 3']], [], ['x'])
+    finally:
+        pool.close()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_worker_token(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    with pytest.raises(ValueError):
+        WorkerServer(str(tmpdir.join('w')), address='0.0.0.0:0')
+
+    server = WorkerServer(str(tmpdir.join('w')), address='0.0.0.0:0', token='secret')
+    server.start_in_thread()
+    address = '127.0.0.1:%d' % (server.server_address[1],)
+    try:
+        for token in (None, 'wrong'):
+            with pytest.raises(ProtocolError):
+                WorkerPool([address], token=token)
+        pool = WorkerPool([address], token='secret')
+        pool.run_commands('x', [['sh', '-c', 'echo x > x']], [], ['x'])
+        pool.close()
+        assert open('x').read() == 'x\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_transfer(tmpdir, monkeypatch):
+    import socket
+    monkeypatch.chdir(tmpdir)
+    server = WorkerServer(str(tmpdir.join('w')))
+    server.start_in_thread()
+    # several chunks each way
+    data = os.urandom(CHUNK_SIZE * 3 + 1)
+    tmpdir.join('big.in').write_binary(data)
+    pool = WorkerPool([server.address])
+    try:
+        pool.run_commands('big', [['sh', '-c', 'cat big.in big.in > big']], ['big.in'], ['big'])
+        assert tmpdir.join('big').read_binary() == data * 2
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+    # a worker not answering
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    try:
+        with pytest.raises(socket.timeout):
+            WorkerPool(['127.0.0.1:%d' % (listener.getsockname()[1],)], timeout=0.1)
+    finally:
+        listener.close()
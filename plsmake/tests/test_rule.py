@@ -1,4 +1,4 @@
-from plsmake.rule import Rule
+from plsmake.rule import Rule, RuleDispatcher, most_specific
 
 
 def test_rule_match():
@@ -16,3 +16,24 @@ def test_rule_match():
 def test_rule_eq_hash():
     assert Rule('asdf') == Rule('asdf')
     assert hash(Rule('bbb')) == hash(Rule('bbb'))
+
+
+def test_rule_dispatcher():
+    rules = [Rule(url) for url in ['{name}.o', 'lib_{name}.o', 'lib_a.o', 'lib{x}_{y}.o', 'x{a}{a}', 'app']]
+    dispatcher = RuleDispatcher(rules)
+
+    def M(target):
+        return [(str(rule), params) for rule, params in dispatcher.match(target)]
+
+    assert M('lib_a.o') == [
+        ('{name}.o', dict(name='lib_a')), ('lib_{name}.o', dict(name='a')), ('lib_a.o', dict()),
+    ]
+    assert M('lib1_b.o') == [('{name}.o', dict(name='lib1_b')), ('lib{x}_{y}.o', dict(x='1', y='b'))]
+    assert M('x12') == [('x{a}{a}', dict(a='2'))]
+    assert M('app') == [('app', dict())]
+    assert M('app.c') == []
+    assert dispatcher.match('lib_a.o') is dispatcher.match('lib_a.o')
+
+    assert str(most_specific(rule for rule, _ in dispatcher.match('lib_a.o'))) == 'lib_a.o'
+    assert str(most_specific([Rule('{name}.o'), Rule('lib_{name}.o')])) == 'lib_{name}.o'
+    assert str(most_specific([Rule('{a}.{b}'), Rule('{a}_{b}')])) == '{a}.{b}'
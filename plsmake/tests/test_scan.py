@@ -0,0 +1,64 @@
+import shutil
+
+import pytest
+
+from plsmake.helpers import get_deps, get_deps_with_cxx
+from plsmake.scan import parse_include_flags, scan_includes
+
+
+FILES = {
+    'src/main.cc': '''
+#include <vector>
+#include "local.h"   // comment
+#include <lib/api.h>
+/* #include "commented.h" */
+  #  include "sub/x.h"
+#include "sys.h"
+const char *s = "/*";
+#include "after_string.h"
+''',
+    'src/local.h': '#pragma once\n#include "sub/x.h"\n',
+    'src/sub/x.h': '#ifndef X_H\n#define X_H\n#include "y.h"\n#endif\n',
+    'src/sub/y.h': '',
+    'src/after_string.h': '',
+    'include/lib/api.h': '#pragma once\n#include "impl.h"\n',
+    'include/lib/impl.h': '#pragma once\n#include <lib/api.h>\n',
+    'system/sys.h': '#include <lib/api.h>\n',
+}
+FLAGS = ['-O2', '-Iinclude', '-isystem', 'system', '-DFOO']
+
+
+@pytest.fixture
+def tree(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for path, content in FILES.items():
+        tmpdir.join(path).write(content, ensure=True)
+    return tmpdir
+
+
+def test_parse_include_flags():
+    assert parse_include_flags(['-I', 'a', '-Ib', '-iquote', 'q', '-isystem/s', '-Wall']) == (
+        ('q',), ('a', 'b'), ('/s',))
+    assert parse_include_flags(['-include', 'config.h']) is None
+
+
+def test_scan_includes(tree):
+    expect = [
+        'src/main.cc', 'src/local.h', 'src/sub/x.h', 'src/sub/y.h',
+        'include/lib/api.h', 'include/lib/impl.h', 'src/after_string.h',
+    ]
+    assert scan_includes('src/main.cc', FLAGS) == expect
+    if shutil.which('c++'):
+        assert get_deps_with_cxx(dict(CXX='c++', CXXFLAGS=FLAGS), 'src/main.cc') == expect
+
+    # computed include
+    tree.join('src/sub/y.h').write('#include CONFIG_H\n')
+    assert scan_includes('src/main.cc', FLAGS) is None
+    # missing header
+    tree.join('src/sub/y.h').write('#include "gen.h"\n')
+    assert scan_includes('src/main.cc', FLAGS) is None
+
+
+def test_get_deps_builtin(tree):
+    env = dict(CXX='false', CXXFLAGS=FLAGS, DEPS_SCANNER='builtin')
+    assert get_deps(env, 'src/local.h') == ['src/local.h', 'src/sub/x.h', 'src/sub/y.h']
@@ -0,0 +1,53 @@
+import pytest
+
+from plsmake.app import Action
+from plsmake.db import BuildDB
+from plsmake.shard import merge_results, parse_shard, plan_shards
+
+
+def make_howto():
+    action = Action(lambda env, depends: None)
+    howto = dict()
+    howto['all'] = ['lib', 'app1', 'app2'], None, Action(lambda env, depends: None, is_task=True), {}
+    howto['lib'] = ['common.o'], None, action, {}
+    for app in ['app1', 'app2']:
+        objs = ['%s_%d.o' % (app, i) for i in range(8)]
+        howto[app] = objs + ['lib'], None, action, {}
+        for obj in objs:
+            howto[obj] = [obj[:-2] + '.c', 'common.h'], None, action, {}
+            howto[obj[:-2] + '.c'] = [], None, None, {}
+    howto['common.o'] = ['common.c', 'common.h'], None, action, {}
+    howto['common.c'] = howto['common.h'] = [], None, None, {}
+    return howto
+
+
+def test_parse_shard():
+    assert parse_shard('1/3') == (0, 3)
+    with pytest.raises(ValueError):
+        parse_shard('4/3')
+
+
+def test_plan_shards(tmpdir):
+    howto = make_howto()
+    assert merge_results([howto, {'x': 1}])['x'] == 1
+
+    db = BuildDB(str(tmpdir.join('db')))
+    db.record_duration('app1_0.o', 10.0)
+    shards = plan_shards(howto, ['all'], 3, db=db)
+    assert len(shards) == 3
+    units = sorted(sum((shard.units for shard in shards), []))
+    assert len(units) == len(set(units))
+    assert 'all' not in units and 'app1' not in units
+
+    built = set().union(*(shard.targets for shard in shards))
+    actions = set(target for target, (_, _, action, _) in howto.items() if action is not None)
+    assert built & actions == actions - {'all', 'app1', 'app2'}
+    # lib is built by the shard having common.o
+    assert 'lib' in built
+    costs = [shard.cost for shard in shards]
+    assert max(costs) <= 1.5 * sum(costs) / len(costs)
+    assert plan_shards(howto, ['all'], 3, db=db) == shards
+
+    # nothing to expand
+    shards = plan_shards(howto, ['common.o'], 2)
+    assert [shard.units for shard in shards] == [['common.o'], []]
@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from plsmake import spawn
+from plsmake.process import children, run_command
+
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='posix only')
+
+
+@pytest.fixture(params=spawn.METHODS)
+def method(request):
+    spawn.configure(request.param)
+    try:
+        yield spawn.method
+    finally:
+        spawn.shutdown()
+        spawn.method = 'subprocess'
+
+
+def test_run_command(method, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    out = run_command(
+        [sys.executable, '-c', 'import os, signal, sys; print(os.getpgrp() == os.getpid()); '
+                               'print(signal.getsignal(signal.SIGINT) == signal.SIG_IGN); '
+                               'sys.stderr.write("err")'], want_stdout=True)
+    assert out == b'True\nFalse\n'
+    assert run_command(['sh', '-c', 'echo x > out.txt']) == 0
+    assert tmpdir.join('out.txt').read() == 'x\n'
+    # longer than a message to the helper
+    out = run_command(['echo', 'x' * 100000], want_stdout=True)
+    assert len(out) == 100001
+
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        run_command(['sh', '-c', 'exit 3'])
+    assert exc_info.value.returncode == 3
+    with pytest.raises(OSError):
+        run_command(['plsmake-no-such-command'])
+
+
+def test_kill(method):
+    start = time.monotonic()
+    proc = children.spawn(['sleep', '30'], stdout=subprocess.PIPE)
+    children.terminate_all(timeout=5)
+    proc.communicate()
+    children.finished(proc)
+    children.reset()
+    assert proc.returncode == -15
+    assert time.monotonic() - start < 10
+
+
+@pytest.mark.parametrize('spawn_method', spawn.METHODS)
+def test_pass_fds(spawn_method, monkeypatch):
+    from plsmake import process
+    # the helper passes descriptors it has inherited, like the jobserver pipe
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setattr(process, 'inherited_fds', (write_fd,))
+    spawn.configure(spawn_method)
+    try:
+        run_command([sys.executable, '-c', 'import os; os.write(%d, b"token")' % (write_fd,)])
+    finally:
+        spawn.shutdown()
+        spawn.method = 'subprocess'
+    assert os.read(read_fd, 16) == b'token'
+
+
+def test_posix_spawn_fds(monkeypatch):
+    from plsmake import process
+    read_fd, write_fd = os.pipe()
+    leaked_fd = os.dup(write_fd)
+    os.set_inheritable(leaked_fd, True)     # e.g. inherited from the shell
+    monkeypatch.setattr(process, 'inherited_fds', (write_fd,))
+    code = 'import os, sys; os.fstat(int(sys.argv[1]))'
+    try:
+        spawn.configure('posix_spawn')
+        run_command([sys.executable, '-c', code, str(write_fd)])
+        assert not os.get_inheritable(write_fd)
+        with pytest.raises(subprocess.CalledProcessError):
+            run_command([sys.executable, '-c', code, str(leaked_fd)])
+
+        spawn.configure('posix_spawn', keep_fds=True)
+        run_command([sys.executable, '-c', code, str(leaked_fd)])
+    finally:
+        spawn.shutdown()
+        spawn.method = 'subprocess'
+        spawn.close_fds = True
+        for fd in (read_fd, write_fd, leaked_fd):
+            os.close(fd)
+
+
+def test_configure_fallback(monkeypatch):
+    # e.g. Python 3.8 has posix_spawnp but not waitstatus_to_exitcode
+    monkeypatch.delattr(os, 'waitstatus_to_exitcode')
+    spawn.configure('posix_spawn')
+    assert spawn.method == 'subprocess'
@@ -0,0 +1,58 @@
+"""Track startup cost of the command line tool with `python -X importtime`"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires 3.7')
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def importtime(args, cwd=None):
+    """Run plsmake, return module -> (cumulative import time in us, nested)"""
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-m', 'plsmake'] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env,
+    )
+    _, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+    modules = dict()
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules[name.strip()] = int(cumulative), name.startswith('  ')
+    return modules
+
+
+def report(title, modules):
+    total = sum(
+        us for name, (us, nested) in modules.items() if name.startswith('plsmake') and not nested)
+    print('\n%s: plsmake imports took %.1fms' % (title, total / 1000))
+
+
+def test_version_startup():
+    modules = importtime(['--version'])
+    report('--version', modules)
+    for name in ['structlog', 'concurrent.futures', 'plsmake.app', 'json', 'subprocess']:
+        assert name not in modules
+
+
+def test_resolve_startup(tmpdir):
+    tmpdir.join('Plsmakefile.py').write("""
+from plsmake.api import *
+
+@deps('all')
+def all(env, depends):
+    depends.append('a.c')
+""")
+    modules = importtime(['--resolve', 'all'], cwd=str(tmpdir))
+    report('--resolve', modules)
+    for name in ['structlog', 'concurrent.futures', 'plsmake.db', 'subprocess']:
+        assert name not in modules
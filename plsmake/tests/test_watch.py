@@ -0,0 +1,140 @@
+import os
+
+from plsmake.app import load_string, resolve, ParallelExecutor
+from plsmake.env import Env
+from plsmake.watch import PollingWatcher, affected_targets, create_watcher, leaf_files
+
+
+SOURCE = """
+from plsmake.api import *
+
+@deps('app')
+def app(env, depends):
+    depends.extend(['a.o', 'b.o'])
+
+@deps('{name}.o')
+def obj(env, depends, name):
+    depends.append(name + '.c')
+
+@action('{name}.o')
+def obj(env, depends, name):
+    pass
+
+@action('app')
+def app(env, depends):
+    pass
+"""
+
+
+def test_affected_targets():
+    rule_list, env = load_string(SOURCE, Env())
+    howto = resolve('app', rule_list, env)
+    assert sorted(leaf_files(howto)) == ['a.c', 'b.c']
+
+    controller = ParallelExecutor(howto)
+    controller.add_target('app')
+    rev = controller.rev_depends()
+    assert affected_targets(rev, ['a.c']) == {'a.c', 'a.o', 'app'}
+
+    controller = ParallelExecutor(howto)
+    controller.add_target('app', limit=affected_targets(rev, ['a.c']))
+    assert controller.rev_depends() == {'a.o': {'app'}, 'a.c': {'a.o'}}
+
+
+def test_watcher(tmpdir):
+    filename = str(tmpdir.join('a.c'))
+    with open(filename, 'wt') as fp:
+        fp.write('1')
+
+    factories = [lambda: PollingWatcher([filename], interval=0.01), lambda: create_watcher([filename])]
+    for factory in factories:
+        watcher = factory()
+        assert watcher.wait(timeout=0.05) == set()
+        with open(filename + '.tmp', 'wt') as fp:
+            fp.write('22')
+        os.replace(filename + '.tmp', filename)
+        assert watcher.wait(timeout=1) == {filename}
+        watcher.close()
+
+
+def test_watch_after_failure(tmpdir, monkeypatch):
+    from plsmake import watch as watch_module
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('build.py').write(SOURCE)
+    limits = []
+    results = [RuntimeError, RuntimeError, None, None]
+
+    class Executor(ParallelExecutor):
+        def add_target(self, target, limit=None):
+            if target == 'app':
+                limits.append(limit and sorted(limit))
+            super().add_target(target, limit=limit)
+
+        def start(self, jobs, **options):
+            error = results.pop(0)
+            if error is not None:
+                raise error('build failed')
+
+    changes = [{'a.c'}, {'b.c'}, {'a.c'}]
+
+    def collect_changes(watcher, settle=0.2):
+        if not changes:
+            raise KeyboardInterrupt
+        return changes.pop(0)
+
+    monkeypatch.setattr(watch_module, 'ParallelExecutor', Executor)
+    monkeypatch.setattr(watch_module, 'collect_changes', collect_changes)
+    try:
+        watch_module.watch('build.py', ['app'])
+    except KeyboardInterrupt:
+        pass
+    # the first one is for rev_depends(); after a failure, the next build is a full one
+    # even if the change is elsewhere
+    assert limits == [None, None, None, None, ['a.c', 'a.o', 'app']]
+
+
+def test_watch_reloads_includes(tmpdir, monkeypatch):
+    from plsmake import watch as watch_module
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('build.py').write("from plsmake.api import *\ninclude('rules.py')\n")
+    tmpdir.join('rules.py').write(SOURCE)
+    loads = []
+    resolve_all = watch_module._resolve_all
+
+    def _resolve_all(filename, targets, memo=None):
+        plans, build_files = resolve_all(filename, targets, memo=memo)
+        loads.append(sorted(build_files))
+        return plans, build_files
+
+    class Executor(ParallelExecutor):
+        def start(self, jobs, **options):
+            pass
+
+    class Watcher:
+        def __init__(self, files, interval=0.5):
+            self.set_files(files)
+
+        def set_files(self, files):
+            self.files = set(files)
+
+        def close(self):
+            pass
+
+    changes = [{'a.c'}, {'rules.py'}]
+
+    def collect_changes(watcher, settle=0.2):
+        assert 'rules.py' in watcher.files
+        if not changes:
+            raise KeyboardInterrupt
+        return changes.pop(0)
+
+    monkeypatch.setattr(watch_module, '_resolve_all', _resolve_all)
+    monkeypatch.setattr(watch_module, 'create_watcher', Watcher)
+    monkeypatch.setattr(watch_module, 'ParallelExecutor', Executor)
+    monkeypatch.setattr(watch_module, 'collect_changes', collect_changes)
+    try:
+        watch_module.watch('build.py', ['app'])
+    except KeyboardInterrupt:
+        pass
+    # a source change does not reload, a change of the included file does
+    assert loads == [['build.py', 'rules.py']] * 2
@@ -1,5 +1,25 @@
+import hashlib
+from types import CodeType
 from typing import Callable
 
 
 def func_name(func: Callable):
     return func.__name__
+
+
+def update_code_hash(h, code: CodeType):
+    """Hash the behavior of code object, ignore line numbers and addresses"""
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            update_code_hash(h, const)
+        else:
+            h.update(repr(const).encode())
+
+
+def code_digest(func: Callable) -> str:
+    func = getattr(func, 'func', func)  # unwrap Action
+    h = hashlib.sha1()
+    update_code_hash(h, func.__code__)
+    return h.hexdigest()
@@ -0,0 +1,267 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+from plsmake import logger
+from plsmake.app import create_init_env, load_file, resolve, ResolverResults, ParallelExecutor
+
+
+def _mtime(filename: str):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+class PollingWatcher:
+    """Detect file changes by comparing mtime periodically"""
+
+    def __init__(self, files: Iterable[str], interval=0.5):
+        self.interval = interval
+        self._mtimes = dict()   # type: Dict[str, int]
+        self.set_files(files)
+
+    def set_files(self, files: Iterable[str]):
+        self._mtimes = dict((filename, _mtime(filename)) for filename in files)
+
+    def poll(self) -> Set[str]:
+        changed = set()
+        for filename, old in self._mtimes.items():
+            new = _mtime(filename)
+            if new != old:
+                self._mtimes[filename] = new
+                changed.add(filename)
+        return changed
+
+    def wait(self, timeout=None) -> Set[str]:
+        """Block until some files changed or timeout, return changed files"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = self.poll()
+            if changed:
+                return changed
+
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return changed
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+)
+_IN_EVENT = struct.Struct('iIII')   # wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    """Watch directories containing the files with inotify, so that files
+    replaced by rename (as editors do) are also detected."""
+
+    def __init__(self, files: Iterable[str], libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self._wds = dict()      # type: Dict[str, int]
+        self._dirs = dict()     # type: Dict[int, str]
+        self._names = dict()    # type: Dict[Tuple[str, bytes], str]
+        self.set_files(files)
+
+    def set_files(self, files: Iterable[str]):
+        self._names.clear()
+        for filename in files:
+            dirname, basename = os.path.split(filename)
+            self._names[(dirname or '.', os.fsencode(basename))] = filename
+
+        dirs = set(dirname for dirname, _ in self._names)
+        for dirname in set(self._wds) - dirs:
+            wd = self._wds.pop(dirname)
+            self._dirs.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+        for dirname in dirs - set(self._wds):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirname), _IN_MASK)
+            if wd < 0:
+                logger.warning('watch.add_watch_fail', dir=dirname, errno=ctypes.get_errno())
+                continue
+            self._wds[dirname] = wd
+            self._dirs[wd] = dirname
+
+    def _read_events(self) -> Set[str]:
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _IN_EVENT.unpack_from(data, offset)
+                offset += _IN_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                filename = self._names.get((self._dirs.get(wd), name))
+                if filename is not None:
+                    changed.add(filename)
+
+    def wait(self, timeout=None) -> Set[str]:
+        """Block until some files changed or timeout, return changed files"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = None if deadline is None else max(deadline - time.monotonic(), 0)
+            readable, _, _ = select.select([self._fd], [], [], delay)
+            if not readable:
+                return set()
+            changed = self._read_events()
+            if changed:
+                return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _load_libc_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def create_watcher(files: Iterable[str], interval=0.5):
+    """Return an inotify based watcher if possible, or fallback to polling"""
+    files = list(files)
+    libc = _load_libc_inotify()
+    if libc is not None:
+        try:
+            return InotifyWatcher(files, libc)
+        except OSError:
+            logger.exception('watch.inotify_fail')
+    return PollingWatcher(files, interval=interval)
+
+
+def leaf_files(howto: ResolverResults) -> List[str]:
+    """Return targets without dependencies and action, i.e. source files"""
+    return [
+        target for target, (depends, _, action, _) in howto.items()
+        if not depends and action is None
+    ]
+
+
+def affected_targets(rev_depends: Dict[str, Set[str]], changed: Iterable[str]) -> Set[str]:
+    """Return changed files and all targets depend on them directly or indirectly"""
+    result = set()
+    stack = list(changed)
+    while stack:
+        target = stack.pop()
+        if target not in result:
+            result.add(target)
+            stack.extend(rev_depends.get(target, ()))
+    return result
+
+
+def collect_changes(watcher, settle=0.2) -> Set[str]:
+    """Wait for changes, then merge bursts of changes until files are quiet for settle seconds"""
+    changed = watcher.wait()
+    while True:
+        more = watcher.wait(timeout=settle)
+        if not more:
+            return changed
+        changed |= more
+
+
+def _resolve_all(filename: str, targets: Sequence[str], memo=None):
+    """Return the plans of targets and the build files loaded, including lazy includes
+    loaded while resolving"""
+    rule_list, env = load_file(filename, create_init_env())
+    plans = []
+    for target in targets:
+        howto = resolve(target, rule_list, env, memo=memo)
+        controller = ParallelExecutor(howto)
+        controller.add_target(target)
+        plans.append((target, howto, controller.rev_depends()))
+    return plans, {filename} | set(rule_list.included)
+
+
+def watch(
+        filename: str, targets: Sequence[str], jobs=1, always_make=False,
+        settle=0.2, interval=0.5, memo=None, **options):
+    """Build targets, then rebuild the affected part of graph whenever source files changed.
+    The build file is re-loaded if it or a file it includes is changed, only resolvers
+    whose inputs changed are re-run if memo is given. A target whose last build failed is
+    built in full next time, as its failed or unfinished parts may not be affected by the
+    change.
+    options are passed to run_target_action()"""
+    watcher = None
+    plans = []
+    changed = set()
+    failed = set()  # type: Set[str]
+    build_files = {filename}
+    reload = True
+    try:
+        while True:
+            if reload:
+                try:
+                    plans, build_files = _resolve_all(filename, targets, memo=memo)
+                except Exception:
+                    # keep watching the includes of the last load, one may be what failed
+                    logger.exception('watch.load_fail', file=filename)
+                    plans = []
+
+                files = set(build_files)
+                for _, howto, _ in plans:
+                    files.update(leaf_files(howto))
+                if watcher is None:
+                    watcher = create_watcher(files, interval=interval)
+                else:
+                    watcher.set_files(files)
+                logger.info('watch.files', count=len(files), watcher=type(watcher).__name__)
+
+            for target, howto, rev_depends in plans:
+                limit = None
+                if not reload and target not in failed:
+                    limit = affected_targets(rev_depends, changed)
+                if limit is not None and target not in limit:
+                    continue
+
+                logger.info('watch.build', target=target, affected=(limit and len(limit)))
+                controller = ParallelExecutor(howto)
+                controller.add_target(target, limit=limit)
+                try:
+                    controller.start(jobs, always_make=always_make, **options)
+                except Exception:
+                    logger.error('watch.build_fail', target=target)
+                    failed.add(target)
+                else:
+                    failed.discard(target)
+
+            always_make = False
+            logger.info('watch.waiting')
+            changed = collect_changes(watcher, settle=settle)
+            logger.info('watch.changed', files=sorted(changed))
+            reload = not build_files.isdisjoint(changed)
+    finally:
+        if watcher is not None:
+            watcher.close()
@@ -0,0 +1,229 @@
+"""A worker agent running commands for plsmake.remote. Usage:
+
+    python -m plsmake.worker --listen 127.0.0.1:7000 --root /tmp/plsworker
+    python -m plsmake.worker --listen unix:/tmp/plsworker.sock
+    PLSMAKE_WORKER_TOKEN=secret python -m plsmake.worker --listen 0.0.0.0:7000
+
+Workers run any command they are sent, so a shared token is required to listen on
+addresses other than loopback, and clients must present it in their `hello`.
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+
+from plsmake.helpers import CACHE_DIR, joinpath
+from plsmake.remote import (
+    IO_TIMEOUT, ProtocolError, parse_address, recv_file, recv_message, send_file, send_message,
+)
+
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        authenticated = self.server.token is None
+        while True:
+            sock.settimeout(None)   # clients keep idle connections
+            try:
+                message = recv_message(sock)
+            except (ProtocolError, OSError):
+                return
+            sock.settimeout(self.server.timeout)
+            if not authenticated:
+                if message.get('op') != 'hello' or not self.server.check_token(message):
+                    send_message(sock, dict(error='authentication failed'))
+                    return
+                authenticated = True
+            try:
+                try:
+                    handler = getattr(self, 'op_%s' % (message.get('op'),))
+                    reply, data = handler(message)
+                except Exception as exc:
+                    send_message(sock, dict(error='%s: %s' % (type(exc).__name__, exc)))
+                    if message.get('size'):
+                        return  # the payload may be partly read, the connection is unusable
+                    continue
+                if isinstance(data, bytes):
+                    if data:
+                        reply['size'] = len(data)
+                    send_message(sock, reply, data)
+                else:
+                    with data:
+                        send_file(sock, reply, data)
+            except (ProtocolError, OSError):
+                return
+
+    def op_hello(self, message):
+        return dict(slots=self.server.slots), b''
+
+    def op_has(self, message):
+        missing = [d for d in message['digests'] if not os.path.exists(self.server.object_path(d))]
+        return dict(missing=missing), b''
+
+    def op_put(self, message):
+        self.server.receive_object(message['digest'], self.request, message.get('size', 0))
+        return dict(), b''
+
+    def op_get(self, message):
+        return dict(), open(self.server.object_path(message['digest']), 'rb')
+
+    def op_run(self, message):
+        return self.server.run(message['commands'], message['inputs'], message['outputs'])
+
+
+def _check_relative(path: str):
+    if os.path.isabs(path) or os.path.normpath(path).startswith('..'):
+        raise ValueError('path outside of work directory: %s' % (path,))
+
+
+def _is_loopback(family, sockaddr) -> bool:
+    import ipaddress
+    if family == socket.AF_UNIX:
+        return True
+    host = sockaddr[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+            self, root: str, address='127.0.0.1:0', slots=None, token=None, timeout=IO_TIMEOUT):
+        """token: the secret clients must send, required unless listening on loopback
+        timeout: of reading a request or sending a reply"""
+        self.root = root
+        self.slots = slots or os.cpu_count() or 1
+        self.token = token
+        self.timeout = timeout
+        self.address_family, sockaddr = parse_address(address)
+        if token is None and not _is_loopback(self.address_family, sockaddr):
+            raise ValueError('a token is required to listen on %s' % (address,))
+        os.makedirs(os.path.join(root, 'work'), exist_ok=True)
+        if self.address_family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.remove(sockaddr)
+        super().__init__(sockaddr, WorkerHandler)
+
+    @property
+    def address(self) -> str:
+        if self.address_family == socket.AF_UNIX:
+            return 'unix:' + self.server_address
+        host, port = self.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    def check_token(self, message: dict) -> bool:
+        token = message.get('token')
+        return isinstance(token, str) and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def object_path(self, digest: str) -> str:
+        if not all(ch in '0123456789abcdef' for ch in digest):
+            raise ValueError('bad digest')
+        return os.path.join(self.root, 'cas', digest[:2], digest)
+
+    def receive_object(self, digest: str, sock: socket.socket, size: int):
+        """Store a payload of size bytes read from sock, which must match digest"""
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        try:
+            with open(tmp, 'wb') as fp:
+                if recv_file(sock, size, fp) != digest:
+                    raise ValueError('digest mismatch')
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _store_file(self, filename: str) -> str:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(filename, 0o444)
+            os.replace(filename, path)
+        return digest
+
+    def run(self, commands, inputs, outputs):
+        """Run commands in a scratch directory with inputs, return digests of outputs"""
+        work = tempfile.mkdtemp(dir=os.path.join(self.root, 'work'))
+        try:
+            for path, digest in inputs.items():
+                _check_relative(path)
+                dst = os.path.join(work, path)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                try:
+                    os.link(self.object_path(digest), dst)
+                except OSError:
+                    shutil.copyfile(self.object_path(digest), dst)
+            for path in outputs:
+                _check_relative(path)
+                os.makedirs(os.path.dirname(os.path.join(work, path)), exist_ok=True)
+
+            log = []
+            returncode = 0
+            for args in commands:
+                proc = subprocess.run(
+                    args, cwd=work, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                log.append(proc.stdout)
+                returncode = proc.returncode
+                if returncode != 0:
+                    break
+
+            result = dict()
+            if returncode == 0:
+                for path in outputs:
+                    result[path] = self._store_file(os.path.join(work, path))
+            return dict(returncode=returncode, outputs=result), b''.join(log)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--listen', default='127.0.0.1:7000', help='host:port or unix:/path to listen')
+    parser.add_argument('--root', default=joinpath(CACHE_DIR, 'worker'), help='storage directory')
+    parser.add_argument('--slots', type=int, help='max concurrent jobs, default: number of CPUs')
+    parser.add_argument(
+        '--token', default=os.environ.get('PLSMAKE_WORKER_TOKEN'),
+        help='secret clients must present, required for non-loopback addresses, '
+             'default: $PLSMAKE_WORKER_TOKEN')
+    option = parser.parse_args()
+
+    try:
+        server = WorkerServer(
+            option.root, address=option.listen, slots=option.slots, token=option.token)
+    except ValueError as exc:
+        parser.error(str(exc))
+    print('worker listening at', server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
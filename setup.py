@@ -2,8 +2,8 @@ import sys
 from setuptools import setup
 
 
-if sys.version_info[:2] < (3, 4):
-    raise SystemExit('require Python3.4+')
+if sys.version_info[:2] < (3, 5):
+    raise SystemExit('require Python3.5+')
 
 
 setup(
@@ -18,7 +18,7 @@ setup(
     entry_points={
         'console_scripts': ['plsmake=plsmake.__main__:main'],
     },
-    python_requires='>=3.4',
+    python_requires='>=3.5',
     url='https://github.com/account-login/plsmake',
     license='MIT',
     author='account-login',
@@ -43,7 +43,6 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
     ],